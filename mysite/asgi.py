@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
 
 application = get_asgi_application()
+
+# Resume the character generation jobs of a previous run of this server
+from npc_api.services.character_jobs import start_recovery  # noqa: E402
+
+start_recovery()
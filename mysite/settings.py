@@ -46,6 +46,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'npc_api.middleware.metrics_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -80,12 +81,7 @@ WSGI_APPLICATION = 'mysite.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db' / 'db.sqlite3',
-    }
-}
+# Selected with DB_ENGINE (sqlite or postgres) once .env is loaded, see below
 
 
 # Password validation
@@ -133,7 +129,10 @@ REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': [
         'rest_framework.renderers.JSONRenderer',
         'rest_framework.renderers.BrowsableAPIRenderer',
-    ]
+    ],
+    'DEFAULT_PAGINATION_CLASS': 'npc_api.pagination.DefaultPagination',
+    'PAGE_SIZE': 20,
+    'EXCEPTION_HANDLER': 'npc_api.exceptions.exception_handler',
 }
 
 from dotenv import load_dotenv
@@ -142,3 +141,210 @@ from pathlib import Path
 BASE_DIR = Path(__file__).resolve().parent.parent
 load_dotenv(BASE_DIR / '.env')
 STORY_FILE_PATH = os.path.join(BASE_DIR, 'data', 'fantasy.md')
+
+# LLM backend used by npc_api.services: 'gemini', 'fake' (deterministic offline
+# stand-in for load testing) or a dotted path to an LLMBackend subclass
+LLM_BACKEND = os.environ.get('LLM_BACKEND', 'gemini')
+LLM_MODEL = os.environ.get('LLM_MODEL', 'gemini-2.0-flash-lite')
+LLM_BACKEND_OPTIONS = {}
+if LLM_BACKEND == 'fake':
+    LLM_BACKEND_OPTIONS = {
+        'latency': float(os.environ.get('LLM_FAKE_LATENCY', '0')),
+        'jitter': float(os.environ.get('LLM_FAKE_JITTER', '0')),
+        'distribution': os.environ.get('LLM_FAKE_DISTRIBUTION', 'uniform'),
+        'token_latency': float(os.environ.get('LLM_FAKE_TOKEN_LATENCY', '0')),
+        'seed': int(os.environ.get('LLM_FAKE_SEED', '0')),
+        'error_rate': float(os.environ.get('LLM_FAKE_ERROR_RATE', '0')),
+    }
+
+# Connection pool of the process-wide Gemini client (keep-alive between requests)
+LLM_HTTP_MAX_CONNECTIONS = int(os.environ.get('LLM_HTTP_MAX_CONNECTIONS', '100'))
+LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS', '20'))
+LLM_HTTP_KEEPALIVE_EXPIRY = float(os.environ.get('LLM_HTTP_KEEPALIVE_EXPIRY', '60'))
+
+# Call scheduler shared by all model calls of a process: concurrent calls in total
+# and per task ("summary=2,talk=8"), rate limit in calls per second (0 = off) with
+# bursts of LLM_RATE_BURST, and retries with exponential backoff and jitter on
+# rate-limit (429) and availability (5xx) errors
+LLM_SCHEDULER = os.environ.get('LLM_SCHEDULER', 'true').lower() in ('1', 'true', 'yes')
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', '16'))
+LLM_TASK_CONCURRENCY = {
+    task.strip(): int(limit)
+    for task, _, limit in (
+        item.partition('=') for item in os.environ.get('LLM_TASK_CONCURRENCY', 'summary=4,memory=4').split(',')
+    )
+    if task.strip() and limit.strip()
+}
+LLM_RATE_LIMIT = float(os.environ.get('LLM_RATE_LIMIT', '0'))
+LLM_RATE_BURST = float(os.environ.get('LLM_RATE_BURST', '0'))
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', '3'))
+LLM_RETRY_BASE_DELAY = float(os.environ.get('LLM_RETRY_BASE_DELAY', '0.5'))
+LLM_RETRY_MAX_DELAY = float(os.environ.get('LLM_RETRY_MAX_DELAY', '10'))
+
+# Tasks whose identical concurrent calls (same prompt and model) share one request,
+# e.g. the summary of a new story requested by many clients at once
+LLM_COALESCE_TASKS = [
+    task.strip() for task in os.environ.get('LLM_COALESCE_TASKS', 'summary,question').split(',') if task.strip()
+]
+
+# Token budgets of prompt fields, "<template>.<field>=<tokens>" (e.g.
+# "persona.background=200,character.story_summary=1000"); they override the defaults
+# in npc_api.services.prompts. Longer values are truncated at a word boundary.
+PROMPT_FIELD_BUDGETS = {
+    field.strip(): int(tokens)
+    for field, _, tokens in (item.partition('=') for item in os.environ.get('PROMPT_FIELD_BUDGETS', '').split(','))
+    if field.strip() and tokens.strip()
+}
+
+# Retrieval index used to answer questions about a story: passage size in words
+# and the number of passages sent with each question
+STORY_INDEX_CHUNK_WORDS = int(os.environ.get('STORY_INDEX_CHUNK_WORDS', '200'))
+STORY_INDEX_TOP_K = int(os.environ.get('STORY_INDEX_TOP_K', '4'))
+
+# Response cache for story questions and generated names. LocMemCache evicts the
+# least recently used entries; CULL_FREQUENCY == MAX_ENTRIES culls one at a time.
+LLM_RESPONSE_CACHE_TTL = int(os.environ.get('LLM_RESPONSE_CACHE_TTL', '3600'))
+LLM_RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('LLM_RESPONSE_CACHE_MAX_ENTRIES', '1000'))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'llm_responses': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'llm-responses',
+        'TIMEOUT': LLM_RESPONSE_CACHE_TTL,
+        'OPTIONS': {
+            'MAX_ENTRIES': LLM_RESPONSE_CACHE_MAX_ENTRIES,
+            'CULL_FREQUENCY': LLM_RESPONSE_CACHE_MAX_ENTRIES,
+        },
+    },
+}
+
+# Character personas (the static part of the talk prompt) are kept in the default
+# cache for PERSONA_CACHE_TIMEOUT seconds and dropped when the character is saved.
+# With LLM_CONTEXT_CACHE on, personas of at least LLM_CONTEXT_CACHE_MIN_TOKENS
+# tokens (the provider's minimum) are cached by the provider for
+# LLM_CONTEXT_CACHE_TTL seconds, so each turn only sends the new messages;
+# smaller ones are sent as the system instruction.
+PERSONA_CACHE_TIMEOUT = int(os.environ.get('PERSONA_CACHE_TIMEOUT', '3600'))
+LLM_CONTEXT_CACHE = os.environ.get('LLM_CONTEXT_CACHE', 'true').lower() in ('1', 'true', 'yes')
+LLM_CONTEXT_CACHE_TTL = int(os.environ.get('LLM_CONTEXT_CACHE_TTL', '3600'))
+LLM_CONTEXT_CACHE_MIN_TOKENS = int(os.environ.get('LLM_CONTEXT_CACHE_MIN_TOKENS', '1024'))
+
+# Group talk: max characters addressed by one message and concurrent model calls
+GROUP_TALK_MAX_CHARACTERS = int(os.environ.get('GROUP_TALK_MAX_CHARACTERS', '10'))
+GROUP_TALK_CONCURRENCY = int(os.environ.get('GROUP_TALK_CONCURRENCY', '10'))
+
+# Batch character generation: max characters per request and concurrent model calls
+CHARACTER_BATCH_MAX_SIZE = int(os.environ.get('CHARACTER_BATCH_MAX_SIZE', '50'))
+CHARACTER_BATCH_CONCURRENCY = int(os.environ.get('CHARACTER_BATCH_CONCURRENCY', '8'))
+
+# Generate character name and details in one structured-output (JSON schema) call
+CHARACTER_SINGLE_CALL = os.environ.get('CHARACTER_SINGLE_CALL', 'true').lower() in ('1', 'true', 'yes')
+
+# Unique character names per story: how often a name is regenerated after a
+# collision and how many taken names are listed in the prompt
+CHARACTER_NAME_RETRIES = int(os.environ.get('CHARACTER_NAME_RETRIES', '2'))
+NAME_REGISTRY_PROMPT_SAMPLE = int(os.environ.get('NAME_REGISTRY_PROMPT_SAMPLE', '20'))
+
+# Conversation memory: messages sent verbatim with each talk request, and how many
+# older messages accumulate before they are folded into the rolling summary
+CONVERSATION_MEMORY_TURNS = int(os.environ.get('CONVERSATION_MEMORY_TURNS', '10'))
+CONVERSATION_SUMMARY_EVERY = int(os.environ.get('CONVERSATION_SUMMARY_EVERY', '10'))
+# Threads per process updating the summaries after the reply was sent; with 0 the
+# summary is updated within the talk request
+CONVERSATION_SUMMARY_WORKERS = int(os.environ.get('CONVERSATION_SUMMARY_WORKERS', '2'))
+
+# Personality words that classify a character as good or evil when it is saved
+# (comma-separated). Traits are matched as whole words, so "unkind" does not count
+# as "kind", and words after "not"/"never" are ignored. Characters matching
+# neither side, or both equally, are neutral.
+PERSONALITY_TRAIT_LEXICON = {
+    'good': os.environ.get(
+        'PERSONALITY_GOOD_TRAITS',
+        'good,kind,helpful,honest,fair,noble,generous,compassionate,loyal,gentle,friendly,caring,'
+        'benevolent,trustworthy,selfless,merciful,just',
+    ).split(','),
+    'evil': os.environ.get(
+        'PERSONALITY_EVIL_TRAITS',
+        'evil,bad,cruel,selfish,cunning,ruthless,malicious,greedy,treacherous,deceitful,vicious,'
+        'sadistic,manipulative,unkind,dishonest,vengeful,callous,corrupt',
+    ).split(','),
+}
+
+# Conversation history writes: buffer turns and insert them in periodic batches
+# (flush every FLUSH_INTERVAL seconds or once FLUSH_SIZE messages are waiting)
+# instead of one transaction per talk request; failed writes are retried by the
+# next FLUSH_RETRIES flushes
+CONVERSATION_HISTORY_BUFFERED = os.environ.get('CONVERSATION_HISTORY_BUFFERED', 'false').lower() in ('1', 'true', 'yes')
+CONVERSATION_HISTORY_FLUSH_INTERVAL = float(os.environ.get('CONVERSATION_HISTORY_FLUSH_INTERVAL', '0.5'))
+CONVERSATION_HISTORY_FLUSH_SIZE = int(os.environ.get('CONVERSATION_HISTORY_FLUSH_SIZE', '200'))
+CONVERSATION_HISTORY_FLUSH_RETRIES = int(os.environ.get('CONVERSATION_HISTORY_FLUSH_RETRIES', '5'))
+
+# Background character generation jobs: worker threads per process, and how often
+# a subscribed client (?stream=sse) is sent the job status, for at most TIMEOUT seconds.
+# Each subscription holds a server worker while it lasts; clients reconnect after
+# the timeout. RUNNING jobs not updated for STALE_AFTER seconds are considered lost
+# with their process and requeued when a process starts serving (RECOVER_ON_START).
+CHARACTER_JOB_WORKERS = int(os.environ.get('CHARACTER_JOB_WORKERS', '4'))
+CHARACTER_JOB_POLL_INTERVAL = float(os.environ.get('CHARACTER_JOB_POLL_INTERVAL', '0.5'))
+CHARACTER_JOB_STREAM_TIMEOUT = float(os.environ.get('CHARACTER_JOB_STREAM_TIMEOUT', '30'))
+CHARACTER_JOB_STALE_AFTER = float(os.environ.get('CHARACTER_JOB_STALE_AFTER', '900'))
+CHARACTER_JOB_RECOVER_ON_START = os.environ.get('CHARACTER_JOB_RECOVER_ON_START', 'true').lower() in ('1', 'true', 'yes')
+
+# Metrics served at /metrics (Prometheus text format): request latency, model calls,
+# prompt sizes and database queries per endpoint. METRICS_TIMING_HEADER adds a
+# Server-Timing header with the model / database / app time of each request.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+METRICS_TIMING_HEADER = os.environ.get('METRICS_TIMING_HEADER', str(DEBUG)).lower() in ('1', 'true', 'yes')
+
+# Database profile, DB_ENGINE=sqlite (default) or postgres.
+# SQLite runs in WAL mode so readers do not block the writer; writers wait up to
+# DB_TIMEOUT seconds for the lock and take it when the transaction starts
+# (IMMEDIATE) instead of failing on upgrade from a read lock.
+DB_ENGINE = os.environ.get('DB_ENGINE', 'sqlite')
+DB_TIMEOUT = int(os.environ.get('DB_TIMEOUT', '20'))
+
+if DB_ENGINE == 'postgres':
+    # DB_POOL=true uses psycopg's connection pool (CONN_MAX_AGE must then be 0);
+    # otherwise connections persist for DB_CONN_MAX_AGE seconds
+    DB_POOL = os.environ.get('DB_POOL', 'false').lower() in ('1', 'true', 'yes')
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('DB_NAME', 'npc'),
+            'USER': os.environ.get('DB_USER', 'npc'),
+            'PASSWORD': os.environ.get('DB_PASSWORD', 'npc'),
+            'HOST': os.environ.get('DB_HOST', 'localhost'),
+            'PORT': os.environ.get('DB_PORT', '5432'),
+            'CONN_MAX_AGE': 0 if DB_POOL else int(os.environ.get('DB_CONN_MAX_AGE', '60')),
+            'CONN_HEALTH_CHECKS': not DB_POOL,
+            'OPTIONS': {
+                'connect_timeout': DB_TIMEOUT,
+            },
+        }
+    }
+    if DB_POOL:
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'min_size': int(os.environ.get('DB_POOL_MIN_SIZE', '2')),
+            'max_size': int(os.environ.get('DB_POOL_MAX_SIZE', '20')),
+            'timeout': DB_TIMEOUT,
+        }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db' / 'db.sqlite3',
+            'OPTIONS': {
+                'timeout': DB_TIMEOUT,
+                'transaction_mode': 'IMMEDIATE',
+                'init_command': (
+                    'PRAGMA journal_mode=WAL;'
+                    'PRAGMA synchronous=NORMAL;'
+                    f'PRAGMA busy_timeout={DB_TIMEOUT * 1000};'
+                    f'PRAGMA mmap_size={int(os.environ.get("DB_SQLITE_MMAP_SIZE", 128 * 1024 * 1024))};'
+                ),
+            },
+        }
+    }
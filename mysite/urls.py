@@ -20,6 +20,7 @@ urlpatterns = [
     path('api/', include('npc_api.urls')),
     path('swagger/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
     path('redoc/', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
+    path('metrics', views.metrics_view, name='metrics'),
 
     # frontend views
     path('', views.main_page, name='main'),
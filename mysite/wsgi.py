@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
 
 application = get_wsgi_application()
+
+# Resume the character generation jobs of a previous run of this server
+from npc_api.services.character_jobs import start_recovery  # noqa: E402
+
+start_recovery()
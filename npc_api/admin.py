@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Story, Character
+from .models import Story, Character, ConversationHistory, CharacterGenerationJob
 
 
 @admin.register(Story)
@@ -11,7 +11,27 @@ class StoryAdmin(admin.ModelAdmin):
 
 @admin.register(Character)
 class CharacterAdmin(admin.ModelAdmin):
-    list_display = ('id', 'name', 'faction', 'profession', 'story', 'created_at')
+    list_display = ('id', 'name', 'faction', 'profession', 'alignment', 'story', 'created_at')
     search_fields = ('name', 'faction', 'profession')
-    list_filter = ('faction', 'profession', 'created_at')
+    list_filter = ('alignment', 'faction', 'profession', 'created_at')
     ordering = ('-created_at',)
+
+
+@admin.register(ConversationHistory)
+class ConversationHistoryAdmin(admin.ModelAdmin):
+    list_display = ('id', 'character', 'sender_type', 'timestamp')
+    list_filter = ('sender_type',)
+    search_fields = ('message',)
+    ordering = ('-timestamp',)
+    # __str__ and the character column read character.name
+    list_select_related = ('character',)
+    raw_id_fields = ('character',)
+
+
+@admin.register(CharacterGenerationJob)
+class CharacterGenerationJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'story', 'status', 'character', 'created_at', 'updated_at')
+    list_filter = ('status',)
+    ordering = ('-created_at',)
+    list_select_related = ('story', 'character')
+    raw_id_fields = ('story', 'character')
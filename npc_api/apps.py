@@ -4,3 +4,15 @@ from django.apps import AppConfig
 class NpcApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'npc_api'
+
+    def ready(self):
+        from django.conf import settings
+        from django.db.backends.signals import connection_created
+
+        from . import signals  # noqa: F401
+        from .metrics import install_query_recorder
+        from .services.prompts import warn_unknown_field_budgets
+
+        warn_unknown_field_budgets()
+        if settings.METRICS_ENABLED:
+            connection_created.connect(install_query_recorder, dispatch_uid='npc_api.metrics.query_recorder')
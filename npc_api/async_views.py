@@ -0,0 +1,254 @@
+import json
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import status
+from rest_framework.authentication import CSRFCheck
+
+from .models import Story, Character
+from .serializers import (
+    CharacterSerializer,
+    StoryQuestionSerializer,
+    CharacterRequestSerializer,
+    CharacterBatchRequestSerializer,
+    CharacterTalkSerializer,
+    GroupTalkSerializer,
+)
+from .services.story_understanding import StoryUnderstanding
+from .services.character_generator import CharacterGenerator
+from .services.character_conversation import CharacterConversation
+from .services.group_conversation import GroupConversation
+from .services.response_cache import ResponseCache
+from .services.llm_backend import LLMError
+from .services.name_registry import unique_names
+from .exceptions import llm_error_response
+from .streaming import event_stream_response, get_stream_format, streaming_response
+from .views import build_characters, load_group
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncAPIView(View):
+    """
+    Base class for the ASGI-native versions of the LLM-bound API views.
+
+    The views await the LLM backend and use the async ORM, so a single process
+    can keep many model calls in flight. Request bodies are JSON or form data,
+    validated with the same serializers as the DRF views. Failed model calls are
+    answered like in the DRF views (see npc_api.exceptions).
+
+    CSRF is checked like DRF's SessionAuthentication does: only for requests of
+    a user logged in with a session, so API clients without a session need no token.
+    """
+
+    http_method_names = ['post', 'options']
+
+    async def dispatch(self, request, *args, **kwargs):
+        reason = await self.check_csrf(request)
+        if reason:
+            return JsonResponse({"detail": f"CSRF Failed: {reason}"}, status=status.HTTP_403_FORBIDDEN)
+        try:
+            return await super().dispatch(request, *args, **kwargs)
+        except LLMError as e:
+            payload, status_code, headers = llm_error_response(e)
+            return JsonResponse(payload, status=status_code, headers=headers)
+
+    async def check_csrf(self, request):
+        """Returns why the request fails the CSRF check, or None."""
+        user = await request.auser()
+        if not user.is_authenticated:
+            return None
+        check = CSRFCheck(lambda request: None)
+        # Sets the CSRF cookie value on the request, as the middleware would
+        check.process_request(request)
+        return check.process_view(request, None, (), {})
+
+    def get_data(self, request):
+        if request.content_type == 'application/json':
+            try:
+                return json.loads(request.body or b'{}')
+            except ValueError:
+                return None
+        return request.POST
+
+    def validate(self, request, serializer_class):
+        """Returns (serializer, error_response); error_response is None when the data is valid."""
+        data = self.get_data(request)
+        if data is None:
+            return None, JsonResponse({"error": "Malformed JSON body"}, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = serializer_class(data=data)
+        if not serializer.is_valid():
+            return None, JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        return serializer, None
+
+
+class AsyncStoryAskQuestionView(AsyncAPIView):
+    async def post(self, request, story_id):
+        try:
+            story = await Story.objects.aget(id=story_id)
+        except Story.DoesNotExist:
+            return JsonResponse({"error": "Story does not exist"}, status=status.HTTP_404_NOT_FOUND)
+
+        serializer, error_response = self.validate(request, StoryQuestionSerializer)
+        if error_response:
+            return error_response
+
+        question = serializer.validated_data['question']
+        response_cache = ResponseCache.for_request(request, 'ask-question')
+        story_understanding = StoryUnderstanding(story=story, response_cache=response_cache)
+
+        stream_format = get_stream_format(request)
+        if stream_format:
+            return streaming_response(story_understanding.astream_answer(question), stream_format, 'answer')
+
+        answer = await story_understanding.aanswer_question(question)
+
+        return JsonResponse({'answer': answer}, headers={'X-Cache': response_cache.status})
+
+
+class AsyncGenerateCharacterView(AsyncAPIView):
+    async def post(self, request, story_id):
+        try:
+            story = await Story.objects.aget(pk=story_id)
+        except Story.DoesNotExist:
+            return JsonResponse(
+                {"error": "Story with the given ID does not exist"},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+        serializer, error_response = self.validate(request, CharacterRequestSerializer)
+        if error_response:
+            return error_response
+
+        story_understanding = StoryUnderstanding(story=story)
+        character_generator = CharacterGenerator(story_understanding)
+
+        character_request = serializer.validated_data['request']
+        character_data = await character_generator.agenerate_character_details(request=character_request)
+
+        with unique_names():
+            character = await Character.objects.acreate(
+                story=story,
+                name=character_data['name'],
+                faction=character_data['faction'],
+                profession=character_data['profession'],
+                personality_traits=character_data['personality_traits'],
+                background=character_data['background']
+            )
+
+        return JsonResponse(CharacterSerializer(character).data, status=status.HTTP_201_CREATED)
+
+
+class AsyncGenerateCharacterBatchView(AsyncAPIView):
+    async def post(self, request, story_id):
+        try:
+            story = await Story.objects.aget(pk=story_id)
+        except Story.DoesNotExist:
+            return JsonResponse(
+                {"error": "Story with the given ID does not exist"},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+        serializer, error_response = self.validate(request, CharacterBatchRequestSerializer)
+        if error_response:
+            return error_response
+
+        story_understanding = StoryUnderstanding(story=story)
+        character_generator = CharacterGenerator(story_understanding)
+
+        results = await character_generator.agenerate_characters(serializer.validated_data['requests'])
+        characters, errors = build_characters(story, results)
+        with unique_names():
+            await Character.objects.abulk_create(characters)
+
+        return JsonResponse(
+            {'characters': CharacterSerializer(characters, many=True).data, 'errors': errors},
+            status=status.HTTP_201_CREATED
+        )
+
+
+class AsyncGenerateCharacterNameView(AsyncAPIView):
+    async def post(self, request, story_id):
+        try:
+            story = await Story.objects.aget(pk=story_id)
+        except Story.DoesNotExist:
+            return JsonResponse(
+                {"error": "Story with the given ID does not exist"},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+        serializer, error_response = self.validate(request, CharacterRequestSerializer)
+        if error_response:
+            return error_response
+
+        response_cache = ResponseCache.for_request(request, 'generate-name')
+        story_understanding = StoryUnderstanding(story=story)
+        character_generator = CharacterGenerator(story_understanding, response_cache=response_cache)
+
+        character_request = serializer.validated_data['request']
+        name = await character_generator.agenerate_character_name(character_request)
+
+        return JsonResponse({'name': name}, headers={'X-Cache': response_cache.status})
+
+
+class AsyncCharacterTalkView(AsyncAPIView):
+    async def post(self, request, character_id):
+        try:
+            character = await Character.objects.aget(pk=character_id)
+        except Character.DoesNotExist:
+            return JsonResponse(
+                {"error": "Character with the given ID does not exist"},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+        serializer, error_response = self.validate(request, CharacterTalkSerializer)
+        if error_response:
+            return error_response
+
+        message = serializer.validated_data['message']
+
+        try:
+            conversation_service = CharacterConversation(character=character)
+
+            stream_format = get_stream_format(request)
+            if stream_format:
+                return streaming_response(
+                    conversation_service.astream_response(message), stream_format, 'response'
+                )
+
+            response = await conversation_service.agenerate_response(message)
+
+            return JsonResponse({'response': response})
+        except LLMError:
+            raise
+        except Exception as e:
+            return JsonResponse(
+                {"error": f"An error occurred: {str(e)}"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+
+class AsyncGroupTalkView(AsyncAPIView):
+    async def post(self, request):
+        serializer, error_response = self.validate(request, GroupTalkSerializer)
+        if error_response:
+            return error_response
+
+        characters, missing = await sync_to_async(load_group)(serializer.validated_data['character_ids'])
+        if missing:
+            return JsonResponse(
+                {"error": "Characters with the given IDs do not exist", "character_ids": missing},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+        message = serializer.validated_data['message']
+        group = GroupConversation(characters)
+
+        stream_format = get_stream_format(request)
+        if stream_format:
+            return event_stream_response(group.astream_events(message), stream_format)
+
+        return JsonResponse(await group.agenerate_responses(message))
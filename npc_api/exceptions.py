@@ -0,0 +1,38 @@
+import math
+
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.views import exception_handler as drf_exception_handler
+
+from .services.llm_backend import LLMError, LLMRateLimitError, LLMUnavailableError, NameCollisionError
+
+
+def llm_error_response(error):
+    """
+    Returns (payload, status code, headers) describing a failed model call.
+
+    Rate limits map to 429 and unavailability to 503, both with Retry-After;
+    names that stayed taken after all retries map to 409 and other model
+    errors to 502.
+    """
+    if isinstance(error, LLMRateLimitError):
+        status_code = status.HTTP_429_TOO_MANY_REQUESTS
+    elif isinstance(error, NameCollisionError):
+        status_code = status.HTTP_409_CONFLICT
+    elif isinstance(error, LLMUnavailableError):
+        status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    else:
+        status_code = status.HTTP_502_BAD_GATEWAY
+
+    headers = {}
+    if error.retry_after:
+        headers['Retry-After'] = str(math.ceil(error.retry_after))
+    return {"error": f"Model call failed: {str(error)}"}, status_code, headers
+
+
+def exception_handler(exc, context):
+    """DRF exception handler that also turns LLMError into 429/409/503/502 responses."""
+    if isinstance(exc, LLMError):
+        payload, status_code, headers = llm_error_response(exc)
+        return Response(payload, status=status_code, headers=headers)
+    return drf_exception_handler(exc, context)
@@ -0,0 +1,308 @@
+import json
+import math
+import os
+import re
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from npc_api import metrics
+from npc_api.models import Character, ConversationHistory, Story
+from npc_api.services.history_writer import conversation_rows
+from npc_api.services.llm_backend import FakeBackend, reset_registry
+
+SERVER_TIMING = re.compile(r'(\w+);dur=([\d.]+)(?:;desc="(\d+) \w+")?')
+
+
+def ask_question(client, data, index):
+    return client.post(
+        reverse('ask-question', args=[data['story'].id]),
+        {'question': f"Who rules the northern provinces? ({index})"},
+        content_type='application/json',
+        # Measure the model path, not the response cache
+        HTTP_X_NPC_CACHE='bypass',
+    )
+
+
+def generate_character(client, data, index):
+    return client.post(
+        reverse('generate-character', args=[data['story'].id]),
+        {'request': f"A wandering merchant with a secret ({index})"},
+        content_type='application/json',
+    )
+
+
+def talk(client, data, index):
+    character = data['characters'][index % len(data['characters'])]
+    return client.post(
+        reverse('character-talk', args=[character.id]),
+        {'message': f"Can you help me find the old road? ({index})"},
+        content_type='application/json',
+    )
+
+
+def history(client, data, index):
+    character = data['characters'][index % len(data['characters'])]
+    return client.get(reverse('conversationhistory-list'), {'character_id': character.id})
+
+
+def history_page(client, data, index):
+    character = data['characters'][index % len(data['characters'])]
+    return client.get(reverse('conversation-history-html', args=[character.id]))
+
+
+SCENARIOS = {
+    'ask-question': ask_question,
+    'generate-character': generate_character,
+    'talk': talk,
+    'history': history,
+    'history-page': history_page,
+}
+
+
+def percentile(sorted_values, share):
+    """Nearest-rank percentile of an ascending list."""
+    rank = max(1, math.ceil(share * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def parse_server_timing(header):
+    """Returns {'llm': ms, 'db': ms, 'db_count': queries, ...} from a Server-Timing header."""
+    result = {}
+    for name, duration, count in SERVER_TIMING.findall(header or ''):
+        result[name] = float(duration)
+        if count:
+            result[f'{name}_count'] = int(count)
+    return result
+
+
+def summarize(scenario, concurrency, samples, elapsed):
+    """Aggregates the (latency, status, server timing) samples of one run."""
+    latencies = sorted(latency for latency, _, _ in samples)
+    queries = [timing.get('db_count', 0) for _, _, timing in samples]
+    llm = [timing.get('llm', 0.0) for _, _, timing in samples]
+    return {
+        'scenario': scenario,
+        'concurrency': concurrency,
+        'requests': len(samples),
+        'errors': sum(1 for _, status, _ in samples if status >= 400),
+        'rps': round(len(samples) / elapsed, 2),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 1),
+        'queries_mean': round(statistics.fmean(queries), 1),
+        'queries_max': max(queries),
+        'llm_mean_ms': round(statistics.fmean(llm), 1),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns (rows, regressions) comparing results with a saved baseline.
+
+    A run regresses when its p95 latency grows, its throughput drops by more
+    than `tolerance` (a share), or it makes more queries per request.
+    """
+    previous = {(row['scenario'], row['concurrency']): row for row in baseline['results']}
+    rows, regressions = [], []
+    for row in results:
+        base = previous.get((row['scenario'], row['concurrency']))
+        if base is None:
+            continue
+        p95 = row['p95_ms'] / base['p95_ms'] - 1 if base['p95_ms'] else 0.0
+        rps = row['rps'] / base['rps'] - 1 if base['rps'] else 0.0
+        queries = row['queries_max'] - base['queries_max']
+        regressed = p95 > tolerance or rps < -tolerance or queries > 0
+        rows.append((row, p95, rps, queries, regressed))
+        if regressed:
+            regressions.append(row)
+    return rows, regressions
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-tests the LLM-bound and history endpoints in-process against a throwaway test "
+        "database and the offline model backend; reports latency percentiles, throughput and "
+        "queries per request, and saves or compares a JSON baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                            help=f"Comma-separated scenarios: {', '.join(SCENARIOS)}")
+        parser.add_argument('--concurrency', default='1,8,32', help="Comma-separated concurrency levels")
+        parser.add_argument('--requests', type=int, default=64, help="Requests per scenario and level")
+        parser.add_argument('--warmup', type=int, default=2, help="Unmeasured requests before each scenario")
+        parser.add_argument('--latency', type=float, default=0.2, help="Simulated model latency in seconds")
+        parser.add_argument('--jitter', type=float, default=0.05,
+                            help="Spread of the latency (see --distribution)")
+        parser.add_argument('--distribution', choices=FakeBackend.DISTRIBUTIONS, default='uniform',
+                            help="Latency distribution of the simulated model calls")
+        parser.add_argument('--error-rate', type=float, default=0.0,
+                            help="Share of model calls failing with a rate limit")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--characters', type=int, default=8, help="Characters created for talk and history")
+        parser.add_argument('--history-rows', type=int, default=200, help="History rows created per character")
+        parser.add_argument('--save', metavar='PATH', help="Write the results as a JSON baseline")
+        parser.add_argument('--compare', metavar='PATH', help="Compare the results with a JSON baseline")
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help="Allowed p95 and throughput change against the baseline (share)")
+        parser.add_argument('--fail-on-regression', action='store_true',
+                            help="Exit with an error when a run regressed against the baseline")
+
+    def handle(self, *args, **options):
+        scenarios = [name.strip() for name in options['scenarios'].split(',') if name.strip()]
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+        try:
+            levels = [int(level) for level in options['concurrency'].split(',')]
+        except ValueError:
+            raise CommandError("--concurrency takes comma-separated integers")
+        baseline = None
+        if options['compare']:
+            with open(options['compare'], encoding='utf-8') as file:
+                baseline = json.load(file)
+
+        backend_options = {
+            'latency': options['latency'],
+            'jitter': options['jitter'],
+            'distribution': options['distribution'],
+            'error_rate': options['error_rate'],
+            'seed': options['seed'],
+        }
+        overrides = override_settings(
+            LLM_BACKEND='fake',
+            LLM_BACKEND_OPTIONS=backend_options,
+            METRICS_ENABLED=True,
+            METRICS_TIMING_HEADER=True,
+            CONVERSATION_HISTORY_BUFFERED=False,
+        )
+
+        setup_test_environment()
+        old_name = self._create_database()
+        try:
+            with overrides:
+                reset_registry()
+                connection_created.connect(metrics.install_query_recorder)
+                data = self._create_data(options['characters'], options['history_rows'])
+                results = []
+                for scenario in scenarios:
+                    for level in levels:
+                        result = self._run(scenario, level, data, options['requests'], options['warmup'])
+                        results.append(result)
+                        self._print_result(result)
+        finally:
+            reset_registry()
+            self._destroy_database(old_name)
+            teardown_test_environment()
+
+        report = {
+            'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'database': settings.DATABASES['default']['ENGINE'],
+            'backend': backend_options,
+            'requests': options['requests'],
+            'results': results,
+        }
+        if options['save']:
+            with open(options['save'], 'w', encoding='utf-8') as file:
+                json.dump(report, file, indent=2)
+            self.stdout.write(f"Baseline saved to {options['save']}")
+        if baseline is not None:
+            self._compare(results, baseline, options['tolerance'], options['fail_on_regression'])
+
+    def _create_database(self):
+        """Creates the test database and returns the original name; SQLite uses a file so threads share it."""
+        old_name = connection.settings_dict['NAME']
+        if connection.vendor == 'sqlite':
+            handle, path = tempfile.mkstemp(prefix='npc_benchmark_', suffix='.sqlite3')
+            os.close(handle)
+            connection.settings_dict['TEST'] = {**connection.settings_dict.get('TEST', {}), 'NAME': path}
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        return old_name
+
+    def _destroy_database(self, old_name):
+        test_name = connection.settings_dict['NAME']
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        if connection.vendor == 'sqlite':
+            # Left behind by the WAL journal mode
+            for suffix in ('-wal', '-shm'):
+                if os.path.exists(test_name + suffix):
+                    os.remove(test_name + suffix)
+
+    def _create_data(self, characters, history_rows):
+        with open(settings.STORY_FILE_PATH, encoding='utf-8') as file:
+            story = Story.objects.create(title="Benchmark World", content=file.read())
+        created = [
+            Character(
+                story=story,
+                name=f"Benchmark Character {index}",
+                faction="Verdant Covenant",
+                profession="Herbalist",
+                personality_traits=["Kind", "Curious"],
+                background="Raised in the Deepwoods.",
+            )
+            for index in range(characters)
+        ]
+        for character in created:
+            character.update_alignment()
+        Character.objects.bulk_create(created)
+        rows = []
+        for character in created:
+            for index in range(history_rows // 2):
+                rows.extend(conversation_rows(character, f"Question {index}", f"Answer {index}"))
+        ConversationHistory.objects.bulk_create(rows, batch_size=500)
+        return {'story': story, 'characters': created}
+
+    def _run(self, scenario, concurrency, data, requests, warmup):
+        send = SCENARIOS[scenario]
+        warmup_client = Client()
+        for index in range(warmup):
+            send(warmup_client, data, -1 - index)
+
+        # One client per worker thread, like one connection per user
+        local = threading.local()
+
+        def measure(index):
+            client = getattr(local, 'client', None)
+            if client is None:
+                client = local.client = Client()
+            started = time.perf_counter()
+            response = send(client, data, index)
+            latency = time.perf_counter() - started
+            return latency, response.status_code, parse_server_timing(response.get('Server-Timing'))
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            samples = list(executor.map(measure, range(requests)))
+        return summarize(scenario, concurrency, samples, time.perf_counter() - started)
+
+    def _print_result(self, result):
+        self.stdout.write(
+            "{scenario:<20} c={concurrency:<4} n={requests:<5} err={errors:<4} {rps:>8.1f} req/s  "
+            "p50={p50_ms:>8.1f}ms  p95={p95_ms:>8.1f}ms  p99={p99_ms:>8.1f}ms  "
+            "queries={queries_mean:.1f} (max {queries_max})  llm={llm_mean_ms:.1f}ms".format(**result)
+        )
+
+    def _compare(self, results, baseline, tolerance, fail):
+        rows, regressions = compare(results, baseline, tolerance)
+        self.stdout.write(f"Compared with the baseline of {baseline.get('created_at', 'unknown date')}:")
+        if not rows:
+            self.stdout.write("No scenario and concurrency level in common with the baseline.")
+        for row, p95, rps, queries, regressed in rows:
+            line = (f"{row['scenario']:<20} c={row['concurrency']:<4} p95 {p95:+.0%}  req/s {rps:+.0%}  "
+                    f"queries {queries:+d}")
+            self.stdout.write(self.style.ERROR(line + "  REGRESSION") if regressed else line)
+        if regressions and fail:
+            raise CommandError(f"{len(regressions)} runs regressed against the baseline")
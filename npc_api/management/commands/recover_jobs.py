@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from npc_api.services.character_jobs import get_executor, recover_jobs
+
+
+class Command(BaseCommand):
+    help = (
+        "Requeues character generation jobs left RUNNING by a crashed process "
+        "(CHARACTER_JOB_STALE_AFTER) and runs every pending job in this process."
+    )
+
+    def handle(self, *args, **options):
+        job_ids = recover_jobs()
+        self.stdout.write(f"Running {len(job_ids)} pending jobs")
+        get_executor().shutdown(wait=True)
+        self.stdout.write(self.style.SUCCESS("Done"))
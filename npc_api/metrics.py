@@ -0,0 +1,240 @@
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+
+PREFIX = 'npc_'
+
+TOKEN_BUCKETS = (16, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+# Upper bounds of the histogram buckets, by metric name; the last bucket is +Inf
+BUCKETS = {
+    'prompt_tokens': TOKEN_BUCKETS,
+    'llm_prompt_tokens': TOKEN_BUCKETS,
+    'llm_response_tokens': TOKEN_BUCKETS,
+    'db_queries': (0, 1, 2, 5, 10, 20, 50, 100, 200),
+}
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+HELP = {
+    'prompt_tokens': "Estimated size in tokens of rendered prompt templates",
+    'http_request_seconds': "Time to the response (headers of streaming responses) per endpoint",
+    'http_errors_total': "Responses with a 4xx or 5xx status per endpoint",
+    'request_llm_seconds': "Time spent waiting for model calls per request",
+    'db_queries': "Database queries per request",
+    'db_seconds': "Time spent in database queries per request",
+    'llm_call_seconds': "Duration of model calls per task, including scheduling and retries",
+    'llm_prompt_tokens': "Estimated prompt size in tokens per task",
+    'llm_response_tokens': "Estimated response size in tokens per task",
+    'llm_errors_total': "Failed model calls per task and error type",
+    'llm_contexts_total': "Prompt contexts created, by whether the provider cached them",
+}
+
+# Values are kept per process; with several worker processes, every process
+# reports its own series at /metrics
+_lock = threading.Lock()
+_histograms = {}
+_counters = Counter()
+
+_current_request = contextvars.ContextVar('npc_request_timings', default=None)
+
+
+class Histogram:
+    """Cumulative-friendly histogram: per-bucket counts, total count and sum."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': dict(zip([*map(str, self.buckets), '+Inf'], self.counts)),
+        }
+
+
+def _labels_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def observe(name, value, **labels):
+    """Records `value` in the histogram `name` for the given labels."""
+    key = (name, _labels_key(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram(BUCKETS.get(name, DEFAULT_BUCKETS))
+        histogram.observe(value)
+
+
+def increment(name, amount=1, **labels):
+    """Adds `amount` to the counter `name` for the given labels."""
+    with _lock:
+        _counters[(name, _labels_key(labels))] += amount
+
+
+def snapshot():
+    """All histograms of this process: {name: [{'labels': {...}, 'count': ..., 'sum': ..., 'buckets': {...}}]}."""
+    with _lock:
+        result = {}
+        for (name, labels), histogram in sorted(_histograms.items()):
+            result.setdefault(name, []).append({'labels': dict(labels), **histogram.as_dict()})
+        return result
+
+
+def counters():
+    """All counters of this process: {name: [{'labels': {...}, 'value': ...}]}."""
+    with _lock:
+        result = {}
+        for (name, labels), value in sorted(_counters.items()):
+            result.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+        return result
+
+
+def reset():
+    """Drops all recorded values, e.g. between tests."""
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+class RequestTimings:
+    """
+    Model and database time accumulated by one request, across its threads and tasks.
+
+    Model time is wall-clock time with at least one call in flight, so concurrent
+    calls (e.g. of a batch) are not counted twice.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.llm_calls = 0
+        self.llm_seconds = 0.0
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self._llm_active = 0
+        self._llm_busy_since = None
+        self._lock = threading.Lock()
+
+    def llm_started(self):
+        with self._lock:
+            self.llm_calls += 1
+            if self._llm_active == 0:
+                self._llm_busy_since = time.perf_counter()
+            self._llm_active += 1
+
+    def llm_finished(self):
+        with self._lock:
+            self._llm_active -= 1
+            if self._llm_active == 0:
+                self.llm_seconds += time.perf_counter() - self._llm_busy_since
+
+    def add_db(self, seconds):
+        with self._lock:
+            self.db_queries += 1
+            self.db_seconds += seconds
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        """Value of the Server-Timing header: total, model, database and remaining (app) time in ms."""
+        total = self.elapsed
+        app = max(0.0, total - self.llm_seconds - self.db_seconds)
+        return ', '.join([
+            f'total;dur={total * 1000:.1f}',
+            f'llm;dur={self.llm_seconds * 1000:.1f};desc="{self.llm_calls} calls"',
+            f'db;dur={self.db_seconds * 1000:.1f};desc="{self.db_queries} queries"',
+            f'app;dur={app * 1000:.1f}',
+        ])
+
+
+def start_request():
+    """Starts collecting timings for the current request; returns (timings, token for end_request)."""
+    timings = RequestTimings()
+    return timings, _current_request.set(timings)
+
+
+def end_request(token):
+    _current_request.reset(token)
+
+
+def current_request():
+    """Timings of the request being handled, or None outside a request."""
+    return _current_request.get()
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper adding the query time to the current request."""
+    timings = _current_request.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.add_db(time.perf_counter() - started)
+
+
+def install_query_recorder(sender, connection, **kwargs):
+    """connection_created receiver installing record_query on every new database connection."""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, **extra):
+    items = [*labels, *extra.items()]
+    if not items:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in items) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_prometheus():
+    """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+    with _lock:
+        histograms = sorted((key, histogram.as_dict()) for key, histogram in _histograms.items())
+        counter_items = sorted(_counters.items())
+
+    lines = []
+    previous = None
+    for (name, labels), histogram in histograms:
+        metric = PREFIX + name
+        if name != previous:
+            lines.append(f"# HELP {metric} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {metric} histogram")
+            previous = name
+        cumulative = 0
+        for bound, count in histogram['buckets'].items():
+            cumulative += count
+            lines.append(f"{metric}_bucket{_format_labels(labels, le=bound)} {cumulative}")
+        lines.append(f"{metric}_sum{_format_labels(labels)} {_format_value(histogram['sum'])}")
+        lines.append(f"{metric}_count{_format_labels(labels)} {histogram['count']}")
+
+    previous = None
+    for (name, labels), value in counter_items:
+        metric = PREFIX + name
+        if name != previous:
+            lines.append(f"# HELP {metric} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {metric} counter")
+            previous = name
+        lines.append(f"{metric}{_format_labels(labels)} {_format_value(value)}")
+
+    return '\n'.join(lines) + '\n'
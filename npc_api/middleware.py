@@ -0,0 +1,50 @@
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.utils.decorators import sync_and_async_middleware
+
+from . import metrics
+
+
+def _finish(request, response, timings):
+    match = getattr(request, 'resolver_match', None)
+    endpoint = match.view_name if match else 'unmatched'
+    status = response.status_code
+
+    metrics.observe('http_request_seconds', timings.elapsed, endpoint=endpoint, method=request.method, status=status)
+    metrics.observe('request_llm_seconds', timings.llm_seconds, endpoint=endpoint)
+    metrics.observe('db_queries', timings.db_queries, endpoint=endpoint)
+    metrics.observe('db_seconds', timings.db_seconds, endpoint=endpoint)
+    if status >= 400:
+        metrics.increment('http_errors_total', endpoint=endpoint, status=status)
+
+    if settings.METRICS_TIMING_HEADER:
+        response['Server-Timing'] = timings.server_timing()
+    return response
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """
+    Records latency, model time, query count and query time of every request by endpoint.
+
+    With settings.METRICS_TIMING_HEADER on, the response carries a Server-Timing
+    header splitting the request time into model, database and remaining time.
+    Streaming responses are measured up to their headers.
+    """
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            timings, token = metrics.start_request()
+            try:
+                response = await get_response(request)
+            finally:
+                metrics.end_request(token)
+            return _finish(request, response, timings)
+    else:
+        def middleware(request):
+            timings, token = metrics.start_request()
+            try:
+                response = get_response(request)
+            finally:
+                metrics.end_request(token)
+            return _finish(request, response, timings)
+    return middleware
@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-18 11:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('npc_api', '0003_alter_conversationhistory_options_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='story',
+            name='summary',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='story',
+            name='summary_content_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
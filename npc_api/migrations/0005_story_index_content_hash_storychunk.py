@@ -0,0 +1,35 @@
+# Generated by Django 5.2 on 2026-10-18 11:47
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('npc_api', '0004_story_summary_story_summary_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='story',
+            name='index_content_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.CreateModel(
+            name='StoryChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('text', models.TextField()),
+                ('content_hash', models.CharField(max_length=64)),
+                ('term_frequencies', models.JSONField(default=dict)),
+                ('length', models.PositiveIntegerField(default=0)),
+                ('story', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='npc_api.story')),
+            ],
+            options={
+                'ordering': ['story', 'position'],
+                'indexes': [models.Index(fields=['story', 'position'], name='npc_api_sto_story_i_f6498a_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2 on 2026-10-18 11:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('npc_api', '0005_story_index_content_hash_storychunk'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='character',
+            index=models.Index(fields=['story', 'name'], name='npc_api_cha_story_i_c58c34_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2 on 2026-10-18 11:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('npc_api', '0007_conversationsummary'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='conversationhistory',
+            index=models.Index(fields=['character', 'timestamp'], name='npc_api_con_charact_779fd9_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversationhistory',
+            index=models.Index(fields=['character', 'sender_type', 'timestamp'], name='npc_api_con_charact_9d0b0e_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2 on 2026-10-18 11:56
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('npc_api', '0008_conversationhistory_npc_api_con_charact_779fd9_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CharacterGenerationJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('request', models.CharField(max_length=300)),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('RUNNING', 'Running'), ('SUCCEEDED', 'Succeeded'), ('FAILED', 'Failed')], default='PENDING', max_length=10)),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('character', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='npc_api.character')),
+                ('story', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='generation_jobs', to='npc_api.story')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'created_at'], name='npc_api_cha_status_b069f1_idx')],
+            },
+        ),
+    ]
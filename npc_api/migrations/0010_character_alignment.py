@@ -0,0 +1,61 @@
+# Generated by Django 5.2 on 2026-10-18 12:08
+
+import re
+
+from django.db import migrations, models
+
+# Frozen copy of npc_api.services.alignment with the default lexicon, so the
+# backfill does not change with the service or the settings
+
+GOOD_WORDS = frozenset([
+    'good', 'kind', 'helpful', 'honest', 'fair', 'noble', 'generous', 'compassionate', 'loyal', 'gentle',
+    'friendly', 'caring', 'benevolent', 'trustworthy', 'selfless', 'merciful', 'just',
+])
+EVIL_WORDS = frozenset([
+    'evil', 'bad', 'cruel', 'selfish', 'cunning', 'ruthless', 'malicious', 'greedy', 'treacherous', 'deceitful',
+    'vicious', 'sadistic', 'manipulative', 'unkind', 'dishonest', 'vengeful', 'callous', 'corrupt',
+])
+NEGATIONS = frozenset(['not', 'never', 'no'])
+WORD = re.compile(r"[a-z]+(?:['-][a-z]+)*")
+
+
+def classify_alignment(traits):
+    if isinstance(traits, str):
+        traits = [traits]
+    good = evil = 0
+    for trait in traits or []:
+        words = WORD.findall(str(trait).lower())
+        for index, word in enumerate(words):
+            if index and words[index - 1] in NEGATIONS:
+                continue
+            good += word in GOOD_WORDS
+            evil += word in EVIL_WORDS
+    if good > evil:
+        return 'good'
+    if evil > good:
+        return 'evil'
+    return 'neutral'
+
+
+def classify_characters(apps, schema_editor):
+    Character = apps.get_model('npc_api', 'Character')
+    characters = list(Character.objects.only('id', 'personality_traits'))
+    for character in characters:
+        character.alignment = classify_alignment(character.personality_traits)
+    Character.objects.bulk_update(characters, ['alignment'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('npc_api', '0009_charactergenerationjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='character',
+            name='alignment',
+            field=models.CharField(choices=[('good', 'Good'), ('evil', 'Evil'), ('neutral', 'Neutral')], db_index=True, default='neutral', editable=False, max_length=10),
+        ),
+        migrations.RunPython(classify_characters, migrations.RunPython.noop),
+    ]
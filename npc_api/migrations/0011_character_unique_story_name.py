@@ -0,0 +1,42 @@
+# Generated by Django 5.2 on 2026-10-18 12:23
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def rename_duplicates(apps, schema_editor):
+    """Numbers the repeated names of a story ("Aria", "Aria 2", ...) so the constraint can be added."""
+    Character = apps.get_model('npc_api', 'Character')
+    duplicates = list(
+        Character.objects.values('story_id', 'name').annotate(count=Count('id')).filter(count__gt=1)
+    )
+    for duplicate in duplicates:
+        characters = Character.objects.filter(
+            story_id=duplicate['story_id'], name=duplicate['name']
+        ).order_by('created_at', 'id')
+        number = 2
+        for character in characters[1:]:
+            while Character.objects.filter(story_id=duplicate['story_id'], name=f"{duplicate['name']} {number}").exists():
+                number += 1
+            character.name = f"{duplicate['name']} {number}"
+            character.save(update_fields=['name'])
+            number += 1
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('npc_api', '0010_character_alignment'),
+    ]
+
+    operations = [
+        migrations.RunPython(rename_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='character',
+            constraint=models.UniqueConstraint(fields=('story', 'name'), name='npc_api_character_unique_story_name'),
+        ),
+        migrations.RemoveIndex(
+            model_name='character',
+            name='npc_api_cha_story_i_c58c34_idx',
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2 on 2026-10-18 12:26
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def drop_duplicated_indexes(apps, schema_editor):
+    """Drops the chunks of stories indexed twice by concurrent rebuilds; they are rebuilt on the next question."""
+    Story = apps.get_model('npc_api', 'Story')
+    StoryChunk = apps.get_model('npc_api', 'StoryChunk')
+    story_ids = set(
+        StoryChunk.objects.values('story_id', 'position').annotate(count=Count('id')).filter(count__gt=1)
+        .values_list('story_id', flat=True)
+    )
+    if story_ids:
+        StoryChunk.objects.filter(story_id__in=story_ids).delete()
+        Story.objects.filter(pk__in=story_ids).update(index_content_hash='')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('npc_api', '0011_character_unique_story_name'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_duplicated_indexes, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='storychunk',
+            constraint=models.UniqueConstraint(fields=('story', 'position'), name='npc_api_storychunk_unique_story_position'),
+        ),
+        migrations.RemoveIndex(
+            model_name='storychunk',
+            name='npc_api_sto_story_i_f6498a_idx',
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2 on 2026-10-18 12:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('npc_api', '0012_storychunk_unique_story_position'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='conversationhistory',
+            index=models.Index(fields=['timestamp', 'id'], name='npc_api_con_timesta_db843e_idx'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2 on 2026-10-18 12:37
+
+import django.db.models.functions.text
+from django.db import migrations, models
+from django.db.models import Count
+from django.db.models.functions import Lower
+
+
+def rename_duplicates(apps, schema_editor):
+    """Numbers the names of a story repeated in another case ("Aria", "aria 2", ...) so the constraint can be added."""
+    Character = apps.get_model('npc_api', 'Character')
+    characters = Character.objects.annotate(lower_name=Lower('name'))
+    duplicates = list(
+        characters.values('story_id', 'lower_name').annotate(count=Count('id')).filter(count__gt=1)
+    )
+    for duplicate in duplicates:
+        story = characters.filter(story_id=duplicate['story_id'])
+        repeated = list(story.filter(lower_name=duplicate['lower_name']).order_by('created_at', 'id'))
+        number = 2
+        for character in repeated[1:]:
+            while story.filter(lower_name=Lower(models.Value(f"{character.name} {number}"))).exists():
+                number += 1
+            character.name = f"{character.name} {number}"
+            character.save(update_fields=['name'])
+            number += 1
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('npc_api', '0013_conversationhistory_npc_api_con_timesta_db843e_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(rename_duplicates, migrations.RunPython.noop),
+        migrations.RemoveConstraint(
+            model_name='character',
+            name='npc_api_character_unique_story_name',
+        ),
+        migrations.AddConstraint(
+            model_name='character',
+            constraint=models.UniqueConstraint(models.F('story'), django.db.models.functions.text.Lower('name'), name='npc_api_character_unique_story_lower_name'),
+        ),
+    ]
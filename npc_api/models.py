@@ -1,27 +1,110 @@
+import hashlib
+import uuid
+
 from django.db import models
+from django.db.models.functions import Lower
+
+from npc_api.services import alignment
 
 
 class Story(models.Model):
     title = models.CharField(max_length=255)
     content = models.TextField()
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    summary = models.TextField(blank=True, default='')
+    summary_content_hash = models.CharField(max_length=64, blank=True, default='')
+    index_content_hash = models.CharField(max_length=64, blank=True, default='')
 
     def __str__(self):
         return self.title
 
+    @staticmethod
+    def hash_content(content):
+        """Returns the SHA-256 hex digest used to key derived data to a content version."""
+        return hashlib.sha256((content or '').encode('utf-8')).hexdigest()
+
+    @property
+    def content_hash(self):
+        return self.hash_content(self.content)
+
+    @property
+    def has_current_summary(self):
+        """True if the stored summary was generated from the current content."""
+        return bool(self.summary) and self.summary_content_hash == self.content_hash
+
+    def save(self, *args, **kwargs):
+        # Drop a summary that belongs to a previous version of the content
+        if self.summary and self.summary_content_hash != self.content_hash:
+            self.summary = ''
+            self.summary_content_hash = ''
+        super().save(*args, **kwargs)
+
+
+class StoryChunk(models.Model):
+    """A passage of a story, indexed for retrieval when answering questions."""
+    story = models.ForeignKey(Story, on_delete=models.CASCADE, related_name='chunks')
+    position = models.PositiveIntegerField()
+    text = models.TextField()
+    content_hash = models.CharField(max_length=64)
+    term_frequencies = models.JSONField(default=dict)
+    length = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.story} #{self.position}"
+
+    class Meta:
+        ordering = ['story', 'position']
+        constraints = [
+            models.UniqueConstraint(fields=['story', 'position'], name='npc_api_storychunk_unique_story_position'),
+        ]
+
 
 class Character(models.Model):
+    GOOD = alignment.GOOD
+    EVIL = alignment.EVIL
+    NEUTRAL = alignment.NEUTRAL
+    ALIGNMENT_CHOICES = [
+        (GOOD, 'Good'),
+        (EVIL, 'Evil'),
+        (NEUTRAL, 'Neutral'),
+    ]
+
     story = models.ForeignKey(Story, on_delete=models.CASCADE, related_name='characters')
     name = models.CharField(max_length=255)
     faction = models.CharField(max_length=255)
     profession = models.CharField(max_length=255)
     personality_traits = models.JSONField()
     background = models.TextField()
+    # Derived from personality_traits on save, see update_alignment()
+    alignment = models.CharField(max_length=10, choices=ALIGNMENT_CHOICES, default=NEUTRAL,
+                                 editable=False, db_index=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
         return self.name
 
+    def update_alignment(self):
+        """
+        Classifies personality_traits into `alignment`.
+
+        Called by save(); bulk_create() skips save(), so callers creating
+        characters in bulk call it on every instance first.
+        """
+        self.alignment = alignment.classify_alignment(self.personality_traits)
+
+    def save(self, *args, **kwargs):
+        self.update_alignment()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'personality_traits' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'alignment'}
+        super().save(*args, **kwargs)
+
+    class Meta:
+        constraints = [
+            # Also the index of the name checks, see NameRegistry
+            models.UniqueConstraint('story', Lower('name'), name='npc_api_character_unique_story_lower_name'),
+        ]
+
 
 class ConversationHistory(models.Model):
     CHARACTER = "CHARACTER"
@@ -44,3 +127,57 @@ class ConversationHistory(models.Model):
         verbose_name = "Conversation message"
         verbose_name_plural = "Conversation history"
         ordering = ['timestamp']
+        indexes = [
+            models.Index(fields=['character', 'timestamp']),
+            models.Index(fields=['character', 'sender_type', 'timestamp']),
+            # The unfiltered history list (cursor pagination over timestamp, id)
+            models.Index(fields=['timestamp', 'id']),
+        ]
+
+
+class ConversationSummary(models.Model):
+    """Rolling summary of the conversation turns that fell out of a character's memory window."""
+    character = models.OneToOneField(Character, on_delete=models.CASCADE, related_name='conversation_summary')
+    summary = models.TextField(blank=True, default='')
+    # Id of the last ConversationHistory message folded into the summary
+    summarized_until = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Summary ({self.character.name})"
+
+
+class CharacterGenerationJob(models.Model):
+    """A character generation request queued for the background worker pool."""
+    PENDING = "PENDING"
+    RUNNING = "RUNNING"
+    SUCCEEDED = "SUCCEEDED"
+    FAILED = "FAILED"
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    ]
+    FINISHED = (SUCCEEDED, FAILED)
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    story = models.ForeignKey(Story, on_delete=models.CASCADE, related_name='generation_jobs')
+    request = models.CharField(max_length=300)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    character = models.ForeignKey(Character, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.id} ({self.status})"
+
+    @property
+    def is_finished(self):
+        return self.status in self.FINISHED
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+        ]
@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta, timezone
+
+from django.db.models import Q
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class DefaultPagination(PageNumberPagination):
+    """Project-wide list pagination; clients can ask for up to max_page_size rows with ?page_size=."""
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class ConversationHistoryCursorPagination(CursorPagination):
+    """
+    Keyset pagination over (timestamp, id).
+
+    Served by the (character, timestamp) index when filtered by character and
+    by the (timestamp, id) index otherwise.
+    """
+    ordering = ('-timestamp', '-id')
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+def encode_cursor(message):
+    """Encodes the (timestamp, id) position of a message as an opaque URL-safe string."""
+    microseconds = (message.timestamp - EPOCH) // timedelta(microseconds=1)
+    return f"{microseconds}-{message.pk}"
+
+
+def decode_cursor(cursor):
+    """Returns (timestamp, id) for a cursor, or None if it is malformed."""
+    try:
+        microseconds, pk = cursor.split('-')
+        return EPOCH + timedelta(microseconds=int(microseconds)), int(pk)
+    except (AttributeError, ValueError, OverflowError):
+        return None
+
+
+class KeysetPage:
+    """
+    One page of messages in ascending (timestamp, id) order.
+
+    Pages are addressed by the position of a neighbouring message (`after` or
+    `before` cursor) instead of an offset, so every page costs the same query.
+    """
+
+    def __init__(self, queryset, after=None, before=None, page_size=20):
+        after_position = decode_cursor(after) if after else None
+        before_position = decode_cursor(before) if before else None
+
+        if before_position:
+            timestamp, pk = before_position
+            rows = list(queryset.filter(
+                Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, pk__lt=pk)
+            ).order_by('-timestamp', '-id')[:page_size + 1])
+            self.has_previous = len(rows) > page_size
+            self.has_next = True
+            self.object_list = list(reversed(rows[:page_size]))
+        else:
+            if after_position:
+                timestamp, pk = after_position
+                queryset = queryset.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, pk__gt=pk))
+            rows = list(queryset.order_by('timestamp', 'id')[:page_size + 1])
+            self.has_previous = after_position is not None
+            self.has_next = len(rows) > page_size
+            self.object_list = rows[:page_size]
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def has_other_pages(self):
+        return self.has_previous or self.has_next
+
+    @property
+    def next_cursor(self):
+        return encode_cursor(self.object_list[-1]) if self.has_next and self.object_list else None
+
+    @property
+    def previous_cursor(self):
+        return encode_cursor(self.object_list[0]) if self.has_previous and self.object_list else None
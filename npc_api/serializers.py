@@ -1,18 +1,52 @@
+from django.conf import settings
 from rest_framework import serializers
-from .models import Story, Character, ConversationHistory
+from .models import Story, Character, ConversationHistory, CharacterGenerationJob
 
 
-class StorySerializer(serializers.ModelSerializer):
+class SparseFieldsetMixin:
+    """
+    Limits the serialized fields to those listed in the `?fields=` query parameter.
+
+    Unknown names are ignored; without the parameter all fields are returned.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        request = self.context.get('request')
+        requested = request.query_params.get('fields') if request is not None else None
+        if requested:
+            allowed = {name.strip() for name in requested.split(',')}
+            for name in set(self.fields) - allowed:
+                self.fields.pop(name)
+
+
+class StorySerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Story
         fields = ['id', 'title', 'content', 'uploaded_at']
 
 
-class CharacterSerializer(serializers.ModelSerializer):
+class StoryListSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    """Story without its content, for list responses; the content is served on detail."""
+    class Meta:
+        model = Story
+        fields = ['id', 'title', 'uploaded_at']
+
+
+class CharacterSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = Character
         fields = ['id', 'story', 'name', 'faction', 'profession',
-                  'personality_traits', 'background', 'created_at']
+                  'personality_traits', 'alignment', 'background', 'created_at']
+
+
+class GeneratedCharacterSerializer(serializers.ModelSerializer):
+    """Validates character attributes returned by the model against the Character fields."""
+    personality_traits = serializers.ListField(child=serializers.CharField(max_length=100), min_length=1)
+
+    class Meta:
+        model = Character
+        fields = ['name', 'faction', 'profession', 'personality_traits', 'background']
 
 
 class StoryQuestionSerializer(serializers.Serializer):
@@ -23,6 +57,24 @@ class CharacterRequestSerializer(serializers.Serializer):
     request = serializers.CharField(max_length=300)
 
 
+class CharacterBatchRequestSerializer(serializers.Serializer):
+    requests = serializers.ListField(
+        child=serializers.CharField(max_length=300),
+        min_length=1,
+        max_length=settings.CHARACTER_BATCH_MAX_SIZE,
+        help_text="One request per character to generate"
+    )
+
+
+class CharacterGenerationJobSerializer(serializers.ModelSerializer):
+    character = CharacterSerializer(read_only=True)
+
+    class Meta:
+        model = CharacterGenerationJob
+        fields = ['id', 'story', 'request', 'status', 'character', 'error', 'created_at', 'updated_at']
+        read_only_fields = fields
+
+
 class CharacterTalkSerializer(serializers.Serializer):
     message = serializers.CharField(
         required=True,
@@ -30,6 +82,23 @@ class CharacterTalkSerializer(serializers.Serializer):
     )
 
 
+class GroupTalkSerializer(serializers.Serializer):
+    character_ids = serializers.ListField(
+        child=serializers.IntegerField(),
+        min_length=1,
+        max_length=settings.GROUP_TALK_MAX_CHARACTERS,
+        help_text="Characters the message is addressed to, in the order of the replies"
+    )
+    message = serializers.CharField(
+        required=True,
+        help_text="Message to the characters"
+    )
+
+    def validate_character_ids(self, value):
+        # Each character answers once
+        return list(dict.fromkeys(value))
+
+
 class ConversationHistorySerializer(serializers.ModelSerializer):
     character_name = serializers.SerializerMethodField()
     sender = serializers.SerializerMethodField()
@@ -0,0 +1,46 @@
+import re
+
+from django.conf import settings
+
+GOOD = 'good'
+EVIL = 'evil'
+NEUTRAL = 'neutral'
+
+NEGATIONS = frozenset(['not', 'never', 'no'])
+
+WORD = re.compile(r"[a-z]+(?:['-][a-z]+)*")
+
+
+def tokenize_traits(traits):
+    """Lowercase words of the personality traits (a list of strings or one string)."""
+    if isinstance(traits, str):
+        traits = [traits]
+    return [WORD.findall(str(trait).lower()) for trait in traits or []]
+
+
+def classify_alignment(traits, lexicon=None):
+    """
+    Classifies personality traits as GOOD, EVIL or NEUTRAL.
+
+    Every word found in the good or evil part of the lexicon (by default
+    settings.PERSONALITY_TRAIT_LEXICON) counts for its side, unless a negation
+    precedes it within the same trait. The side with more words wins; a tie,
+    including no matches at all, is NEUTRAL.
+    """
+    lexicon = lexicon or settings.PERSONALITY_TRAIT_LEXICON
+    good_words = {word.strip().lower() for word in lexicon.get(GOOD, ())}
+    evil_words = {word.strip().lower() for word in lexicon.get(EVIL, ())}
+
+    good = evil = 0
+    for words in tokenize_traits(traits):
+        for index, word in enumerate(words):
+            if index and words[index - 1] in NEGATIONS:
+                continue
+            good += word in good_words
+            evil += word in evil_words
+
+    if good > evil:
+        return GOOD
+    if evil > good:
+        return EVIL
+    return NEUTRAL
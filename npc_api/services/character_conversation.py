@@ -1,66 +1,47 @@
-import os
-import google.generativeai as genai
-from npc_api.models import ConversationHistory  # dodajemy import modelu
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from npc_api.services import persona, prompts
+from npc_api.services.conversation_memory import ConversationMemory, schedule_update
+from npc_api.services.history_writer import conversation_rows, save_rows
+from npc_api.services.llm_backend import get_backend
+
+logger = logging.getLogger(__name__)
 
 
 class CharacterConversation:
-    def __init__(self, character=None, api_key=None):
+    def __init__(self, character=None, api_key=None, backend=None):
         """
         Initialization of the character conversation service.
 
         Args:
             character: Character object from the Character model
             api_key: Optional Gemini API key
+            backend: Optional LLMBackend, defaults to the one configured in settings
         """
-        self.api_key = api_key or os.environ.get("GEMINI_API_KEY")
-        genai.configure(api_key=self.api_key)
+        self.backend = backend or get_backend(api_key=api_key)
 
         self.character = character
-        self.model = "gemini-2.0-flash-lite"
+        self.model = settings.LLM_MODEL
 
-        # Prepare character description
         if character:
-            self.character_description = self._prepare_character_description()
-
-    def _prepare_character_description(self):
-        """
-        Prepares a character description based on its attributes.
-        """
-        personality = (
-            self.character.personality_traits
-            if isinstance(self.character.personality_traits, str)
-            else str(self.character.personality_traits)
-        )
-
-        return {
-            "name": self.character.name,
-            "faction": self.character.faction,
-            "profession": self.character.profession,
-            "personality": personality,
-            "background": self.character.background
-        }
-
-    def _is_good_personality(self):
-        """
-        Checks if the character has a good personality.
+            self.memory = ConversationMemory(character, self.backend, self.model)
 
-        Returns:
-        bool: True if the character has a good personality, False otherwise
-        """
-        good_traits = ['good', 'kind', 'helpful', 'honest', 'fair', 'noble']
-        bad_traits = ['evil', 'bad', 'cruel', 'selfish', 'cunning', 'ruthless']
-
-        personality = str(self.character.personality_traits).lower()
+    def _persona(self):
+        """The character's persona, the static prompt prefix cached per character version."""
+        return persona.get_persona(self.character, self.backend, self.model)
 
-        good_count = sum(1 for trait in good_traits if trait in personality)
-        bad_count = sum(1 for trait in bad_traits if trait in personality)
-
-        return good_count >= bad_count
+    async def _apersona(self):
+        return await persona.aget_persona(self.character, self.backend, self.model)
 
     def save_conversation(self, user_message, character_response):
         """
         Zapisuje wymianę wiadomości do bazy danych.
 
+        Both messages are written atomically with one bulk insert, or queued for
+        the buffered writer when settings.CONVERSATION_HISTORY_BUFFERED is on.
+
         Args:
             user_message: Wiadomość od użytkownika
             character_response: Odpowiedź postaci
@@ -68,19 +49,55 @@ class CharacterConversation:
         if not self.character:
             return
 
-        # Zapisz wiadomość użytkownika
-        ConversationHistory.objects.create(
-            character=self.character,
-            message=user_message,
-            sender_type=ConversationHistory.USER
-        )
+        save_rows(conversation_rows(self.character, user_message, character_response))
+
+    async def asave_conversation(self, user_message, character_response):
+        """Async version of save_conversation()."""
+        await sync_to_async(self.save_conversation)(user_message, character_response)
 
-        # Zapisz odpowiedź postaci
-        ConversationHistory.objects.create(
-            character=self.character,
-            message=character_response,
-            sender_type=ConversationHistory.CHARACTER
-        )
+    def _remember(self, user_message, character_response):
+        """Saves the exchange; old turns are folded into the rolling summary in the background."""
+        self.save_conversation(user_message, character_response)
+        schedule_update(self.character.pk, self.update_memory)
+
+    def update_memory(self):
+        """Folds old turns into the rolling summary when due; failures are only logged."""
+        try:
+            self.memory.update()
+        except Exception:
+            # The reply is already saved; the summary catches up on a later turn
+            logger.exception("Conversation summary update failed for character %s", self.character.pk)
+
+    async def _aremember(self, user_message, character_response):
+        await sync_to_async(self._remember)(user_message, character_response)
+
+    def _load_memory(self):
+        return self.memory.load() if self.character else ('', [])
+
+    async def _aload_memory(self):
+        return await sync_to_async(self._load_memory)()
+
+    def _memory_block(self, memory):
+        summary, recent = memory
+        parts = []
+        if summary:
+            parts.append(f"Summary of your earlier conversation with the user:\n{summary}")
+        if recent:
+            transcript = "\n".join(self.memory.format_message(message) for message in recent)
+            parts.append(f"Most recent messages of your conversation:\n{transcript}")
+        return "\n\n".join(parts)
+
+    def _build_prompt(self, message, memory=('', [])):
+        """The part of the talk prompt following the persona: memory and the new message."""
+        return prompts.TALK.render(memory=self._memory_block(memory), message=message)
+
+    def prepare(self, message):
+        """Returns (prompt, persona context) of a talk call, loading the memory from the database."""
+        return self._build_prompt(message, self._load_memory()), self._persona()
+
+    async def aprepare(self, message):
+        """Async version of prepare()."""
+        return self._build_prompt(message, await self._aload_memory()), await self._apersona()
 
     def generate_response(self, message, save_history=True):
         """
@@ -92,35 +109,59 @@ class CharacterConversation:
 
         Returns:
             str: Generated character response
+
+        Raises:
+            LLMError: If the model call fails (after the scheduler's retries)
         """
-        try:
-            is_good = self._is_good_personality()
-            personality_type = "good, helpful, and friendly" if is_good else "malicious, selfish, and suspicious"
+        prompt, context = self.prepare(message)
+        response_text = self.backend.generate(prompt, task="talk", model=self.model, context=context)
+
+        # Zapisz konwersację do bazy danych
+        if save_history and self.character:
+            self._remember(message, response_text)
 
-            prompt = f"""
-            Assume the role of a character with the following traits:
-            - Name: {self.character.name}
-            - Faction: {self.character.faction}
-            - Profession: {self.character.profession}
-            - Personality: {self.character.personality_traits}
-            - Background: {self.character.background}
+        return response_text
 
-            Your character has a {personality_type} personality.
+    async def agenerate_response(self, message, save_history=True):
+        """Async version of generate_response()."""
+        prompt, context = await self.aprepare(message)
+        response_text = await self.backend.agenerate(prompt, task="talk", model=self.model, context=context)
 
-            The user wrote to you: "{message}"
+        if save_history and self.character:
+            await self._aremember(message, response_text)
 
-            Respond as this character, maintaining their unique character and manner of speaking.
-            The response should be short (2-3 sentences) and fully reflect the character's personality.
-            """
+        return response_text
 
-            model = genai.GenerativeModel(self.model)
-            response = model.generate_content(prompt)
-            response_text = response.text
+    def stream_response(self, message, save_history=True):
+        """
+        Streams a character's response to the user's message chunk by chunk.
 
-            # Zapisz konwersację do bazy danych
-            if save_history and self.character:
-                self.save_conversation(message, response_text)
+        The full response is saved to the conversation history once the stream
+        completes; an interrupted stream is not saved.
 
-            return response_text
-        except Exception as e:
-            return f"Error while generating response: {str(e)}"
+        Args:
+            message: Message from the user
+            save_history: Whether to save conversation to database
+
+        Yields:
+            str: Chunks of the generated character response
+        """
+        prompt, context = self.prepare(message)
+        chunks = []
+        for chunk in self.backend.stream(prompt, task="talk", model=self.model, context=context):
+            chunks.append(chunk)
+            yield chunk
+
+        if save_history and self.character:
+            self._remember(message, ''.join(chunks))
+
+    async def astream_response(self, message, save_history=True):
+        """Async version of stream_response()."""
+        prompt, context = await self.aprepare(message)
+        chunks = []
+        async for chunk in self.backend.astream(prompt, task="talk", model=self.model, context=context):
+            chunks.append(chunk)
+            yield chunk
+
+        if save_history and self.character:
+            await self._aremember(message, ''.join(chunks))
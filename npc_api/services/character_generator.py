@@ -1,95 +1,329 @@
-import os
+import asyncio
+import contextvars
 import json
-from google import genai
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connection
+from npc_api.models import Story
+from npc_api.serializers import GeneratedCharacterSerializer
+from npc_api.services import prompts
+from npc_api.services.llm_backend import LLMInvalidOutputError, NameCollisionError
+from npc_api.services.name_registry import NameRegistry
+
+# Structured output schema for single-call character generation
+CHARACTER_SCHEMA = {
+    'type': 'OBJECT',
+    'properties': {
+        'name': {'type': 'STRING', 'description': "Character's name"},
+        'faction': {'type': 'STRING', 'description': 'Which faction of the world they belong to'},
+        'profession': {'type': 'STRING', 'description': 'Their occupation or role'},
+        'personality_traits': {
+            'type': 'ARRAY',
+            'items': {'type': 'STRING'},
+            'description': '2-4 personality traits',
+        },
+        'background': {'type': 'STRING', 'description': 'Brief history (1-2 sentences)'},
+    },
+    'required': ['name', 'faction', 'profession', 'personality_traits', 'background'],
+    'property_ordering': ['name', 'faction', 'profession', 'personality_traits', 'background'],
+}
+
+
+@contextmanager
+def last_attempt():
+    """Turns invalid model output on the last attempt into an LLMInvalidOutputError (a 502)."""
+    try:
+        yield
+    except ValueError as e:
+        raise LLMInvalidOutputError(f"Invalid model output: {e}") from e
 
 
 class CharacterGenerator:
-    def __init__(self, story_understanding, api_key=None):
-        """Initialization with StoryUnderstanding object."""
+    def __init__(self, story_understanding, api_key=None, backend=None, response_cache=None, name_registry=None):
+        """
+        Initialization with StoryUnderstanding object.
 
-        self.api_key = api_key or os.environ.get("GEMINI_API_KEY")
-        self.client = genai.Client(api_key=self.api_key)
+        Names generated for a request are cached in `response_cache` (a ResponseCache)
+        when one is given. Name uniqueness is checked against `name_registry`, which
+        defaults to the names of the story's characters.
+        """
+
+        self.backend = backend or story_understanding.backend
         self.story_understanding = story_understanding
-        self.model = "gemini-2.0-flash-lite"
-        self.generated_names = set()
+        self.response_cache = response_cache
+        self.model = settings.LLM_MODEL
+        self.name_registry = name_registry
 
-    def generate_character_name(self, request):
-        """Generate a character name based on the user's request."""
+    def _get_name_registry(self):
+        if self.name_registry is None:
+            story = self.story_understanding.story
+            self.name_registry = NameRegistry.for_story(story) if story is not None else NameRegistry()
+        return self.name_registry
+
+    async def _aget_name_registry(self):
+        if self.name_registry is None:
+            story = self.story_understanding.story
+            self.name_registry = await NameRegistry.afor_story(story) if story is not None else NameRegistry()
+        return self.name_registry
+
+    def _avoid_names(self, collisions):
+        """A bounded list of taken names for the prompt: recent ones plus those just rejected."""
+        return ', '.join(collisions + self.name_registry.sample())
 
-        prompt = f"""
-        Based on the story world below and the user's request, generate a unique name that fits the world for a character.
+    def _claim_or_collide(self, name, collisions):
+        if self.name_registry.claim(name):
+            return True
+        collisions.append(name)
+        return False
 
-        World summary:
-        {self.story_understanding.story_summary}
+    async def _aclaim_or_collide(self, name, collisions):
+        if await self.name_registry.aclaim(name):
+            return True
+        collisions.append(name)
+        return False
 
-        User request: {request}
+    def _name_prompt(self, story_summary, request, avoid_names):
+        return prompts.NAME.render(story_summary=story_summary, request=request, avoid_names=avoid_names)
 
-        Previously generated names (avoid them): {', '.join(self.generated_names)}
+    def _details_prompt(self, story_summary, name, request):
+        return prompts.DETAILS.render(
+            story_summary=story_summary, name=name, request=request or "No specific request"
+        )
 
-        Return only the character name, nothing else.
+    def _character_prompt(self, story_summary, request, avoid_names):
+        return prompts.CHARACTER.render(
+            story_summary=story_summary, request=request or "No specific request", avoid_names=avoid_names
+        )
+
+    def _retry_prompt(self, name):
+        return prompts.CHARACTER_RETRY.render(name=name)
+
+    def _parse_character_json(self, character_json):
+        """Parses the model output, stripping Markdown code fences. Raises json.JSONDecodeError."""
+
+        # Cleaning the response to ensure a valid JSON format
+        character_json = character_json.strip()
+        if character_json.startswith("```json"):
+            character_json = character_json[7:]
+        if character_json.endswith("```"):
+            character_json = character_json[:-3]
+
+        return json.loads(character_json.strip())
+
+    def _validate_character(self, character_json, name=None):
+        """
+        Parses and validates model output against the Character fields.
+
+        A given `name` (the one claimed in the registry) replaces the name the model wrote.
+
+        Raises:
+            ValueError: If the output is not valid JSON or misses/violates a field
         """
+        character_data = self._parse_character_json(character_json)
+        if name is not None and isinstance(character_data, dict):
+            character_data['name'] = name
+        serializer = GeneratedCharacterSerializer(data=character_data)
+        if not serializer.is_valid():
+            raise ValueError(f"Invalid character data: {serializer.errors}")
+
+        return dict(serializer.validated_data)
+
+    def _request_structured(self, prompt):
+        """One structured-output call, retried once on invalid output."""
+
+        try:
+            return self._validate_character(
+                self.backend.generate(prompt, task="character", model=self.model, response_schema=CHARACTER_SCHEMA)
+            )
+        except ValueError:
+            with last_attempt():
+                return self._validate_character(
+                    self.backend.generate(prompt, task="character", model=self.model, response_schema=CHARACTER_SCHEMA)
+                )
+
+    async def _arequest_structured(self, prompt):
+        try:
+            return self._validate_character(
+                await self.backend.agenerate(prompt, task="character", model=self.model,
+                                             response_schema=CHARACTER_SCHEMA)
+            )
+        except ValueError:
+            with last_attempt():
+                return self._validate_character(
+                    await self.backend.agenerate(prompt, task="character", model=self.model,
+                                                 response_schema=CHARACTER_SCHEMA)
+                )
+
+    def _generate_structured(self, request, story_summary):
+        """Generate name and details in one structured-output call, regenerating only on a name collision."""
+
+        self._get_name_registry()
+        collisions = []
+        for _ in range(settings.CHARACTER_NAME_RETRIES + 1):
+            prompt = self._character_prompt(story_summary, request, self._avoid_names(collisions))
+            character_data = self._request_structured(prompt)
+            if self._claim_or_collide(character_data['name'], collisions):
+                return character_data
+        raise NameCollisionError(f"Could not generate a unique name, taken: {', '.join(collisions)}")
+
+    async def _agenerate_structured(self, request, story_summary):
+        await self._aget_name_registry()
+        collisions = []
+        for _ in range(settings.CHARACTER_NAME_RETRIES + 1):
+            prompt = self._character_prompt(story_summary, request, self._avoid_names(collisions))
+            character_data = await self._arequest_structured(prompt)
+            if await self._aclaim_or_collide(character_data['name'], collisions):
+                return character_data
+        raise NameCollisionError(f"Could not generate a unique name, taken: {', '.join(collisions)}")
+
+    def _name_cache_key(self, request):
+        content_hash = Story.hash_content(self.story_understanding.story_content)
+        return self.response_cache.make_key(content_hash, request, self.model)
 
-        chat = self.client.chats.create(model=self.model)
-        response = chat.send_message(prompt)
+    def _generate_name(self, request):
+        """Generate a name that is not taken yet, regenerating only on a collision."""
 
-        name = response.text.strip()
-        self.generated_names.add(name)
-        return name
+        story_summary = self.story_understanding.story_summary
+        self._get_name_registry()
+        collisions = []
+        for _ in range(settings.CHARACTER_NAME_RETRIES + 1):
+            prompt = self._name_prompt(story_summary, request, self._avoid_names(collisions))
+            name = self.backend.generate(prompt, task="name", model=self.model).strip()
+            if self._claim_or_collide(name, collisions):
+                return name
+        raise NameCollisionError(f"Could not generate a unique name, taken: {', '.join(collisions)}")
+
+    async def _agenerate_name(self, request):
+        story_summary = await self.story_understanding.aget_story_summary()
+        await self._aget_name_registry()
+        collisions = []
+        for _ in range(settings.CHARACTER_NAME_RETRIES + 1):
+            prompt = self._name_prompt(story_summary, request, self._avoid_names(collisions))
+            name = (await self.backend.agenerate(prompt, task="name", model=self.model)).strip()
+            if await self._aclaim_or_collide(name, collisions):
+                return name
+        raise NameCollisionError(f"Could not generate a unique name, taken: {', '.join(collisions)}")
+
+    def generate_character_name(self, request):
+        """
+        Generate a character name based on the user's request.
+
+        A cached name is only reused while it is still free in the story; once a
+        character took it, a new name is generated and replaces the cache entry.
+        """
+
+        if self.response_cache is None:
+            return self._generate_name(request)
+        return self.response_cache.get_or_set(
+            self._name_cache_key(request),
+            lambda: self._generate_name(request),
+            accept=lambda name: self._get_name_registry().claim(name),
+        )
+
+    async def agenerate_character_name(self, request):
+        """Async version of generate_character_name()."""
+
+        async def accept(name):
+            return await (await self._aget_name_registry()).aclaim(name)
+
+        if self.response_cache is None:
+            return await self._agenerate_name(request)
+        return await self.response_cache.aget_or_set(
+            self._name_cache_key(request),
+            lambda: self._agenerate_name(request),
+            accept=accept,
+        )
 
     def generate_character_details(self, name=None, request=None):
-        """Generate complete character details in JSON format."""
+        """
+        Generate complete character details in JSON format.
+
+        Without a given name and with settings.CHARACTER_SINGLE_CALL enabled, the name
+        and details come from a single structured-output call; otherwise the name is
+        generated first and the details in a second call.
+        """
+
+        if name is None and settings.CHARACTER_SINGLE_CALL:
+            return self._generate_structured(request, self.story_understanding.story_summary)
 
         if name is None and request is not None:
             name = self.generate_character_name(request)
 
-        prompt = f"""
-        Create detailed attributes for the character "{name}" that are consistent with the story world.
+        prompt = self._details_prompt(self.story_understanding.story_summary, name, request)
+        character_json = self.backend.generate(prompt, task="character", model=self.model)
+
+        try:
+            return self._validate_character(character_json, name)
+        except ValueError:
+            # If the output is invalid, try again
+            character_json = self.backend.generate(self._retry_prompt(name), task="character", model=self.model)
+            with last_attempt():
+                return self._validate_character(character_json, name)
+
+    async def agenerate_character_details(self, name=None, request=None):
+        """Async version of generate_character_details()."""
 
-        World summary:
-        {self.story_understanding.story_summary}
+        if name is None and settings.CHARACTER_SINGLE_CALL:
+            return await self._agenerate_structured(request, await self.story_understanding.aget_story_summary())
 
-        User request (if any): {request or "No specific request"}
+        if name is None and request is not None:
+            name = await self.agenerate_character_name(request)
+
+        story_summary = await self.story_understanding.aget_story_summary()
+        prompt = self._details_prompt(story_summary, name, request)
+        character_json = await self.backend.agenerate(prompt, task="character", model=self.model)
 
-        Generate a JSON object with the following fields:
-        - name: Character's name
-        - faction: Which faction of the world they belong to
-        - profession: Their occupation or role
-        - personality_traits: Array of 2-4 personality traits
-        - background: Brief history (1-2 sentences)
+        try:
+            return self._validate_character(character_json, name)
+        except ValueError:
+            character_json = await self.backend.agenerate(self._retry_prompt(name), task="character", model=self.model)
+            with last_attempt():
+                return self._validate_character(character_json, name)
 
-        Return only valid JSON, nothing else.
+    def generate_characters(self, requests):
         """
+        Generate characters for a batch of requests with concurrent model calls.
 
-        chat = self.client.chats.create(model=self.model)
-        response = chat.send_message(prompt)
+        All calls share one name registry, so names are unique across the batch
+        and the story.
 
-        character_json = response.text
+        Args:
+            requests: List of user requests, one per character
 
-        # Cleaning the response to ensure a valid JSON format
-        character_json = character_json.strip()
-        if character_json.startswith("```json"):
-            character_json = character_json[7:]
-        if character_json.endswith("```"):
-            character_json = character_json[:-3]
+        Returns:
+            list: (character_data, exception) pairs in request order; one of them is None
+        """
+        # Summarize and load the recent names once, before the workers start
+        self.story_understanding.story_summary
+        self._get_name_registry()
 
-        try:
-            character_data = json.loads(character_json.strip())
-            return character_data
-        except json.JSONDecodeError:
-            # If the JSON format is invalid, try again
-            retry_prompt = f"""
-                Create a valid JSON object for the character "{name}". Return only clean JSON:
-                {{
-                  "name": "character name",
-                  "faction": "faction",
-                  "profession": "occupation",
-                  "personality_traits": ["trait1", "trait2"],
-                  "background": "background story"
-                }}
-                """
-            retry_response = self.client.generate_content(
-                model=self.model,
-                contents=retry_prompt
-            )
-            character_json = retry_response.text.strip()
-            return json.loads(character_json)
+        def generate(request):
+            try:
+                return self.generate_character_details(request=request), None
+            except Exception as e:
+                return None, e
+            finally:
+                # Name checks query the database from this worker thread
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=settings.CHARACTER_BATCH_CONCURRENCY) as executor:
+            # Each worker runs in a copy of the caller's context, so calls count towards its request metrics
+            futures = [executor.submit(contextvars.copy_context().run, generate, request) for request in requests]
+            return [future.result() for future in futures]
+
+    async def agenerate_characters(self, requests):
+        """Async version of generate_characters()."""
+
+        await self.story_understanding.aget_story_summary()
+        await self._aget_name_registry()
+        semaphore = asyncio.Semaphore(settings.CHARACTER_BATCH_CONCURRENCY)
+
+        async def generate(request):
+            async with semaphore:
+                try:
+                    return await self.agenerate_character_details(request=request), None
+                except Exception as e:
+                    return None, e
+
+        return list(await asyncio.gather(*(generate(request) for request in requests)))
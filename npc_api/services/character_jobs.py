@@ -0,0 +1,169 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+
+from npc_api.models import Character, CharacterGenerationJob
+from npc_api.services.character_generator import CharacterGenerator
+from npc_api.services.name_registry import unique_names
+from npc_api.services.story_understanding import StoryUnderstanding
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Returns the process-wide worker pool (settings.CHARACTER_JOB_WORKERS threads)."""
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.CHARACTER_JOB_WORKERS, thread_name_prefix='character-job'
+            )
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def requeue_stale_jobs(stale_after=None):
+    """
+    Puts RUNNING jobs not updated for `stale_after` seconds (settings.CHARACTER_JOB_STALE_AFTER)
+    back to PENDING; their worker died with its process.
+
+    Returns:
+        int: Number of requeued jobs
+    """
+    stale_after = settings.CHARACTER_JOB_STALE_AFTER if stale_after is None else stale_after
+    cutoff = timezone.now() - timedelta(seconds=stale_after)
+    return CharacterGenerationJob.objects.filter(
+        status=CharacterGenerationJob.RUNNING, updated_at__lt=cutoff
+    ).update(status=CharacterGenerationJob.PENDING, updated_at=timezone.now())
+
+
+def recover_jobs():
+    """
+    Requeues stale jobs and submits every pending job to the worker pool, oldest first.
+
+    Run when a process starts serving (see start_recovery()) and by the
+    `recover_jobs` management command.
+
+    Returns:
+        list: Ids of the submitted jobs
+    """
+    requeued = requeue_stale_jobs()
+    if requeued:
+        logger.warning("Requeued %d character generation jobs left running", requeued)
+    pending = CharacterGenerationJob.objects.filter(status=CharacterGenerationJob.PENDING)
+    job_ids = list(pending.order_by('created_at').values_list('id', flat=True))
+    executor = get_executor()
+    for job_id in job_ids:
+        executor.submit(run_job, job_id)
+    return job_ids
+
+
+def start_recovery():
+    """
+    Recovers the jobs in a background thread, when settings.CHARACTER_JOB_RECOVER_ON_START is on.
+
+    Called by the WSGI and ASGI entry points, so only processes serving requests
+    pick the jobs up, not management commands or the test runner.
+    """
+    if settings.CHARACTER_JOB_RECOVER_ON_START:
+        threading.Thread(target=_recover, name='character-job-recovery', daemon=True).start()
+
+
+def _recover():
+    try:
+        recover_jobs()
+    except Exception:
+        logger.exception("Could not recover the character generation jobs")
+    finally:
+        close_old_connections()
+
+
+def submit_job(story, request):
+    """
+    Stores a character generation job and queues it for the worker pool.
+
+    Returns:
+        CharacterGenerationJob: The job, in PENDING state
+    """
+    job = CharacterGenerationJob.objects.create(story=story, request=request)
+    # Workers read the job from the database, so hand it over once it is committed
+    transaction.on_commit(lambda: get_executor().submit(run_job, job.pk))
+    return job
+
+
+@contextmanager
+def _heartbeat(job_id):
+    """
+    Refreshes the updated_at of a running job every third of settings.CHARACTER_JOB_STALE_AFTER,
+    so a long generation is not requeued by requeue_stale_jobs() while it runs.
+    """
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(settings.CHARACTER_JOB_STALE_AFTER / 3):
+                CharacterGenerationJob.objects.filter(
+                    pk=job_id, status=CharacterGenerationJob.RUNNING
+                ).update(updated_at=timezone.now())
+        except Exception:
+            logger.exception("Could not refresh character generation job %s", job_id)
+        finally:
+            connection.close()
+
+    threading.Thread(target=beat, name=f'character-job-{job_id}-heartbeat', daemon=True).start()
+    try:
+        yield
+    finally:
+        stop.set()
+
+
+def run_job(job_id):
+    """Generates and saves the character of a job, recording the outcome on the job."""
+    close_old_connections()
+    try:
+        # Claim the job; a job submitted twice (or already done) runs only once. update()
+        # skips auto_now, and a job long pending must not look stale once running.
+        claimed = CharacterGenerationJob.objects.filter(
+            pk=job_id, status=CharacterGenerationJob.PENDING
+        ).update(status=CharacterGenerationJob.RUNNING, updated_at=timezone.now())
+        if not claimed:
+            return
+
+        job = CharacterGenerationJob.objects.select_related('story').get(pk=job_id)
+        try:
+            with _heartbeat(job_id):
+                character_generator = CharacterGenerator(StoryUnderstanding(story=job.story))
+                character_data = character_generator.generate_character_details(request=job.request)
+
+            with unique_names():
+                character = Character.objects.create(
+                    story=job.story,
+                    name=character_data['name'],
+                    faction=character_data['faction'],
+                    profession=character_data['profession'],
+                    personality_traits=character_data['personality_traits'],
+                    background=character_data['background']
+                )
+        except Exception as e:
+            logger.exception("Character generation job %s failed", job_id)
+            job.status = CharacterGenerationJob.FAILED
+            job.error = str(e)
+            job.save(update_fields=['status', 'error', 'updated_at'])
+            return
+
+        job.status = CharacterGenerationJob.SUCCEEDED
+        job.character = character
+        job.save(update_fields=['status', 'character', 'updated_at'])
+    finally:
+        close_old_connections()
@@ -0,0 +1,131 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from npc_api.models import ConversationHistory, ConversationSummary
+from npc_api.services import prompts
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_pid = None
+# Characters whose summary update is queued or running
+_scheduled = set()
+_lock = threading.Lock()
+
+
+class ConversationMemory:
+    """
+    Bounded conversation memory of a character.
+
+    The last settings.CONVERSATION_MEMORY_TURNS messages are sent verbatim; older
+    messages are folded into a rolling per-character summary, updated once at least
+    settings.CONVERSATION_SUMMARY_EVERY messages have left the window. Prompt size
+    therefore stays constant however long a conversation runs.
+    """
+
+    def __init__(self, character, backend, model=None):
+        self.character = character
+        self.backend = backend
+        self.model = model or settings.LLM_MODEL
+        self.window = settings.CONVERSATION_MEMORY_TURNS
+        self.summarize_every = settings.CONVERSATION_SUMMARY_EVERY
+
+    def _history(self):
+        return ConversationHistory.objects.filter(character=self.character)
+
+    def load(self):
+        """
+        Returns the memory to put in the prompt.
+
+        Returns:
+            tuple: (summary text, list of recent ConversationHistory messages, oldest first)
+        """
+        summary = ConversationSummary.objects.filter(character=self.character).values_list('summary', flat=True).first()
+        recent = list(self._history().order_by('-timestamp', '-id')[:self.window])
+        recent.reverse()
+        return summary or '', recent
+
+    def _summary_prompt(self, summary, messages):
+        transcript = "\n".join(self.format_message(message) for message in messages)
+        return prompts.MEMORY.render(name=self.character.name, summary=summary or "(empty)", transcript=transcript)
+
+    def format_message(self, message):
+        speaker = "User" if message.sender_type == ConversationHistory.USER else self.character.name
+        return f"{speaker}: {message.message}"
+
+    def update(self):
+        """
+        Folds the messages that left the window into the summary, once enough accumulated.
+
+        Returns:
+            bool: True if the summary was updated
+        """
+        memory, _ = ConversationSummary.objects.get_or_create(character=self.character)
+
+        window_ids = list(self._history().order_by('-timestamp', '-id').values_list('id', flat=True)[:self.window])
+        if len(window_ids) < self.window:
+            return False
+
+        pending = self._history().filter(id__gt=memory.summarized_until, id__lt=min(window_ids))
+        if pending.count() < self.summarize_every:
+            return False
+
+        messages = list(pending.order_by('timestamp', 'id'))
+        memory.summary = self.backend.generate(
+            self._summary_prompt(memory.summary, messages), task="memory", model=self.model
+        ).strip()
+        memory.summarized_until = messages[-1].id
+        memory.save(update_fields=['summary', 'summarized_until', 'updated_at'])
+        return True
+
+
+def _get_executor():
+    """Returns the process-wide summary pool (settings.CONVERSATION_SUMMARY_WORKERS threads)."""
+    global _executor, _executor_pid
+    with _lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.CONVERSATION_SUMMARY_WORKERS, thread_name_prefix='conversation-summary'
+            )
+            _executor_pid = os.getpid()
+            _scheduled.clear()
+        return _executor
+
+
+def schedule_update(character_id, update):
+    """
+    Runs `update()` (a summary update of the character) after the reply, on the summary pool.
+
+    The update is queued once the current transaction commits, so the worker sees
+    the saved turn. At most one update per character is queued or running; turns
+    arriving meanwhile are folded in by a later one. With
+    settings.CONVERSATION_SUMMARY_WORKERS set to 0 it runs in the calling thread.
+    """
+    if not settings.CONVERSATION_SUMMARY_WORKERS:
+        update()
+        return
+    transaction.on_commit(lambda: _submit(character_id, update))
+
+
+def _submit(character_id, update):
+    executor = _get_executor()
+    with _lock:
+        if character_id in _scheduled:
+            return
+        _scheduled.add(character_id)
+    executor.submit(_run, character_id, update)
+
+
+def _run(character_id, update):
+    close_old_connections()
+    try:
+        update()
+    finally:
+        with _lock:
+            _scheduled.discard(character_id)
+        close_old_connections()
@@ -0,0 +1,207 @@
+import asyncio
+import contextvars
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from npc_api.services.character_conversation import CharacterConversation
+from npc_api.services.conversation_memory import schedule_update
+from npc_api.services.history_writer import conversation_rows, save_rows
+from npc_api.services.llm_backend import LLMError, get_backend
+
+
+class GroupConversation:
+    """
+    One message from the user to several characters at once (e.g. a tavern scene).
+
+    Every character answers from its own persona and memory, as with
+    CharacterConversation, but the model calls run concurrently (at most
+    settings.GROUP_TALK_CONCURRENCY at a time) and all history rows of the
+    turn are written with one bulk insert once the replies are in. Memory and
+    personas are loaded in the calling thread before the fan-out, so the
+    worker threads only wait for the model.
+    """
+
+    def __init__(self, characters, api_key=None, backend=None):
+        """
+        Args:
+            characters: Character objects, in the order the replies are returned
+            api_key: Optional Gemini API key
+            backend: Optional LLMBackend, defaults to the one configured in settings
+        """
+        self.backend = backend or get_backend(api_key=api_key)
+        self.model = settings.LLM_MODEL
+        self.conversations = [
+            CharacterConversation(character=character, backend=self.backend) for character in characters
+        ]
+
+    def _reply(self, conversation, response):
+        character = conversation.character
+        return {'character_id': character.pk, 'name': character.name, 'response': response}
+
+    def _error(self, conversation, error):
+        return {'character_id': conversation.character.pk, 'error': f"An error occurred: {str(error)}"}
+
+    def _result(self, message, outcomes, save_history):
+        """
+        Builds {'responses': [...], 'errors': [...]} from (conversation, reply, error) triples.
+
+        Saves the replies when asked to; if no character answered and a model call
+        failed, the first LLMError is raised, so the caller gets a 429/503.
+        """
+        answered = [(conversation, reply) for conversation, reply, error in outcomes if error is None]
+        if not answered:
+            for _, _, error in outcomes:
+                if isinstance(error, LLMError):
+                    raise error
+        if save_history:
+            self._remember(message, answered)
+        return {
+            'responses': [self._reply(conversation, reply) for conversation, reply in answered],
+            'errors': [self._error(conversation, error) for conversation, _, error in outcomes if error is not None],
+        }
+
+    def _remember(self, message, answered):
+        """Saves the exchanges with one bulk insert; the memory summaries are updated in the background."""
+        if not answered:
+            return
+        rows = []
+        for conversation, reply in answered:
+            rows.extend(conversation_rows(conversation.character, message, reply))
+        save_rows(rows)
+        for conversation, _ in answered:
+            schedule_update(conversation.character.pk, conversation.update_memory)
+
+    def _map(self, func, items):
+        """Runs func over items in worker threads, each in a copy of the caller's context (request metrics)."""
+        workers = max(1, min(settings.GROUP_TALK_CONCURRENCY, len(items)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, func, item) for item in items]
+            return [future.result() for future in futures]
+
+    def generate_responses(self, message, save_history=True):
+        """
+        Generates every character's reply to the message concurrently.
+
+        Returns:
+            dict: {'responses': [{'character_id', 'name', 'response'}], 'errors': [{'character_id', 'error'}]}
+        """
+        prepared = [(conversation, *conversation.prepare(message)) for conversation in self.conversations]
+
+        def generate(item):
+            conversation, prompt, context = item
+            try:
+                return conversation, self.backend.generate(prompt, task="talk", model=self.model, context=context), None
+            except Exception as e:
+                return conversation, None, e
+
+        return self._result(message, self._map(generate, prepared), save_history)
+
+    async def agenerate_responses(self, message, save_history=True):
+        """Async version of generate_responses()."""
+        prepared = [(conversation, *await conversation.aprepare(message)) for conversation in self.conversations]
+        semaphore = asyncio.Semaphore(settings.GROUP_TALK_CONCURRENCY)
+
+        async def generate(conversation, prompt, context):
+            async with semaphore:
+                try:
+                    reply = await self.backend.agenerate(prompt, task="talk", model=self.model, context=context)
+                    return conversation, reply, None
+                except Exception as e:
+                    return conversation, None, e
+
+        outcomes = await asyncio.gather(*(generate(*item) for item in prepared))
+        return await sync_to_async(self._result)(message, outcomes, save_history)
+
+    def stream_events(self, message, save_history=True):
+        """
+        Streams the replies of all characters as they are generated.
+
+        Yields (event, payload) pairs: (None, {'character_id', 'token'}) for every
+        chunk, ('reply', {...}) or ('error', {...}) when a character finishes and
+        finally ('done', {'done': True, 'responses': [...], 'errors': [...]}) once
+        the history is saved. An interrupted stream is not saved.
+        """
+        prepared = [(conversation, *conversation.prepare(message)) for conversation in self.conversations]
+        events = queue.Queue()
+
+        def generate(item):
+            conversation, prompt, context = item
+            chunks = []
+            try:
+                for chunk in self.backend.stream(prompt, task="talk", model=self.model, context=context):
+                    chunks.append(chunk)
+                    events.put((conversation, chunk, None, False))
+            except Exception as e:
+                events.put((conversation, None, e, True))
+                return
+            events.put((conversation, ''.join(chunks), None, True))
+
+        workers = max(1, min(settings.GROUP_TALK_CONCURRENCY, len(prepared)))
+        outcomes = []
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            for item in prepared:
+                executor.submit(contextvars.copy_context().run, generate, item)
+            while len(outcomes) < len(prepared):
+                conversation, text, error, finished = events.get()
+                if not finished:
+                    yield None, {'character_id': conversation.character.pk, 'token': text}
+                elif error is not None:
+                    outcomes.append((conversation, None, error))
+                    yield 'error', self._error(conversation, error)
+                else:
+                    outcomes.append((conversation, text, None))
+                    yield 'reply', self._reply(conversation, text)
+        finally:
+            # A disconnected client must not wait for the replies still being generated
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        yield 'done', {'done': True, **self._result_or_error(message, outcomes, save_history)}
+
+    async def astream_events(self, message, save_history=True):
+        """Async version of stream_events()."""
+        prepared = [(conversation, *await conversation.aprepare(message)) for conversation in self.conversations]
+        events = asyncio.Queue()
+        semaphore = asyncio.Semaphore(settings.GROUP_TALK_CONCURRENCY)
+
+        async def generate(conversation, prompt, context):
+            async with semaphore:
+                chunks = []
+                try:
+                    async for chunk in self.backend.astream(prompt, task="talk", model=self.model, context=context):
+                        chunks.append(chunk)
+                        await events.put((conversation, chunk, None, False))
+                except Exception as e:
+                    await events.put((conversation, None, e, True))
+                    return
+                await events.put((conversation, ''.join(chunks), None, True))
+
+        tasks = [asyncio.ensure_future(generate(*item)) for item in prepared]
+        outcomes = []
+        try:
+            while len(outcomes) < len(prepared):
+                conversation, text, error, finished = await events.get()
+                if not finished:
+                    yield None, {'character_id': conversation.character.pk, 'token': text}
+                elif error is not None:
+                    outcomes.append((conversation, None, error))
+                    yield 'error', self._error(conversation, error)
+                else:
+                    outcomes.append((conversation, text, None))
+                    yield 'reply', self._reply(conversation, text)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        result = await sync_to_async(self._result_or_error)(message, outcomes, save_history)
+        yield 'done', {'done': True, **result}
+
+    def _result_or_error(self, message, outcomes, save_history):
+        """_result() for streams, which have already sent their headers and cannot turn into a 429."""
+        try:
+            return self._result(message, outcomes, save_history)
+        except LLMError:
+            return {'responses': [], 'errors': [self._error(c, e) for c, _, e in outcomes]}
@@ -0,0 +1,122 @@
+import atexit
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from npc_api.models import ConversationHistory
+
+logger = logging.getLogger(__name__)
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def conversation_rows(character, user_message, character_response):
+    """Unsaved ConversationHistory rows of one exchange, user message first."""
+    return [
+        ConversationHistory(character=character, message=user_message, sender_type=ConversationHistory.USER),
+        ConversationHistory(character=character, message=character_response, sender_type=ConversationHistory.CHARACTER),
+    ]
+
+
+def write_rows(rows):
+    """Inserts the rows with one bulk INSERT in one transaction."""
+    with transaction.atomic():
+        ConversationHistory.objects.bulk_create(rows)
+
+
+def save_rows(rows):
+    """Writes the rows at once, or queues them for the buffered writer when settings.CONVERSATION_HISTORY_BUFFERED is on."""
+    if settings.CONVERSATION_HISTORY_BUFFERED:
+        get_history_writer().add(rows)
+    else:
+        write_rows(rows)
+
+
+class HistoryWriter:
+    """
+    Buffers conversation rows and writes them with periodic bulk inserts.
+
+    A daemon thread flushes the buffer every `interval` seconds, or as soon as
+    `batch_size` rows are waiting, so turns from many concurrent conversations
+    share one transaction. Rows are only visible in the database after the
+    flush; their timestamps are the flush time. Rows whose write failed (e.g.
+    a locked SQLite database) are retried by the next flushes, and dropped
+    after `max_retries` failed flushes in a row.
+    """
+
+    def __init__(self, interval=None, batch_size=None, max_retries=None):
+        self.interval = settings.CONVERSATION_HISTORY_FLUSH_INTERVAL if interval is None else interval
+        self.batch_size = settings.CONVERSATION_HISTORY_FLUSH_SIZE if batch_size is None else batch_size
+        self.max_retries = settings.CONVERSATION_HISTORY_FLUSH_RETRIES if max_retries is None else max_retries
+        self.pid = os.getpid()
+        self._rows = []
+        self._failures = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='history-writer', daemon=True)
+        self._thread.start()
+
+    def add(self, rows):
+        """Queues the rows of one exchange; they are written together."""
+        with self._lock:
+            self._rows.extend(rows)
+            pending = len(self._rows)
+        if pending >= self.batch_size:
+            self._wakeup.set()
+
+    def flush(self):
+        """
+        Writes everything buffered so far in the calling thread.
+
+        Returns:
+            int: Number of rows written
+        """
+        with self._lock:
+            rows, self._rows = self._rows, []
+        if not rows:
+            return 0
+        try:
+            write_rows(rows)
+        except Exception:
+            with self._lock:
+                self._failures += 1
+                if self._failures > self.max_retries:
+                    self._failures = 0
+                    logger.exception("Could not write %d conversation messages, dropping them", len(rows))
+                else:
+                    # Back in front of the rows added meanwhile, so the order is kept
+                    self._rows[:0] = rows
+                    logger.warning("Could not write %d conversation messages, retrying", len(rows), exc_info=True)
+            return 0
+        with self._lock:
+            self._failures = 0
+        return len(rows)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            close_old_connections()
+            self.flush()
+
+    def stop(self):
+        """Stops the flush thread and writes the remaining rows."""
+        self._stopped.set()
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+
+
+def get_history_writer():
+    """Returns the process-wide HistoryWriter, started on first use (again after a fork)."""
+    global _writer
+    with _writer_lock:
+        if _writer is None or _writer.pid != os.getpid():
+            _writer = HistoryWriter()
+            atexit.register(_writer.stop)
+        return _writer
@@ -0,0 +1,98 @@
+import time
+
+from npc_api import metrics
+from npc_api.services.llm_backend import LLMBackend
+from npc_api.services.prompts import estimate_tokens
+
+
+class InstrumentedBackend(LLMBackend):
+    """
+    Wraps a backend to record every model call in npc_api.metrics.
+
+    Per task: call duration by outcome, estimated prompt and response size and
+    failed calls by error type. The prompt size includes the context unless it is
+    cached on the provider's side. The duration also counts towards the model time
+    of the current request (Server-Timing header).
+    """
+
+    def __init__(self, backend):
+        super().__init__(model=backend.model)
+        self.backend = backend
+
+    def _start(self):
+        timings = metrics.current_request()
+        if timings is not None:
+            timings.llm_started()
+        return timings, time.perf_counter()
+
+    def _record_context(self, context):
+        metrics.increment('llm_contexts_total', cached=context.name is not None)
+        return context
+
+    def create_context(self, text, model=None, ttl=None):
+        return self._record_context(self.backend.create_context(text, model=model, ttl=ttl))
+
+    async def acreate_context(self, text, model=None, ttl=None):
+        return self._record_context(await self.backend.acreate_context(text, model=model, ttl=ttl))
+
+    def _record(self, task, prompt, start, response=None, error=None, context=None):
+        if context is not None and (context.name is None or context.expired):
+            prompt = self.with_context(prompt, context)
+        timings, started = start
+        if timings is not None:
+            timings.llm_finished()
+        elapsed = time.perf_counter() - started
+        task = task or 'default'
+        outcome = 'error' if error is not None else 'ok'
+        metrics.observe('llm_call_seconds', elapsed, task=task, outcome=outcome)
+        metrics.observe('llm_prompt_tokens', estimate_tokens(prompt), task=task)
+        if error is not None:
+            metrics.increment('llm_errors_total', task=task, error=error.__class__.__name__)
+        else:
+            metrics.observe('llm_response_tokens', estimate_tokens(response or ''), task=task)
+
+    def generate(self, prompt, task=None, model=None, response_schema=None, context=None):
+        start = self._start()
+        try:
+            response = self.backend.generate(prompt, task=task, model=model, response_schema=response_schema,
+                                             context=context)
+        except BaseException as e:
+            self._record(task, prompt, start, error=e, context=context)
+            raise
+        self._record(task, prompt, start, response=response, context=context)
+        return response
+
+    async def agenerate(self, prompt, task=None, model=None, response_schema=None, context=None):
+        start = self._start()
+        try:
+            response = await self.backend.agenerate(prompt, task=task, model=model, response_schema=response_schema,
+                                                    context=context)
+        except BaseException as e:
+            self._record(task, prompt, start, error=e, context=context)
+            raise
+        self._record(task, prompt, start, response=response, context=context)
+        return response
+
+    def stream(self, prompt, task=None, model=None, context=None):
+        start = self._start()
+        chunks = []
+        try:
+            for chunk in self.backend.stream(prompt, task=task, model=model, context=context):
+                chunks.append(chunk)
+                yield chunk
+        except BaseException as e:
+            self._record(task, prompt, start, error=e, context=context)
+            raise
+        self._record(task, prompt, start, response=''.join(chunks), context=context)
+
+    async def astream(self, prompt, task=None, model=None, context=None):
+        start = self._start()
+        chunks = []
+        try:
+            async for chunk in self.backend.astream(prompt, task=task, model=model, context=context):
+                chunks.append(chunk)
+                yield chunk
+        except BaseException as e:
+            self._record(task, prompt, start, error=e, context=context)
+            raise
+        self._record(task, prompt, start, response=''.join(chunks), context=context)
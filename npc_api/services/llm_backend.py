@@ -0,0 +1,599 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+from string import Template
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.module_loading import import_string
+from google import genai
+from google.genai import errors as genai_errors
+from google.genai import types
+
+from npc_api.services.prompts import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+
+_registry = {}
+_registry_lock = threading.RLock()
+
+BACKENDS = {
+    'gemini': 'npc_api.services.llm_backend.GeminiBackend',
+    'fake': 'npc_api.services.llm_backend.FakeBackend',
+}
+
+
+class LLMError(Exception):
+    """
+    A model call failed.
+
+    `retry_after` is the number of seconds the provider asked to wait before
+    retrying, if it said so.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LLMRateLimitError(LLMError):
+    """The provider rejected the call because of a rate limit or exhausted quota (HTTP 429)."""
+
+
+class LLMUnavailableError(LLMError):
+    """The provider is temporarily unavailable or overloaded (HTTP 5xx, timeouts, connection errors)."""
+
+
+class LLMInvalidOutputError(LLMError):
+    """The model output could not be parsed or validated, even after a retry."""
+
+
+class NameCollisionError(LLMError):
+    """The model kept generating names already taken in the story, after all retries."""
+
+
+def _retry_after(error):
+    """Seconds to wait from the Retry-After header or the RetryInfo detail of a Gemini API error."""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        pass
+    details = error.details if isinstance(error.details, dict) else {}
+    for detail in details.get('error', {}).get('details', []):
+        delay = detail.get('retryDelay') if isinstance(detail, dict) else None
+        if delay:
+            try:
+                return float(str(delay).rstrip('s'))
+            except ValueError:
+                pass
+    return None
+
+
+def translate_error(error):
+    """Maps a google-genai or httpx exception to the matching LLMError."""
+    if isinstance(error, genai_errors.APIError):
+        if error.code == 429:
+            return LLMRateLimitError(str(error), retry_after=_retry_after(error))
+        if error.code in (500, 502, 503, 504):
+            return LLMUnavailableError(str(error), retry_after=_retry_after(error))
+        return LLMError(str(error))
+    if isinstance(error, httpx.HTTPError):
+        return LLMUnavailableError(f"{error.__class__.__name__}: {error}")
+    return LLMError(str(error))
+
+
+class PromptContext:
+    """
+    Static prefix shared by many prompts (e.g. a character's persona).
+
+    `name` is the handle of the prefix cached on the provider's side, valid
+    until `expires_at` (a time.time() value); without it the backend sends
+    `text` with every call.
+    """
+
+    # Handles this close to their expiry are not used any more
+    EXPIRY_MARGIN = 60
+
+    def __init__(self, text, model=None, name=None, expires_at=None):
+        self.text = text
+        self.model = model
+        self.name = name
+        self.expires_at = expires_at
+
+    @property
+    def expired(self):
+        return self.expires_at is not None and time.time() > self.expires_at - self.EXPIRY_MARGIN
+
+    def __repr__(self):
+        return f"PromptContext(model={self.model!r}, name={self.name!r}, chars={len(self.text)})"
+
+
+class LLMBackend:
+    """
+    Interface shared by all text generation backends used in npc_api.services.
+
+    Every call carries a `task` label ("summary", "question", "name", "character",
+    "talk", ...) describing which service call it serves, so backends and wrappers
+    can treat endpoints differently.
+
+    A call can also carry a `context`, a PromptContext from create_context(),
+    that the model reads before the prompt.
+
+    Failed calls raise LLMError, LLMRateLimitError or LLMUnavailableError.
+    """
+
+    def __init__(self, model=None, **options):
+        self.model = model or settings.LLM_MODEL
+
+    def create_context(self, text, model=None, ttl=None):
+        """
+        Registers a static prompt prefix, cached on the provider's side where supported.
+
+        Backends without context caching return an uncached PromptContext,
+        whose text is sent with every call.
+        """
+        return PromptContext(text, model=model or self.model)
+
+    async def acreate_context(self, text, model=None, ttl=None):
+        """Async version of create_context()."""
+        return await sync_to_async(self.create_context, thread_sensitive=False)(text, model=model, ttl=ttl)
+
+    @staticmethod
+    def with_context(prompt, context):
+        """The prompt with the context text in front, for backends sending both in one message."""
+        return f"{context.text}\n\n{prompt}" if context is not None else prompt
+
+    def generate(self, prompt, task=None, model=None, response_schema=None, context=None):
+        """
+        Generates a text completion for the prompt.
+
+        Args:
+            prompt: Full prompt text, or the part following `context`
+            task: Label of the service call the prompt belongs to
+            model: Optional model name overriding the backend default
+            response_schema: Optional schema; the completion is then a JSON document
+                following it (for backends with structured output support)
+            context: Optional PromptContext read before the prompt
+
+        Returns:
+            str: Generated text
+        """
+        raise NotImplementedError
+
+    async def agenerate(self, prompt, task=None, model=None, response_schema=None, context=None):
+        """Async version of generate(); runs it in a worker thread unless overridden."""
+        return await sync_to_async(self.generate, thread_sensitive=False)(
+            prompt, task=task, model=model, response_schema=response_schema, context=context
+        )
+
+    def stream(self, prompt, task=None, model=None, context=None):
+        """
+        Yields the completion in text chunks as the model produces them.
+
+        Backends without streaming support yield the whole completion at once.
+        """
+        yield self.generate(prompt, task=task, model=model, context=context)
+
+    async def astream(self, prompt, task=None, model=None, context=None):
+        """Async version of stream()."""
+        yield await self.agenerate(prompt, task=task, model=model, context=context)
+
+
+class GeminiBackend(LLMBackend):
+    """
+    Backend calling the Gemini API through google-genai.
+
+    Contexts of at least settings.LLM_CONTEXT_CACHE_MIN_TOKENS tokens are stored
+    as Gemini cached content, so calls only send the prompt; smaller ones (below
+    the provider's minimum) and contexts whose cache could not be created or was
+    dropped are sent as the system instruction.
+    """
+
+    def __init__(self, model=None, api_key=None, **options):
+        super().__init__(model=model, **options)
+        self.api_key = api_key or os.environ.get("GEMINI_API_KEY")
+        self.client = get_client(self.api_key)
+
+    @property
+    def aio(self):
+        """The async API, on the client of the running event loop (see get_async_client())."""
+        return get_async_client(self.api_key).aio
+
+    def _cache_config(self, text, ttl):
+        return types.CreateCachedContentConfig(system_instruction=text, ttl=f"{int(ttl)}s")
+
+    def _cacheable(self, text):
+        return settings.LLM_CONTEXT_CACHE and estimate_tokens(text) >= settings.LLM_CONTEXT_CACHE_MIN_TOKENS
+
+    def create_context(self, text, model=None, ttl=None):
+        model = model or self.model
+        if not self._cacheable(text):
+            return PromptContext(text, model=model)
+        ttl = ttl or settings.LLM_CONTEXT_CACHE_TTL
+        try:
+            cached = self.client.caches.create(model=model, config=self._cache_config(text, ttl))
+        except (genai_errors.APIError, httpx.HTTPError) as e:
+            logger.warning("Context caching failed, sending the context with every call: %s", e)
+            return PromptContext(text, model=model)
+        return PromptContext(text, model=model, name=cached.name, expires_at=time.time() + ttl)
+
+    async def acreate_context(self, text, model=None, ttl=None):
+        model = model or self.model
+        if not self._cacheable(text):
+            return PromptContext(text, model=model)
+        ttl = ttl or settings.LLM_CONTEXT_CACHE_TTL
+        try:
+            cached = await self.aio.caches.create(model=model, config=self._cache_config(text, ttl))
+        except (genai_errors.APIError, httpx.HTTPError) as e:
+            logger.warning("Context caching failed, sending the context with every call: %s", e)
+            return PromptContext(text, model=model)
+        return PromptContext(text, model=model, name=cached.name, expires_at=time.time() + ttl)
+
+    def _config(self, response_schema=None, context=None, use_cache=True):
+        options = {}
+        if response_schema is not None:
+            options.update(response_mime_type='application/json', response_schema=response_schema)
+        if context is not None:
+            if use_cache and context.name and not context.expired:
+                options['cached_content'] = context.name
+            else:
+                options['system_instruction'] = context.text
+        return types.GenerateContentConfig(**options) if options else None
+
+    @staticmethod
+    def _cache_missing(error, context):
+        """True if the call failed because the cached content it referenced is gone."""
+        return (
+            context is not None and context.name is not None
+            and isinstance(error, genai_errors.APIError) and error.code in (400, 403, 404)
+        )
+
+    def generate(self, prompt, task=None, model=None, response_schema=None, context=None):
+        def call(use_cache=True):
+            return self.client.models.generate_content(
+                model=model or self.model,
+                contents=prompt,
+                config=self._config(response_schema, context, use_cache)
+            )
+
+        try:
+            try:
+                response = call()
+            except genai_errors.APIError as e:
+                if not self._cache_missing(e, context):
+                    raise
+                response = call(use_cache=False)
+        except (genai_errors.APIError, httpx.HTTPError) as e:
+            raise translate_error(e) from e
+        return response.text
+
+    async def agenerate(self, prompt, task=None, model=None, response_schema=None, context=None):
+        async def call(use_cache=True):
+            return await self.aio.models.generate_content(
+                model=model or self.model,
+                contents=prompt,
+                config=self._config(response_schema, context, use_cache)
+            )
+
+        try:
+            try:
+                response = await call()
+            except genai_errors.APIError as e:
+                if not self._cache_missing(e, context):
+                    raise
+                response = await call(use_cache=False)
+        except (genai_errors.APIError, httpx.HTTPError) as e:
+            raise translate_error(e) from e
+        return response.text
+
+    def stream(self, prompt, task=None, model=None, context=None):
+        use_cache = True
+        started = False
+        while True:
+            try:
+                for chunk in self.client.models.generate_content_stream(
+                    model=model or self.model, contents=prompt, config=self._config(context=context, use_cache=use_cache)
+                ):
+                    if chunk.text:
+                        started = True
+                        yield chunk.text
+                return
+            except genai_errors.APIError as e:
+                # Retried without the cache only if nothing was yielded yet
+                if started or not use_cache or not self._cache_missing(e, context):
+                    raise translate_error(e) from e
+                use_cache = False
+            except httpx.HTTPError as e:
+                raise translate_error(e) from e
+
+    async def astream(self, prompt, task=None, model=None, context=None):
+        use_cache = True
+        started = False
+        while True:
+            try:
+                chunks = await self.aio.models.generate_content_stream(
+                    model=model or self.model, contents=prompt, config=self._config(context=context, use_cache=use_cache)
+                )
+                async for chunk in chunks:
+                    if chunk.text:
+                        started = True
+                        yield chunk.text
+                return
+            except genai_errors.APIError as e:
+                if started or not use_cache or not self._cache_missing(e, context):
+                    raise translate_error(e) from e
+                use_cache = False
+            except httpx.HTTPError as e:
+                raise translate_error(e) from e
+
+
+class FakeBackend(LLMBackend):
+    """
+    Deterministic local stand-in for load testing and offline benchmarks.
+
+    Responses are `string.Template` strings chosen by task and filled with
+    `$name`, `$call` and `$prompt_chars`. Latency follows `distribution`, drawn
+    from a generator seeded with `seed`: 'uniform' is `latency` seconds plus up
+    to `jitter`, 'exponential' adds a random delay averaging `jitter` (a long
+    tail), and 'lognormal' has a median of `latency` and a shape of `jitter`. When
+    streaming, the latency is paid before the first token and `token_latency`
+    between the following ones. A share `error_rate` of the calls fails with
+    LLMRateLimitError after the latency, to exercise retries.
+
+    Contexts are "cached" without a size minimum: `$prompt_chars` then counts the
+    prompt only, as a provider would bill it, and `contexts` counts the
+    create_context() calls.
+    """
+
+    FIRST_NAMES = ['Aldric', 'Brenna', 'Corin', 'Daria', 'Eldon', 'Fenna', 'Garrick', 'Hilde',
+                   'Ivor', 'Jessa', 'Kael', 'Liora', 'Morwen', 'Nyssa', 'Orin', 'Perrin']
+    LAST_NAMES = ['Ashford', 'Blackthorn', 'Duskwalker', 'Emberfall', 'Frostvale', 'Greymane',
+                  'Ironwood', 'Moonbrook', 'Ravenscar', 'Stormhold', 'Thornfield', 'Wyndmere']
+
+    DISTRIBUTIONS = ('uniform', 'exponential', 'lognormal')
+
+    DEFAULT_RESPONSES = {
+        'summary': "A fractured realm of rival factions, old magic and contested borders.",
+        'question': "The story follows the factions of a sundered realm and the conflicts between them.",
+        'name': "$name",
+        'character': json.dumps({
+            "name": "$name",
+            "faction": "Verdant Covenant",
+            "profession": "Herbalist",
+            "personality_traits": ["Kind", "Curious"],
+            "background": "Raised in the Deepwoods, $name learned the old ways from the elders.",
+        }),
+        'talk': "Well met, traveller. I am $name, and I will help you as best I can.",
+        'memory': "The user asked the character for help several times and the character agreed to assist.",
+        'default': "Generated response #$call.",
+    }
+
+    def __init__(self, model=None, latency=0.0, jitter=0.0, token_latency=0.0, responses=None, seed=0,
+                 error_rate=0.0, distribution='uniform', **options):
+        super().__init__(model=model, **options)
+        if distribution not in self.DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution: {distribution}")
+        self.latency = latency
+        self.jitter = jitter
+        self.distribution = distribution
+        self.token_latency = token_latency
+        self.error_rate = error_rate
+        self.responses = {**self.DEFAULT_RESPONSES, **(responses or {})}
+        self._random = random.Random(seed)
+        self._calls = 0
+        self.contexts = 0
+        self._lock = threading.Lock()
+
+    def create_context(self, text, model=None, ttl=None):
+        with self._lock:
+            self.contexts += 1
+            number = self.contexts
+        ttl = ttl or settings.LLM_CONTEXT_CACHE_TTL
+        return PromptContext(text, model=model or self.model, name=f"fake-context-{number}",
+                             expires_at=time.time() + ttl)
+
+    def _delay(self):
+        if not self.jitter:
+            return self.latency
+        if self.distribution == 'exponential':
+            return self.latency + self._random.expovariate(1 / self.jitter)
+        if self.distribution == 'lognormal':
+            return self.latency * self._random.lognormvariate(0, self.jitter)
+        return self.latency + self._random.uniform(0, self.jitter)
+
+    def _next_call(self):
+        with self._lock:
+            self._calls += 1
+            delay = self._delay()
+            failed = bool(self.error_rate) and self._random.random() < self.error_rate
+            return self._calls, delay, failed
+
+    def _check(self, call, failed):
+        if failed:
+            raise LLMRateLimitError(f"Simulated rate limit on call #{call}")
+
+    def _name_for(self, call):
+        first = self.FIRST_NAMES[call % len(self.FIRST_NAMES)]
+        last = self.LAST_NAMES[(call // len(self.FIRST_NAMES)) % len(self.LAST_NAMES)]
+        # Numbered once all combinations are used, so long runs keep names unique
+        cycle = call // (len(self.FIRST_NAMES) * len(self.LAST_NAMES))
+        return f"{first} {last}" + (f" {cycle + 1}" if cycle else "")
+
+    def _render(self, prompt, task, call, context=None):
+        if context is not None and (context.name is None or context.expired):
+            prompt = self.with_context(prompt, context)
+        template = self.responses.get(task, self.responses['default'])
+        return Template(template).safe_substitute(
+            name=self._name_for(call),
+            call=call,
+            prompt_chars=len(prompt),
+        )
+
+    def generate(self, prompt, task=None, model=None, response_schema=None, context=None):
+        call, delay, failed = self._next_call()
+        if delay:
+            time.sleep(delay)
+        self._check(call, failed)
+        return self._render(prompt, task, call, context)
+
+    async def agenerate(self, prompt, task=None, model=None, response_schema=None, context=None):
+        call, delay, failed = self._next_call()
+        if delay:
+            await asyncio.sleep(delay)
+        self._check(call, failed)
+        return self._render(prompt, task, call, context)
+
+    def _tokens(self, text):
+        words = text.split(' ')
+        return [word + ' ' for word in words[:-1]] + words[-1:]
+
+    def stream(self, prompt, task=None, model=None, context=None):
+        call, delay, failed = self._next_call()
+        for index, token in enumerate(self._tokens(self._render(prompt, task, call, context))):
+            pause = delay if index == 0 else self.token_latency
+            if pause:
+                time.sleep(pause)
+            if index == 0:
+                self._check(call, failed)
+            yield token
+
+    async def astream(self, prompt, task=None, model=None, context=None):
+        call, delay, failed = self._next_call()
+        for index, token in enumerate(self._tokens(self._render(prompt, task, call, context))):
+            pause = delay if index == 0 else self.token_latency
+            if pause:
+                await asyncio.sleep(pause)
+            if index == 0:
+                self._check(call, failed)
+            yield token
+
+
+def _get_or_create(key, factory):
+    """
+    Returns the registry entry for `key`, creating it once per process.
+
+    Keys include the process id, so objects created before a worker fork
+    (and their open connections) are never shared with the child process.
+    """
+    key = (os.getpid(),) + key
+    instance = _registry.get(key)
+    if instance is None:
+        with _registry_lock:
+            instance = _registry.get(key)
+            if instance is None:
+                instance = _registry[key] = factory()
+    return instance
+
+
+def _create_client(api_key):
+    limits = httpx.Limits(
+        max_connections=settings.LLM_HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=settings.LLM_HTTP_KEEPALIVE_EXPIRY,
+    )
+    http_options = types.HttpOptions(
+        client_args={'limits': limits},
+        async_client_args={'limits': limits},
+    )
+    return genai.Client(api_key=api_key, http_options=http_options)
+
+
+def get_client(api_key=None):
+    """
+    Returns the process-wide genai.Client for the API key, used for the sync API.
+
+    The client keeps a pooled httpx connection (keep-alive), so TLS setup is
+    paid once per process, not per request.
+    """
+    return _get_or_create(('client', api_key), lambda: _create_client(api_key))
+
+
+def get_async_client(api_key=None):
+    """
+    Returns the genai.Client for the API key and the running event loop, used for the async API.
+
+    Async connections belong to the loop that opened them, and under WSGI every
+    async view runs in a new loop (async_to_sync) closed after the request, so
+    each loop gets its own client and pool. Clients of closed loops are dropped.
+    """
+    loop = asyncio.get_running_loop()
+    _drop_closed_loops()
+    _, client = _get_or_create(('async_client', api_key, id(loop)), lambda: (loop, _create_client(api_key)))
+    return client
+
+
+def _drop_closed_loops():
+    with _registry_lock:
+        closed = [
+            key for key, entry in _registry.items()
+            if key[1] == 'async_client' and entry[0].is_closed()
+        ]
+        for key in closed:
+            _, client = _registry.pop(key)
+            # Only the sync pool can still be closed; the async one went with its loop
+            client.close()
+
+
+def get_backend(**options):
+    """
+    Returns the process-wide backend configured by settings.LLM_BACKEND.
+
+    The setting is either a short name from BACKENDS or a dotted class path;
+    settings.LLM_BACKEND_OPTIONS are passed to the constructor, overridden by the
+    `options` that are not None. One instance is shared per backend class and options, across all threads.
+    With settings.LLM_SCHEDULER on, the backend is wrapped in a ScheduledBackend
+    sharing the process-wide CallScheduler; identical concurrent calls of the
+    tasks in settings.LLM_COALESCE_TASKS share one request (CoalescingBackend),
+    and with settings.METRICS_ENABLED every call is recorded (InstrumentedBackend).
+    """
+    backend_path = BACKENDS.get(settings.LLM_BACKEND, settings.LLM_BACKEND)
+    options = {**settings.LLM_BACKEND_OPTIONS, **{k: v for k, v in options.items() if v is not None}}
+    key = (
+        'backend', backend_path, repr(sorted(options.items())),
+        settings.LLM_SCHEDULER, tuple(sorted(settings.LLM_COALESCE_TASKS)), settings.METRICS_ENABLED,
+    )
+
+    def create():
+        from npc_api.services.instrumented_backend import InstrumentedBackend
+        from npc_api.services.llm_scheduler import ScheduledBackend
+        from npc_api.services.single_flight import CoalescingBackend
+
+        backend = import_string(backend_path)(**options)
+        if settings.LLM_SCHEDULER:
+            backend = ScheduledBackend(backend, get_scheduler())
+        if settings.LLM_COALESCE_TASKS:
+            # Outermost, so callers waiting for a shared call do not hold scheduler slots
+            backend = CoalescingBackend(backend, get_single_flight(), settings.LLM_COALESCE_TASKS)
+        if settings.METRICS_ENABLED:
+            # Outermost, so the recorded time is what the caller waited, coalesced calls included
+            backend = InstrumentedBackend(backend)
+        return backend
+
+    return _get_or_create(key, create)
+
+
+def get_scheduler():
+    """Returns the process-wide CallScheduler shared by all backends."""
+    from npc_api.services.llm_scheduler import CallScheduler
+
+    return _get_or_create(('scheduler',), CallScheduler)
+
+
+def get_single_flight():
+    """Returns the process-wide SingleFlight shared by all backends."""
+    from npc_api.services.single_flight import SingleFlight
+
+    return _get_or_create(('single_flight',), SingleFlight)
+
+
+def reset_registry():
+    """Drops all pooled clients and backends, e.g. after settings change in tests."""
+    with _registry_lock:
+        _registry.clear()
@@ -0,0 +1,319 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+from django.conf import settings
+
+from npc_api.services.llm_backend import LLMBackend, LLMRateLimitError, LLMUnavailableError
+
+logger = logging.getLogger(__name__)
+
+# Errors worth retrying; any other LLMError fails at once
+RETRYABLE_ERRORS = (LLMRateLimitError, LLMUnavailableError)
+
+
+class Limiter:
+    """
+    Counting semaphore shared by threads and event loops.
+
+    Sync callers block their thread; async callers await a future on their own
+    loop, so waiting for a slot never ties up a worker thread. Released slots
+    are handed to the waiters in arrival order.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._active = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._active < self.limit:
+                self._active += 1
+                return
+            event = threading.Event()
+            waiter = (None, event)
+            self._waiters.append(waiter)
+        event.wait()
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._active < self.limit:
+                self._active += 1
+                return
+            future = loop.create_future()
+            waiter = (loop, future)
+            self._waiters.append(waiter)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+            # The slot was handed over just before the cancellation
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            while self._waiters:
+                loop, waiter = self._waiters.popleft()
+                if loop is None:
+                    waiter.set()
+                    return
+                try:
+                    loop.call_soon_threadsafe(self._hand_over, waiter)
+                    return
+                except RuntimeError:
+                    # The waiter's event loop is closed
+                    continue
+            self._active -= 1
+
+    def _hand_over(self, future):
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+
+class TokenBucket:
+    """
+    Rate limiter: `rate` calls per second on average, bursts of up to `burst` calls.
+
+    `reserve()` takes a token and returns how long the caller must wait before
+    using it, so sync and async callers can sleep in their own way.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = max(1.0, float(burst or rate))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self._paused_until - now)
+            if self.rate:
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                self._tokens -= 1
+                if self._tokens < 0:
+                    wait = max(wait, -self._tokens / self.rate)
+            return wait
+
+    def pause(self, seconds):
+        """Holds back every caller for `seconds`, e.g. when the provider asks to slow down."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class CallScheduler:
+    """
+    Process-wide admission control for model calls.
+
+    A call needs a slot of the global limit (settings.LLM_MAX_CONCURRENCY), a slot
+    of its task's limit (settings.LLM_TASK_CONCURRENCY) and a token of the rate
+    limiter (settings.LLM_RATE_LIMIT calls per second). Rate-limit and availability
+    errors are retried up to settings.LLM_MAX_RETRIES times with exponential backoff
+    and full jitter, honouring the delay the provider asked for; a rate-limit error
+    also pauses the rate limiter for every caller, so retries do not pile up.
+    """
+
+    def __init__(self, max_concurrency=None, task_concurrency=None, rate=None, burst=None,
+                 max_retries=None, base_delay=None, max_delay=None):
+        self.limiter = Limiter(max_concurrency or settings.LLM_MAX_CONCURRENCY)
+        task_concurrency = settings.LLM_TASK_CONCURRENCY if task_concurrency is None else task_concurrency
+        self.task_limiters = {task: Limiter(limit) for task, limit in task_concurrency.items()}
+        self.bucket = TokenBucket(
+            settings.LLM_RATE_LIMIT if rate is None else rate,
+            settings.LLM_RATE_BURST if burst is None else burst,
+        )
+        self.max_retries = settings.LLM_MAX_RETRIES if max_retries is None else max_retries
+        self.base_delay = settings.LLM_RETRY_BASE_DELAY if base_delay is None else base_delay
+        self.max_delay = settings.LLM_RETRY_MAX_DELAY if max_delay is None else max_delay
+
+    def _limiters(self, task):
+        # The task's own limit first: a call queued behind its task must not hold
+        # a global slot that calls of other tasks could use meanwhile
+        task_limiter = self.task_limiters.get(task)
+        return [task_limiter, self.limiter] if task_limiter else [self.limiter]
+
+    @contextmanager
+    def slot(self, task=None):
+        """Holds a concurrency slot and a rate token for one call."""
+        acquired = []
+        try:
+            for limiter in self._limiters(task):
+                limiter.acquire()
+                acquired.append(limiter)
+            wait = self.bucket.reserve()
+            if wait:
+                time.sleep(wait)
+            yield
+        finally:
+            for limiter in reversed(acquired):
+                limiter.release()
+
+    @asynccontextmanager
+    async def aslot(self, task=None):
+        """Async version of slot()."""
+        acquired = []
+        try:
+            for limiter in self._limiters(task):
+                await limiter.aacquire()
+                acquired.append(limiter)
+            wait = self.bucket.reserve()
+            if wait:
+                await asyncio.sleep(wait)
+            yield
+        finally:
+            for limiter in reversed(acquired):
+                limiter.release()
+
+    def backoff(self, attempt, error):
+        """
+        Delay before retry number `attempt` (0-based) after `error`.
+
+        Full jitter spreads the retries of concurrent callers; the delay is never
+        shorter than the Retry-After the provider sent.
+        """
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if error.retry_after:
+            delay = max(delay, error.retry_after)
+        if isinstance(error, LLMRateLimitError):
+            self.bucket.pause(delay)
+        return delay
+
+    def _give_up(self, attempt, error):
+        """True if `error` is final; tells the client when to come back if so."""
+        if isinstance(error, RETRYABLE_ERRORS) and attempt < self.max_retries:
+            return False
+        if isinstance(error, RETRYABLE_ERRORS) and not error.retry_after:
+            error.retry_after = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return True
+
+    def call(self, func, task=None):
+        """Runs `func()` (one model call) under the limits, retrying transient errors."""
+        attempt = 0
+        while True:
+            try:
+                with self.slot(task):
+                    return func()
+            except RETRYABLE_ERRORS as e:
+                if self._give_up(attempt, e):
+                    raise
+                delay = self.backoff(attempt, e)
+                logger.warning("Model call (%s) failed: %s; retry %d in %.2fs", task, e, attempt + 1, delay)
+                time.sleep(delay)
+                attempt += 1
+
+    async def acall(self, func, task=None):
+        """Async version of call(); `func()` returns an awaitable."""
+        attempt = 0
+        while True:
+            try:
+                async with self.aslot(task):
+                    return await func()
+            except RETRYABLE_ERRORS as e:
+                if self._give_up(attempt, e):
+                    raise
+                delay = self.backoff(attempt, e)
+                logger.warning("Model call (%s) failed: %s; retry %d in %.2fs", task, e, attempt + 1, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    def stream(self, func, task=None):
+        """
+        Yields the chunks of `func()` (a streaming call) under the limits.
+
+        The call is retried only until its first chunk arrived; later failures
+        are raised, since the client already received part of the text.
+        """
+        attempt = 0
+        while True:
+            started = False
+            try:
+                with self.slot(task):
+                    for chunk in func():
+                        started = True
+                        yield chunk
+                return
+            except RETRYABLE_ERRORS as e:
+                if started or self._give_up(attempt, e):
+                    raise
+                delay = self.backoff(attempt, e)
+                logger.warning("Model stream (%s) failed: %s; retry %d in %.2fs", task, e, attempt + 1, delay)
+                time.sleep(delay)
+                attempt += 1
+
+    async def astream(self, func, task=None):
+        """Async version of stream(); `func()` returns an async iterator."""
+        attempt = 0
+        while True:
+            started = False
+            try:
+                async with self.aslot(task):
+                    async for chunk in func():
+                        started = True
+                        yield chunk
+                return
+            except RETRYABLE_ERRORS as e:
+                if started or self._give_up(attempt, e):
+                    raise
+                delay = self.backoff(attempt, e)
+                logger.warning("Model stream (%s) failed: %s; retry %d in %.2fs", task, e, attempt + 1, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+
+class ScheduledBackend(LLMBackend):
+    """Wraps a backend so that all its calls go through a CallScheduler."""
+
+    def __init__(self, backend, scheduler):
+        super().__init__(model=backend.model)
+        self.backend = backend
+        self.scheduler = scheduler
+
+    def create_context(self, text, model=None, ttl=None):
+        # Creating a provider-side cache is a model API call too
+        return self.scheduler.call(lambda: self.backend.create_context(text, model=model, ttl=ttl), 'context')
+
+    async def acreate_context(self, text, model=None, ttl=None):
+        return await self.scheduler.acall(
+            lambda: self.backend.acreate_context(text, model=model, ttl=ttl), 'context'
+        )
+
+    def generate(self, prompt, task=None, model=None, response_schema=None, context=None):
+        return self.scheduler.call(
+            lambda: self.backend.generate(
+                prompt, task=task, model=model, response_schema=response_schema, context=context
+            ), task
+        )
+
+    async def agenerate(self, prompt, task=None, model=None, response_schema=None, context=None):
+        return await self.scheduler.acall(
+            lambda: self.backend.agenerate(
+                prompt, task=task, model=model, response_schema=response_schema, context=context
+            ), task
+        )
+
+    def stream(self, prompt, task=None, model=None, context=None):
+        return self.scheduler.stream(
+            lambda: self.backend.stream(prompt, task=task, model=model, context=context), task
+        )
+
+    def astream(self, prompt, task=None, model=None, context=None):
+        return self.scheduler.astream(
+            lambda: self.backend.astream(prompt, task=task, model=model, context=context), task
+        )
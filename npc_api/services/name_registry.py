@@ -0,0 +1,109 @@
+import re
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import Value
+from django.db.models.functions import Lower
+
+from npc_api.models import Character
+from npc_api.services.llm_backend import NameCollisionError
+
+
+class NameRegistry:
+    """
+    Character names already used in a story, backed by the Character table.
+
+    Names are compared case-insensitively, like the (story, LOWER(name)) unique
+    constraint. A name is checked with an indexed lookup on that constraint,
+    and against the names claimed through this registry, so the names of the
+    story are never loaded in full. The prompt only gets a bounded
+    sample of the most recent names. `claim()` is thread-safe, so one registry
+    can be shared by the concurrent calls of a batch.
+    """
+
+    def __init__(self, story=None, recent=()):
+        self.story = story
+        self._recent = list(recent)
+        self._claimed = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(name):
+        """Collapses whitespace and lower-cases, as the case-insensitive unique constraint compares names."""
+        return re.sub(r"\s+", " ", str(name)).strip().lower()
+
+    def _taken(self, name):
+        """
+        The characters of the story with the name in any case, through the
+        (story, LOWER(name)) unique index; the database lower-cases both sides.
+        """
+        name = re.sub(r"\s+", " ", str(name)).strip()
+        return Character.objects.filter(story=self.story).alias(lower_name=Lower('name')).filter(
+            lower_name=Lower(Value(name))
+        )
+
+    @classmethod
+    def _recent_names(cls, story):
+        return Character.objects.filter(story=story).order_by('-created_at', '-id').values_list(
+            'name', flat=True
+        )[:settings.NAME_REGISTRY_PROMPT_SAMPLE]
+
+    @classmethod
+    def for_story(cls, story):
+        return cls(story, cls._recent_names(story))
+
+    @classmethod
+    async def afor_story(cls, story):
+        return cls(story, [name async for name in cls._recent_names(story)])
+
+    def _add(self, name):
+        """Registers a name free in the database, unless claimed meanwhile."""
+        with self._lock:
+            key = self.normalize(name)
+            if key in self._claimed:
+                return False
+            self._claimed.add(key)
+            self._recent.insert(0, name)
+            return True
+
+    def _claimed_before(self, name):
+        with self._lock:
+            return self.normalize(name) in self._claimed
+
+    def claim(self, name):
+        """Registers the name; returns False if it is already taken."""
+        if self._claimed_before(name):
+            return False
+        if self.story is not None and self._taken(name).exists():
+            return False
+        return self._add(name)
+
+    async def aclaim(self, name):
+        """Async version of claim()."""
+        if self._claimed_before(name):
+            return False
+        if self.story is not None and await self._taken(name).aexists():
+            return False
+        return self._add(name)
+
+    def sample(self, size=None):
+        """The most recently used names, at most `size` (settings.NAME_REGISTRY_PROMPT_SAMPLE)."""
+        size = settings.NAME_REGISTRY_PROMPT_SAMPLE if size is None else size
+        with self._lock:
+            return self._recent[:size]
+
+
+@contextmanager
+def unique_names():
+    """
+    Turns a violated (story, LOWER(name)) constraint into a NameCollisionError (a 409).
+
+    Wraps the insert of generated characters: a concurrent request can take a
+    name between the registry's check and the insert.
+    """
+    try:
+        yield
+    except IntegrityError as e:
+        raise NameCollisionError(f"Could not save the character, the name was taken meanwhile: {e}") from e
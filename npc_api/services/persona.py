@@ -0,0 +1,83 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+from npc_api.services import alignment, prompts
+
+# How the persona describes each alignment (Character.alignment)
+PERSONALITY_TYPES = {
+    alignment.GOOD: "good, helpful, and friendly",
+    alignment.EVIL: "malicious, selfish, and suspicious",
+    alignment.NEUTRAL: "guarded, pragmatic, and even-tempered",
+}
+
+
+def cache_key(character_id):
+    return f"npc_api:persona:{character_id}"
+
+
+def render_persona(character):
+    """The static part of the talk prompt for the character."""
+    return prompts.PERSONA.render(
+        name=character.name,
+        faction=character.faction,
+        profession=character.profession,
+        personality=character.personality_traits,
+        background=character.background,
+        personality_type=PERSONALITY_TYPES[character.alignment],
+    )
+
+
+def persona_version(character):
+    """Hash of the fields the persona is built from, so an entry never outlives an edit."""
+    fields = (character.name, character.faction, character.profession, repr(character.personality_traits),
+              character.background, character.alignment)
+    return hashlib.sha256('|'.join(fields).encode('utf-8')).hexdigest()
+
+
+def _valid_context(entry, character, model):
+    """The PromptContext of a cache entry, or None if missing, stale or expired."""
+    if entry is None or entry['version'] != persona_version(character):
+        return None
+    context = entry['context']
+    if context.model != model or context.expired:
+        return None
+    return context
+
+
+def _entry(character, context):
+    return {'version': persona_version(character), 'context': context}
+
+
+def get_persona(character, backend, model=None):
+    """
+    Returns the character's persona as a PromptContext of the backend.
+
+    The context is built once per character version and model and kept in the
+    default cache, so repeated turns neither render the persona again nor
+    register it with the provider again.
+    """
+    model = model or backend.model
+    key = cache_key(character.pk)
+    context = _valid_context(cache.get(key), character, model)
+    if context is None:
+        context = backend.create_context(render_persona(character), model=model)
+        cache.set(key, _entry(character, context), timeout=settings.PERSONA_CACHE_TIMEOUT)
+    return context
+
+
+async def aget_persona(character, backend, model=None):
+    """Async version of get_persona()."""
+    model = model or backend.model
+    key = cache_key(character.pk)
+    context = _valid_context(await cache.aget(key), character, model)
+    if context is None:
+        context = await backend.acreate_context(render_persona(character), model=model)
+        await cache.aset(key, _entry(character, context), timeout=settings.PERSONA_CACHE_TIMEOUT)
+    return context
+
+
+def invalidate_persona(character_id):
+    """Drops the cached persona; a provider-side cache of it expires on its own."""
+    cache.delete(cache_key(character_id))
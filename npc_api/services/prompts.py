@@ -0,0 +1,215 @@
+import logging
+import math
+import re
+import textwrap
+from string import Template
+
+from django.conf import settings
+
+from npc_api import metrics
+
+logger = logging.getLogger(__name__)
+
+# Rough size of a token in characters for English prose; good enough to budget
+# prompts without calling the provider's tokenizer
+CHARS_PER_TOKEN = 4
+
+TRUNCATION_MARK = " [...]"
+
+# Field names of every template, by template name
+FIELDS = {}
+
+
+def estimate_tokens(text):
+    """Estimated number of tokens in the text."""
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def truncate_to_tokens(text, max_tokens, keep_end=False):
+    """
+    Cuts the text to about `max_tokens` tokens at a word boundary, marking the cut.
+
+    The beginning of the text is kept, or its end with `keep_end` (e.g. for a
+    transcript, whose latest messages matter most).
+    """
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+    size = max_chars - len(TRUNCATION_MARK)
+    if keep_end:
+        cut = text[-size:]
+        if ' ' in cut:
+            cut = cut.split(' ', 1)[1]
+        return TRUNCATION_MARK.lstrip() + ' ' + cut.lstrip()
+    cut = text[:size]
+    if ' ' in cut:
+        cut = cut.rsplit(' ', 1)[0]
+    return cut.rstrip() + TRUNCATION_MARK
+
+
+def normalize_whitespace(text):
+    """Dedents the template, strips every line and keeps at most one blank line in a row."""
+    lines = [line.strip() for line in textwrap.dedent(text).strip().splitlines()]
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines))
+
+
+class PromptTemplate:
+    """
+    A prompt compiled once at import: whitespace-normalized `string.Template` text.
+
+    `render()` truncates the fields that have a token budget, either a default
+    from `budgets` or a "<template>.<field>" entry of settings.PROMPT_FIELD_BUDGETS,
+    and records the estimated size of the prompt in the `prompt_tokens` metric.
+    Fields in `keep_end` lose their beginning instead of their end.
+    """
+
+    def __init__(self, name, text, budgets=None, keep_end=()):
+        self.name = name
+        self.template = Template(normalize_whitespace(text))
+        self.budgets = budgets or {}
+        self.keep_end = frozenset(keep_end)
+        FIELDS.setdefault(name, set()).update(self.template.get_identifiers())
+
+    def budget(self, field):
+        return settings.PROMPT_FIELD_BUDGETS.get(f"{self.name}.{field}", self.budgets.get(field))
+
+    def render(self, **values):
+        for field, value in values.items():
+            budget = self.budget(field)
+            if budget:
+                values[field] = truncate_to_tokens(str(value), budget, keep_end=field in self.keep_end)
+        # Collapse the blank lines left by empty optional fields
+        prompt = re.sub(r"\n{3,}", "\n\n", self.template.substitute(values)).strip()
+        metrics.observe('prompt_tokens', estimate_tokens(prompt), template=self.name)
+        return prompt
+
+
+SUMMARY = PromptTemplate('summary', """
+    Analyze this story and create a detailed summary with key elements such as world, factions, cultures,
+    history, and other important details that will help in character generation:
+
+    $story
+""", budgets={'story': 200000})
+
+QUESTION_STORY = PromptTemplate('question', """
+    Story:
+
+    $story
+
+    Question: $question
+""", budgets={'story': 200000, 'question': 100})
+
+QUESTION_EXCERPTS = PromptTemplate('question', """
+    Story excerpts relevant to the question:
+
+    $excerpts
+
+    Question: $question
+""", budgets={'excerpts': 4000, 'question': 100})
+
+NAME = PromptTemplate('name', """
+    Based on the story world below and the user's request, generate a unique name that fits the world for a character.
+
+    World summary:
+    $story_summary
+
+    User request: $request
+
+    Previously generated names (avoid them): $avoid_names
+
+    Return only the character name, nothing else.
+""", budgets={'story_summary': 1500, 'avoid_names': 300})
+
+DETAILS = PromptTemplate('details', """
+    Create detailed attributes for the character "$name" that are consistent with the story world.
+
+    World summary:
+    $story_summary
+
+    User request (if any): $request
+
+    Generate a JSON object with the following fields:
+    - name: Character's name
+    - faction: Which faction of the world they belong to
+    - profession: Their occupation or role
+    - personality_traits: Array of 2-4 personality traits
+    - background: Brief history (1-2 sentences)
+
+    Return only valid JSON, nothing else.
+""", budgets={'story_summary': 1500})
+
+CHARACTER = PromptTemplate('character', """
+    Based on the story world below and the user's request, create a new character
+    with a unique name that fits the world, consistent with the story world.
+
+    World summary:
+    $story_summary
+
+    User request (if any): $request
+
+    Previously generated names (avoid them): $avoid_names
+
+    Fill in: name, faction (which faction of the world they belong to), profession
+    (their occupation or role), personality_traits (2-4 traits) and background
+    (brief history, 1-2 sentences).
+""", budgets={'story_summary': 1500, 'avoid_names': 300})
+
+CHARACTER_RETRY = PromptTemplate('character_retry', """
+    Create a valid JSON object for the character "$name". Return only clean JSON:
+    {
+      "name": "character name",
+      "faction": "faction",
+      "profession": "occupation",
+      "personality_traits": ["trait1", "trait2"],
+      "background": "background story"
+    }
+""")
+
+# Static part of the talk prompt, cached per character (npc_api.services.persona)
+PERSONA = PromptTemplate('persona', """
+    Assume the role of a character with the following traits:
+    - Name: $name
+    - Faction: $faction
+    - Profession: $profession
+    - Personality: $personality
+    - Background: $background
+
+    Your character has a $personality_type personality.
+
+    Respond as this character, maintaining their unique character and manner of speaking.
+    The response should be short (2-3 sentences) and fully reflect the character's personality.
+""", budgets={'background': 300})
+
+# Part of the talk prompt that changes every turn, sent after the persona
+TALK = PromptTemplate('talk', """
+    $memory
+
+    The user wrote to you: "$message"
+""", budgets={'memory': 1500, 'message': 500}, keep_end=['memory'])
+
+MEMORY = PromptTemplate('memory', """
+    You keep the memory of $name, a character in a role-playing game.
+    Update the summary of their conversation with the user with the new messages below.
+    Keep facts, promises, names and the user's requests; drop small talk.
+    Answer with the updated summary only, at most 150 words.
+
+    Current summary:
+    $summary
+
+    New messages:
+    $transcript
+""", budgets={'summary': 400, 'transcript': 4000})
+
+
+def unknown_field_budgets():
+    """The keys of settings.PROMPT_FIELD_BUDGETS that name no field of a template, e.g. typos."""
+    return sorted(
+        key for key in settings.PROMPT_FIELD_BUDGETS
+        if key.partition('.')[2] not in FIELDS.get(key.partition('.')[0], ())
+    )
+
+
+def warn_unknown_field_budgets():
+    """Logs the budgets that would be silently ignored; called once at startup."""
+    for key in unknown_field_budgets():
+        logger.warning("PROMPT_FIELD_BUDGETS has no template field %r; the budget is ignored", key)
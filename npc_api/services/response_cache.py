@@ -0,0 +1,115 @@
+import hashlib
+import re
+import threading
+from collections import Counter
+
+from django.core.cache import caches
+
+HIT = 'HIT'
+MISS = 'MISS'
+BYPASS = 'BYPASS'
+
+CACHE_ALIAS = 'llm_responses'
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def normalize_text(text):
+    """Case-folds the text, collapses whitespace and drops trailing punctuation."""
+    return re.sub(r"\s+", " ", text.casefold()).strip().rstrip("?!. ")
+
+
+def cache_stats():
+    """Per-endpoint hit/miss/bypass counters of this process."""
+    with _stats_lock:
+        stats = {}
+        for (endpoint, status), count in _stats.items():
+            stats.setdefault(endpoint, {HIT: 0, MISS: 0, BYPASS: 0})[status] = count
+        return stats
+
+
+class ResponseCache:
+    """
+    Cache of LLM responses for one endpoint, backed by Django's cache framework.
+
+    Entries are keyed by (story content hash, normalized text, model); the TTL and
+    the LRU size limit come from the `llm_responses` entry of settings.CACHES.
+    With `bypass` set, the cache is not read, but the fresh response is stored.
+    """
+
+    def __init__(self, endpoint, bypass=False):
+        self.endpoint = endpoint
+        self.bypass = bypass
+        self.cache = caches[CACHE_ALIAS]
+        self.status = None
+
+    @classmethod
+    def for_request(cls, request, endpoint):
+        """Builds the cache for a view; `Cache-Control: no-cache` or `X-NPC-Cache: bypass` opt out."""
+        bypass = (
+            'no-cache' in request.headers.get('Cache-Control', '')
+            or request.headers.get('X-NPC-Cache', '').lower() == 'bypass'
+        )
+        return cls(endpoint, bypass=bypass)
+
+    def make_key(self, content_hash, text, model):
+        digest = hashlib.sha256(f"{content_hash}|{normalize_text(text)}|{model}".encode('utf-8')).hexdigest()
+        return f"{self.endpoint}:{digest}"
+
+    def _record(self, status):
+        self.status = status
+        with _stats_lock:
+            _stats[(self.endpoint, status)] += 1
+
+    def get(self, key, accept=None):
+        """
+        Returns the cached response or None, recording a hit, miss or bypass.
+
+        A cached response for which `accept` returns False counts as a miss.
+        """
+        if self.bypass:
+            self._record(BYPASS)
+            return None
+        value = self.cache.get(key)
+        if value is not None and accept is not None and not accept(value):
+            value = None
+        self._record(MISS if value is None else HIT)
+        return value
+
+    async def aget(self, key, accept=None):
+        """Async version of get(); `accept` returns an awaitable."""
+        if self.bypass:
+            self._record(BYPASS)
+            return None
+        value = await self.cache.aget(key)
+        if value is not None and accept is not None and not await accept(value):
+            value = None
+        self._record(MISS if value is None else HIT)
+        return value
+
+    def set(self, key, value):
+        self.cache.set(key, value)
+
+    async def aset(self, key, value):
+        await self.cache.aset(key, value)
+
+    def get_or_set(self, key, compute, accept=None):
+        """
+        Returns the cached response, or computes and stores it. Nothing is stored if `compute` raises.
+
+        A cached response rejected by `accept` is replaced by a computed one.
+        """
+        value = self.get(key, accept)
+        if value is None:
+            value = compute()
+            self.set(key, value)
+        return value
+
+    async def aget_or_set(self, key, compute, accept=None):
+        """Async version of get_or_set(); `compute` and `accept` return awaitables."""
+        value = await self.aget(key, accept)
+        if value is None:
+            value = await compute()
+            await self.aset(key, value)
+        return value
@@ -0,0 +1,134 @@
+import asyncio
+import hashlib
+import threading
+from collections import Counter
+from concurrent.futures import Future
+
+from npc_api.services.llm_backend import LLMBackend
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls into one.
+
+    The first caller of a key (the leader) runs the call; callers arriving while
+    it is in flight wait for its result (or exception) instead of starting their
+    own. Threads and coroutines on any event loop share the same flights. Once a
+    call finishes its key is forgotten, so later callers run it again.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._stats = Counter()
+
+    def _join(self, key):
+        """Returns (future, is_leader) for the key."""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self._stats['shared'] += 1
+                return future, False
+            future = self._calls[key] = Future()
+            self._stats['calls'] += 1
+            return future, True
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            self._calls.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, func):
+        """Returns `func()`, shared with the concurrent callers of the same key."""
+        future, is_leader = self._join(key)
+        if is_leader:
+            try:
+                result = func()
+            except BaseException as e:
+                self._finish(key, future, error=e)
+                raise
+            self._finish(key, future, result=result)
+            return result
+        return future.result()
+
+    async def ado(self, key, func):
+        """
+        Async version of do(); `func()` returns an awaitable.
+
+        The leader's call runs as a separate task, so cancelling any caller,
+        the leader included, does not cancel the call the others wait for.
+        """
+        future, is_leader = self._join(key)
+        if is_leader:
+            task = asyncio.ensure_future(func())
+
+            def finish(task):
+                if task.cancelled():
+                    self._finish(key, future, error=asyncio.CancelledError())
+                elif task.exception() is not None:
+                    self._finish(key, future, error=task.exception())
+                else:
+                    self._finish(key, future, result=task.result())
+
+            task.add_done_callback(finish)
+        return await asyncio.shield(asyncio.wrap_future(future))
+
+    def stats(self):
+        """Number of calls run (`calls`) and of callers that shared one (`shared`)."""
+        with self._lock:
+            return {'calls': self._stats['calls'], 'shared': self._stats['shared'], 'in_flight': len(self._calls)}
+
+
+class CoalescingBackend(LLMBackend):
+    """
+    Wraps a backend so that identical concurrent calls of the given tasks share one request.
+
+    Calls are identical when task, model, response schema, context and prompt
+    are equal (compared by hash). Streaming calls are not coalesced.
+    """
+
+    def __init__(self, backend, flights, tasks):
+        super().__init__(model=backend.model)
+        self.backend = backend
+        self.flights = flights
+        self.tasks = frozenset(tasks)
+
+    def _key(self, prompt, task, model, response_schema, context):
+        context_text = context.text if context is not None else ''
+        digest = hashlib.sha256(
+            f"{task}|{model or self.model}|{response_schema!r}|{context_text}|{prompt}".encode('utf-8')
+        ).hexdigest()
+        return f"{task}:{digest}"
+
+    def create_context(self, text, model=None, ttl=None):
+        return self.backend.create_context(text, model=model, ttl=ttl)
+
+    def acreate_context(self, text, model=None, ttl=None):
+        return self.backend.acreate_context(text, model=model, ttl=ttl)
+
+    def generate(self, prompt, task=None, model=None, response_schema=None, context=None):
+        def call():
+            return self.backend.generate(prompt, task=task, model=model, response_schema=response_schema,
+                                         context=context)
+
+        if task not in self.tasks:
+            return call()
+        return self.flights.do(self._key(prompt, task, model, response_schema, context), call)
+
+    async def agenerate(self, prompt, task=None, model=None, response_schema=None, context=None):
+        def call():
+            return self.backend.agenerate(prompt, task=task, model=model, response_schema=response_schema,
+                                          context=context)
+
+        if task not in self.tasks:
+            return await call()
+        return await self.flights.ado(self._key(prompt, task, model, response_schema, context), call)
+
+    def stream(self, prompt, task=None, model=None, context=None):
+        return self.backend.stream(prompt, task=task, model=model, context=context)
+
+    def astream(self, prompt, task=None, model=None, context=None):
+        return self.backend.astream(prompt, task=task, model=model, context=context)
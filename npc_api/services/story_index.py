@@ -0,0 +1,178 @@
+import math
+import re
+import threading
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+
+from npc_api.models import Story, StoryChunk
+
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+STOP_WORDS = frozenset("""
+a an and are as at be but by for from has have he her his i in is it its of on or she that the their them
+they this to was were what which who will with you your about into than then there these those do does did
+""".split())
+
+# BM25 parameters
+K1 = 1.5
+B = 0.75
+
+
+def tokenize(text):
+    """Lowercase word tokens of the text, without stop words."""
+    return [token for token in TOKEN_RE.findall(text.lower()) if token not in STOP_WORDS]
+
+
+def split_into_chunks(content, chunk_words=None):
+    """
+    Splits story content into passages of about `chunk_words` words.
+
+    Paragraphs (separated by blank lines) are kept together and merged until the
+    limit is reached; paragraphs longer than the limit are split by words.
+    """
+    chunk_words = chunk_words or settings.STORY_INDEX_CHUNK_WORDS
+    chunks, current, current_words = [], [], 0
+
+    for paragraph in re.split(r"\n\s*\n", content or ''):
+        words = paragraph.split()
+        if not words:
+            continue
+
+        if current and current_words + len(words) > chunk_words:
+            chunks.append("\n\n".join(current))
+            current, current_words = [], 0
+
+        text = paragraph.strip()
+        if len(words) > chunk_words:
+            while len(words) > chunk_words:
+                chunks.append(" ".join(words[:chunk_words]))
+                words = words[chunk_words:]
+            text = " ".join(words)
+
+        current.append(text)
+        current_words += len(words)
+
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def build_story_index(story):
+    """
+    Brings the persisted chunk index of the story up to date with its content.
+
+    The rebuild is incremental: chunks whose text did not change keep their row
+    and term statistics (only their position is updated), removed chunks are
+    deleted and only new chunks are tokenized and inserted. The story row is
+    locked while the chunks are read and rewritten, so concurrent rebuilds run
+    one after the other and the second one finds the index up to date.
+    """
+    if story.index_content_hash == story.content_hash and story.chunks.exists():
+        return
+
+    with transaction.atomic():
+        locked = Story.objects.select_for_update().only('content', 'index_content_hash').get(pk=story.pk)
+        content_hash = locked.content_hash
+        if locked.index_content_hash == content_hash and locked.chunks.exists():
+            story.index_content_hash = content_hash
+            return
+
+        texts = split_into_chunks(locked.content)
+        existing, highest = {}, -1
+        for chunk in locked.chunks.only('content_hash', 'position'):
+            existing.setdefault(chunk.content_hash, []).append(chunk)
+            highest = max(highest, chunk.position)
+
+        kept, moved, created = set(), [], []
+        for position, text in enumerate(texts):
+            chunk_hash = Story.hash_content(text)
+            candidates = existing.get(chunk_hash)
+            if candidates:
+                chunk = candidates.pop()
+                kept.add(chunk.pk)
+                if chunk.position != position:
+                    chunk.position = position
+                    moved.append(chunk)
+                continue
+
+            tokens = tokenize(text)
+            created.append(StoryChunk(
+                story=locked,
+                position=position,
+                text=text,
+                content_hash=chunk_hash,
+                term_frequencies=dict(Counter(tokens)),
+                length=len(tokens),
+            ))
+
+        locked.chunks.exclude(pk__in=kept).delete()
+        if moved:
+            # Park the moved chunks past every stored position first: (story, position) is unique
+            offset = highest + 1
+            for chunk in moved:
+                chunk.position += offset
+            StoryChunk.objects.bulk_update(moved, ['position'])
+            for chunk in moved:
+                chunk.position -= offset
+            StoryChunk.objects.bulk_update(moved, ['position'])
+        StoryChunk.objects.bulk_create(created)
+        Story.objects.filter(pk=story.pk).update(index_content_hash=content_hash)
+    story.index_content_hash = content_hash
+
+
+class StoryIndex:
+    """In-memory BM25 index over the persisted chunks of one story version."""
+
+    _cache = OrderedDict()
+    _cache_lock = threading.Lock()
+    cache_size = 32
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.average_length = (sum(chunk.length for chunk in chunks) / len(chunks)) if chunks else 0
+        document_frequency = Counter()
+        for chunk in chunks:
+            document_frequency.update(chunk.term_frequencies.keys())
+        total = len(chunks)
+        self.idf = {
+            term: math.log(1 + (total - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in document_frequency.items()
+        }
+
+    @classmethod
+    def for_story(cls, story):
+        """Returns the index of the story's current content, building it on first use."""
+        key = (story.pk, story.content_hash)
+        with cls._cache_lock:
+            index = cls._cache.get(key)
+            if index is not None:
+                cls._cache.move_to_end(key)
+                return index
+
+        build_story_index(story)
+        index = cls(list(story.chunks.only('position', 'text', 'term_frequencies', 'length')))
+
+        with cls._cache_lock:
+            cls._cache[key] = index
+            while len(cls._cache) > cls.cache_size:
+                cls._cache.popitem(last=False)
+        return index
+
+    def score(self, chunk, terms):
+        score = 0.0
+        length_norm = K1 * (1 - B + B * chunk.length / (self.average_length or 1))
+        for term in terms:
+            frequency = chunk.term_frequencies.get(term)
+            if frequency:
+                score += self.idf[term] * frequency * (K1 + 1) / (frequency + length_norm)
+        return score
+
+    def search(self, query, top_k=None):
+        """Returns the `top_k` passages most relevant to the query, in story order."""
+        top_k = top_k or settings.STORY_INDEX_TOP_K
+        terms = set(tokenize(query))
+        scored = [(self.score(chunk, terms), chunk) for chunk in self.chunks]
+        best = sorted(scored, key=lambda item: (-item[0], item[1].position))[:top_k]
+        return [chunk.text for _, chunk in sorted(best, key=lambda item: item[1].position)]
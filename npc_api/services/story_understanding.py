@@ -1,16 +1,31 @@
-import os
-from google import genai
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from npc_api.models import Story
+from npc_api.services import prompts
+from npc_api.services.llm_backend import get_backend
+from npc_api.services.story_index import StoryIndex
 
 
 class StoryUnderstanding:
-    def __init__(self, story_content=None, story_file_path=None, api_key=None):
-        """Initialization with story text or file path."""
+    def __init__(self, story_content=None, story_file_path=None, api_key=None, story=None, backend=None,
+                 response_cache=None):
+        """
+        Initialization with a Story object, story text or file path.
 
-        self.api_key = api_key or os.environ.get("GEMINI_API_KEY")
-        self.client = genai.Client(api_key=self.api_key)
+        When a Story object is given, the summary is read from (and saved to) the
+        database, so a story is summarized once per content version. The summary
+        is generated lazily, on first access to `story_summary`.
+        `backend` defaults to the LLM backend configured in settings. Answers are
+        cached in `response_cache` (a ResponseCache) when one is given.
+        """
 
-        if story_content:
+        self.backend = backend or get_backend(api_key=api_key)
+        self.story = story
+        self.response_cache = response_cache
+
+        if story is not None:
+            self.story_content = story.content
+        elif story_content:
             self.story_content = story_content
         elif story_file_path:
             self.story_content = self._load_story(story_file_path)
@@ -18,38 +33,155 @@ class StoryUnderstanding:
             # Load from Django configuration by default
             self.story_content = self._load_story(settings.STORY_FILE_PATH)
 
-        self.model = "gemini-2.0-flash-lite"
-        self.story_summary = self._generate_summary()
+        self.model = settings.LLM_MODEL
+        self._story_summary = None
+
+    @property
+    def story_summary(self):
+        """Story summary, loaded from the Story or generated on first access."""
+
+        if self._story_summary is None:
+            self._story_summary = self._load_or_generate_summary()
+        return self._story_summary
+
+    async def aget_story_summary(self):
+        """Async version of the `story_summary` property."""
+
+        if self._story_summary is None:
+            self._story_summary = await self._aload_or_generate_summary()
+        return self._story_summary
 
     def _load_story(self, file_path):
         """Load story content from file."""
         with open(file_path, 'r', encoding='utf-8') as file:
             return file.read()
 
+    def _load_or_generate_summary(self):
+        """Return the persisted summary if it matches the content, otherwise generate and persist it."""
+
+        if self.story is not None and self.story.has_current_summary:
+            return self.story.summary
+
+        summary = self._generate_summary()
+
+        if self.story is not None:
+            self._save_summary(summary)
+        return summary
+
+    async def _aload_or_generate_summary(self):
+        """Async version of _load_or_generate_summary()."""
+
+        if self.story is not None and self.story.has_current_summary:
+            return self.story.summary
+
+        summary = await self.backend.agenerate(self._summary_prompt(), task="summary", model=self.model)
+
+        if self.story is not None:
+            await self._asave_summary(summary)
+        return summary
+
+    def _summary_queryset(self):
+        # Only write if the content was not changed in the meantime
+        return Story.objects.filter(pk=self.story.pk, content=self.story_content)
+
+    def _save_summary(self, summary):
+        """Store the summary on the Story, keyed by the hash of the summarized content."""
+
+        content_hash = Story.hash_content(self.story_content)
+        self._summary_queryset().update(summary=summary, summary_content_hash=content_hash)
+        self.story.summary = summary
+        self.story.summary_content_hash = content_hash
+
+    async def _asave_summary(self, summary):
+        content_hash = Story.hash_content(self.story_content)
+        await self._summary_queryset().aupdate(summary=summary, summary_content_hash=content_hash)
+        self.story.summary = summary
+        self.story.summary_content_hash = content_hash
+
+    def _summary_prompt(self):
+        return prompts.SUMMARY.render(story=self.story_content)
+
+    def _question_prompt(self, question):
+        """
+        Builds the question prompt. For a Story only the most relevant passages
+        from its retrieval index are sent, instead of the whole content.
+        """
+        if self.story is None:
+            return prompts.QUESTION_STORY.render(story=self.story_content, question=question)
+
+        passages = StoryIndex.for_story(self.story).search(question)
+        excerpts = "\n\n---\n\n".join(passages)
+        return prompts.QUESTION_EXCERPTS.render(excerpts=excerpts, question=question)
+
     def _generate_summary(self):
         """Generate a summary of the story for internal use."""
 
-        try:
-            prompt = (f"Analyze this story and create a detailed summary with key elements such as world,"
-                      f" factions, cultures, history, and other important details that will help in character generation:"
-                      f"\n\n{self.story_content}")
+        return self.backend.generate(self._summary_prompt(), task="summary", model=self.model)
+
+    def _answer_cache_key(self, question):
+        content_hash = self.story.content_hash if self.story is not None else Story.hash_content(self.story_content)
+        return self.response_cache.make_key(content_hash, question, self.model)
 
-            chat = self.client.chats.create(model=self.model)
-            response = chat.send_message(prompt)
+    def _generate_answer(self, question):
+        return self.backend.generate(self._question_prompt(question), task="question", model=self.model)
 
-            return response.text
-        except Exception as e:
-            return f"Error during summary generation: {str(e)}"
+    async def _agenerate_answer(self, question):
+        prompt = await sync_to_async(self._question_prompt)(question)
+        return await self.backend.agenerate(prompt, task="question", model=self.model)
 
     def answer_question(self, question):
-        """Answer questions about the story."""
+        """Answer questions about the story. Raises LLMError if the model call fails."""
+
+        if self.response_cache is None:
+            return self._generate_answer(question)
+        return self.response_cache.get_or_set(
+            self._answer_cache_key(question),
+            lambda: self._generate_answer(question)
+        )
+
+    async def aanswer_question(self, question):
+        """Async version of answer_question()."""
+
+        if self.response_cache is None:
+            return await self._agenerate_answer(question)
+        return await self.response_cache.aget_or_set(
+            self._answer_cache_key(question),
+            lambda: self._agenerate_answer(question)
+        )
+
+    def stream_answer(self, question):
+        """Stream the answer to a question about the story chunk by chunk."""
+
+        if self.response_cache is not None:
+            key = self._answer_cache_key(question)
+            cached = self.response_cache.get(key)
+            if cached is not None:
+                yield cached
+                return
+
+        chunks = []
+        for chunk in self.backend.stream(self._question_prompt(question), task="question", model=self.model):
+            chunks.append(chunk)
+            yield chunk
+
+        if self.response_cache is not None:
+            self.response_cache.set(key, ''.join(chunks))
+
+    async def astream_answer(self, question):
+        """Async version of stream_answer()."""
 
-        try:
-            prompt = f"Story:\n\n{self.story_content}\n\nQuestion: {question}"
+        if self.response_cache is not None:
+            key = self._answer_cache_key(question)
+            cached = await self.response_cache.aget(key)
+            if cached is not None:
+                yield cached
+                return
 
-            chat = self.client.chats.create(model=self.model)
-            response = chat.send_message(prompt)
+        chunks = []
+        prompt = await sync_to_async(self._question_prompt)(question)
+        async for chunk in self.backend.astream(prompt, task="question", model=self.model):
+            chunks.append(chunk)
+            yield chunk
 
-            return response.text
-        except Exception as e:
-            return f"Error while answering the question: {str(e)}"
+        if self.response_cache is not None:
+            await self.response_cache.aset(key, ''.join(chunks))
@@ -0,0 +1,20 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Character, Story
+from .services.persona import invalidate_persona
+from .services.story_index import build_story_index
+
+
+@receiver(post_save, sender=Story)
+def index_story_content(sender, instance, raw=False, **kwargs):
+    """Chunks and indexes the story when it is saved, so questions only send relevant passages."""
+    if not raw:
+        build_story_index(instance)
+
+
+@receiver(post_save, sender=Character)
+@receiver(post_delete, sender=Character)
+def invalidate_character_persona(sender, instance, **kwargs):
+    """Drops the cached persona, so the next talk turn uses the saved attributes."""
+    invalidate_persona(instance.pk)
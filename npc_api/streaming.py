@@ -0,0 +1,117 @@
+import json
+
+from django.http import StreamingHttpResponse
+from rest_framework.renderers import BaseRenderer
+
+SSE = 'sse'
+NDJSON = 'ndjson'
+
+CONTENT_TYPES = {
+    SSE: 'text/event-stream',
+    NDJSON: 'application/x-ndjson',
+}
+
+
+class EventStreamRenderer(BaseRenderer):
+    """Lets DRF content negotiation accept `Accept: text/event-stream` on streaming views."""
+    media_type = CONTENT_TYPES[SSE]
+    format = SSE
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data).encode()
+
+
+class NDJSONRenderer(BaseRenderer):
+    """Lets DRF content negotiation accept `Accept: application/x-ndjson` on streaming views."""
+    media_type = CONTENT_TYPES[NDJSON]
+    format = NDJSON
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data).encode()
+
+
+def get_stream_format(request):
+    """
+    Returns the streaming format requested by the client, or None for a plain JSON response.
+
+    Streaming is requested with `?stream=sse|ndjson` (`?stream=1` means SSE) or
+    with an Accept header of text/event-stream or application/x-ndjson.
+    """
+    value = request.GET.get('stream', '').lower()
+    if value in (SSE, NDJSON):
+        return value
+    if value in ('1', 'true'):
+        return SSE
+
+    accept = request.headers.get('Accept', '')
+    for stream_format, content_type in CONTENT_TYPES.items():
+        if content_type in accept:
+            return stream_format
+    return None
+
+
+def _encode(stream_format, payload, event=None):
+    data = json.dumps(payload)
+    if stream_format == NDJSON:
+        return f"{data}\n"
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {data}\n\n"
+
+
+def _events(chunks, stream_format, field):
+    text = []
+    try:
+        for chunk in chunks:
+            text.append(chunk)
+            yield _encode(stream_format, {'token': chunk})
+    except Exception as e:
+        yield _encode(stream_format, {'error': f"An error occurred: {str(e)}"}, event='error')
+        return
+    yield _encode(stream_format, {'done': True, field: ''.join(text)}, event='done')
+
+
+async def _aevents(chunks, stream_format, field):
+    text = []
+    try:
+        async for chunk in chunks:
+            text.append(chunk)
+            yield _encode(stream_format, {'token': chunk})
+    except Exception as e:
+        yield _encode(stream_format, {'error': f"An error occurred: {str(e)}"}, event='error')
+        return
+    yield _encode(stream_format, {'done': True, field: ''.join(text)}, event='done')
+
+
+def streaming_response(chunks, stream_format, field):
+    """
+    Wraps a (sync or async) iterator of text chunks in a streaming HTTP response.
+
+    Every chunk is sent as a `{"token": ...}` event. The stream ends with a
+    `{"done": true, <field>: <full text>}` event, or an `{"error": ...}` event
+    if generation fails midway.
+    """
+    if hasattr(chunks, '__aiter__'):
+        events = _aevents(chunks, stream_format, field)
+    else:
+        events = _events(chunks, stream_format, field)
+    return _response(events, stream_format)
+
+
+def event_stream_response(events, stream_format):
+    """Streams a (sync or async) iterator of (event name, payload) pairs, e.g. status updates of a job."""
+    if hasattr(events, '__aiter__'):
+        async def encoded():
+            async for event, payload in events:
+                yield _encode(stream_format, payload, event=event)
+
+        return _response(encoded(), stream_format)
+    return _response(
+        (_encode(stream_format, payload, event=event) for event, payload in events), stream_format
+    )
+
+
+def _response(events, stream_format):
+    response = StreamingHttpResponse(events, content_type=CONTENT_TYPES[stream_format])
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,1204 @@
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache, caches
+from django.db import OperationalError, connection, transaction
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.crypto import get_random_string
+
+from . import metrics
+from .management.commands import benchmark
+from .models import Story, Character, ConversationHistory, CharacterGenerationJob
+from .pagination import encode_cursor
+from .services.alignment import classify_alignment
+from .services.character_conversation import CharacterConversation
+from .services.character_generator import CharacterGenerator
+from .services.character_jobs import requeue_stale_jobs, run_job
+from .services.group_conversation import GroupConversation
+from .services.history_writer import HistoryWriter, conversation_rows
+from .services.instrumented_backend import InstrumentedBackend
+from .services.llm_backend import (
+    FakeBackend, GeminiBackend, LLMInvalidOutputError, LLMRateLimitError, LLMUnavailableError, NameCollisionError,
+    PromptContext, get_async_client, get_backend, get_client, reset_registry,
+)
+from .services.llm_scheduler import CallScheduler, ScheduledBackend
+from .services.name_registry import NameRegistry, unique_names
+from .services.response_cache import CACHE_ALIAS
+from .services.single_flight import CoalescingBackend, SingleFlight
+from .services.story_index import StoryIndex, build_story_index
+from .services.story_understanding import StoryUnderstanding
+from .services import history_writer, llm_backend, persona, prompts
+from .streaming import get_stream_format, streaming_response
+
+
+def create_character(story=None, **fields):
+    """Creates the test character Aria, in a new story unless one is given; `fields` override the defaults."""
+    if story is None:
+        story = Story.objects.create(title="Story", content="Content.")
+    defaults = {
+        'name': "Aria", 'faction': "Verdant Covenant", 'profession': "Herbalist",
+        'personality_traits': ["Kind"], 'background': "Raised in the Deepwoods.",
+    }
+    return Character.objects.create(story=story, **{**defaults, **fields})
+
+
+class QueryBudgetTestCase(TestCase):
+    """
+    Query-count regression tests for the list endpoints.
+
+    Every endpoint is requested with many rows in the database and must stay
+    within a fixed number of queries, independent of the number of rows.
+    """
+
+    ROWS = 30
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.stories = Story.objects.bulk_create(
+            [Story(title=f"Story {i}", content=f"Content of story {i}.") for i in range(cls.ROWS)]
+        )
+        cls.characters = Character.objects.bulk_create([
+            Character(
+                story=cls.stories[i % len(cls.stories)],
+                name=f"Character {i}",
+                faction="Verdant Covenant",
+                profession="Herbalist",
+                personality_traits=["Kind", "Honest"],
+                background="Raised in the Deepwoods.",
+            )
+            for i in range(cls.ROWS)
+        ])
+        cls.character = cls.characters[0]
+        ConversationHistory.objects.bulk_create([
+            ConversationHistory(
+                character=cls.characters[i % 3],
+                message=f"Message {i}",
+                sender_type=ConversationHistory.USER if i % 2 else ConversationHistory.CHARACTER,
+            )
+            for i in range(cls.ROWS * 3)
+        ])
+
+    def assertMaxQueries(self, budget, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(
+            len(queries), budget,
+            f"{url} ran {len(queries)} queries, budget is {budget}:\n"
+            + "\n".join(query['sql'] for query in queries.captured_queries)
+        )
+        return response
+
+    def test_story_list(self):
+        response = self.assertMaxQueries(2, '/api/stories/')
+        self.assertEqual(response.json()['count'], self.ROWS)
+
+    def test_character_list(self):
+        response = self.assertMaxQueries(2, '/api/characters/')
+        self.assertEqual(response.json()['count'], self.ROWS)
+
+    def test_conversation_list(self):
+        response = self.assertMaxQueries(2, '/api/conversations/')
+        self.assertIn('character_name', response.json()['results'][0])
+
+    def test_conversation_list_for_character(self):
+        self.assertMaxQueries(2, f'/api/conversations/?character_id={self.character.pk}')
+
+    def test_conversation_history_page(self):
+        self.assertMaxQueries(3, reverse('conversation-history-html', args=[self.character.pk]))
+
+    def test_html_lists(self):
+        for name in ('world', 'characters', 'conversation'):
+            with self.subTest(page=name):
+                self.assertMaxQueries(2, reverse(name))
+
+    def test_admin_conversation_changelist(self):
+        admin = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(admin)
+        self.assertMaxQueries(8, reverse('admin:npc_api_conversationhistory_changelist'))
+
+
+class ListRepresentationTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.stories = Story.objects.bulk_create(
+            [Story(title=f"Story {i}", content="word " * 500) for i in range(25)]
+        )
+
+    def test_story_list_is_paginated(self):
+        data = self.client.get('/api/stories/').json()
+        self.assertEqual(data['count'], 25)
+        self.assertEqual(len(data['results']), 20)
+        self.assertIsNotNone(data['next'])
+
+        data = self.client.get('/api/stories/?page_size=5').json()
+        self.assertEqual(len(data['results']), 5)
+
+    def test_story_list_omits_content(self):
+        story = self.client.get('/api/stories/').json()['results'][0]
+        self.assertNotIn('content', story)
+        self.assertIn('content', self.client.get(f'/api/stories/{story["id"]}/').json())
+
+    def test_sparse_fieldsets(self):
+        story = self.client.get('/api/stories/?fields=id,title').json()['results'][0]
+        self.assertEqual(set(story), {'id', 'title'})
+
+        story = self.client.get(f'/api/stories/{self.stories[0].pk}/?fields=id,content').json()
+        self.assertEqual(set(story), {'id', 'content'})
+
+    def test_world_page_shows_excerpt(self):
+        response = self.client.get(reverse('world'))
+        self.assertContains(response, "word " * 10)
+        self.assertNotContains(response, "word " * 131)
+
+
+class ConversationWriteTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.character = create_character()
+
+    def test_exchange_is_one_insert(self):
+        conversation = CharacterConversation(character=self.character, backend=FakeBackend())
+        with CaptureQueriesContext(connection) as queries:
+            conversation.save_conversation("Hello", "Greetings, traveller.")
+
+        inserts = [query for query in queries.captured_queries if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+        messages = list(ConversationHistory.objects.order_by('timestamp', 'id').values_list('sender_type', 'message'))
+        self.assertEqual(messages, [
+            (ConversationHistory.USER, "Hello"),
+            (ConversationHistory.CHARACTER, "Greetings, traveller."),
+        ])
+
+    def test_buffered_writer_batches_exchanges(self):
+        writer = HistoryWriter(interval=3600, batch_size=1000)
+        writer.add(conversation_rows(self.character, "Hello", "Greetings."))
+        writer.add(conversation_rows(self.character, "Bye", "Farewell."))
+        self.assertFalse(ConversationHistory.objects.exists())
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(writer.flush(), 4)
+        writer.stop()
+
+        inserts = [query for query in queries.captured_queries if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(ConversationHistory.objects.count(), 4)
+
+    def test_buffered_writer_retries_a_failed_write(self):
+        writer = HistoryWriter(interval=3600, batch_size=1000, max_retries=1)
+        self.addCleanup(writer.stop)
+        writer.add(conversation_rows(self.character, "Hello", "Greetings."))
+        with mock.patch.object(history_writer, 'write_rows', side_effect=OperationalError("database is locked")), \
+                self.assertLogs(history_writer.logger, 'WARNING'):
+            self.assertEqual(writer.flush(), 0)
+        writer.add(conversation_rows(self.character, "Bye", "Farewell."))
+
+        self.assertEqual(writer.flush(), 4)
+        messages = list(ConversationHistory.objects.order_by('timestamp', 'id').values_list('message', flat=True))
+        self.assertEqual(messages, ["Hello", "Greetings.", "Bye", "Farewell."])
+
+    def test_buffered_writer_drops_rows_after_the_retries(self):
+        writer = HistoryWriter(interval=3600, batch_size=1000, max_retries=1)
+        self.addCleanup(writer.stop)
+        writer.add(conversation_rows(self.character, "Hello", "Greetings."))
+        with mock.patch.object(history_writer, 'write_rows', side_effect=OperationalError("database is locked")), \
+                self.assertLogs(history_writer.logger, 'WARNING') as logs:
+            self.assertEqual(writer.flush(), 0)
+            self.assertEqual(writer.flush(), 0)
+        self.assertIn("dropping them", logs.output[-1])
+        self.assertEqual(writer.flush(), 0)
+        self.assertFalse(ConversationHistory.objects.exists())
+
+    def test_stream_is_saved_once_complete(self):
+        conversation = CharacterConversation(character=self.character, backend=FakeBackend())
+        interrupted = conversation.stream_response("Hello")
+        next(interrupted)
+        interrupted.close()
+        self.assertFalse(ConversationHistory.objects.exists())
+
+        text = ''.join(conversation.stream_response("Hello"))
+        self.assertEqual(ConversationHistory.objects.get(sender_type=ConversationHistory.CHARACTER).message, text)
+
+    @override_settings(CONVERSATION_SUMMARY_WORKERS=1)
+    def test_reply_does_not_wait_for_the_summary(self):
+        conversation = CharacterConversation(character=self.character, backend=FakeBackend())
+        release, updated = threading.Event(), threading.Event()
+
+        def update():
+            release.wait(5)
+            updated.set()
+
+        conversation.memory.update = update
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(conversation.generate_response("Hello"))
+        # Saved, and the summary update is still waiting in the background
+        self.assertEqual(ConversationHistory.objects.count(), 2)
+        self.assertFalse(updated.is_set())
+        release.set()
+        self.assertTrue(updated.wait(5))
+
+
+class HistoryPaginationTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.character = create_character()
+        ConversationHistory.objects.bulk_create([
+            ConversationHistory(character=cls.character, message=f"Message {i}", sender_type=ConversationHistory.USER)
+            for i in range(5)
+        ])
+        cls.ids = list(ConversationHistory.objects.order_by('timestamp', 'id').values_list('id', flat=True))
+
+    def test_api_cursor_walks_every_message_once(self):
+        url, seen = reverse('conversationhistory-list') + '?page_size=2', []
+        while url:
+            page = self.client.get(url).json()
+            seen.extend(message['id'] for message in page['results'])
+            url = page['next']
+        self.assertEqual(seen, list(reversed(self.ids)))
+
+    def test_api_rejects_garbage_cursor(self):
+        response = self.client.get(reverse('conversationhistory-list'), {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_html_after_and_before_links(self):
+        url = reverse('conversation-history-html', args=[self.character.pk])
+        page = self.client.get(url).context['conversations']
+        self.assertEqual([message.pk for message in page], self.ids[:20])
+        self.assertIsNone(page.next_cursor)
+
+        after = self.client.get(url, {'after': encode_cursor(ConversationHistory.objects.get(pk=self.ids[1]))})
+        self.assertEqual([message.pk for message in after.context['conversations']], self.ids[2:])
+        self.assertContains(after, '?before=')
+
+        cursor = after.context['conversations'].previous_cursor
+        before = self.client.get(url, {'before': cursor})
+        self.assertEqual([message.pk for message in before.context['conversations']], self.ids[:2])
+        self.assertContains(before, '?after=')
+
+    def test_html_ignores_garbage_cursor(self):
+        url = reverse('conversation-history-html', args=[self.character.pk])
+        for params in ({'after': 'garbage'}, {'before': '12-x'}, {'after': '99999999999999999999999-1'}):
+            with self.subTest(params=params):
+                response = self.client.get(url, params)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual([message.pk for message in response.context['conversations']], self.ids)
+
+
+class RequeueingBackend(FakeBackend):
+    """Recovers the stale jobs during the character calls, as a worker process starting meanwhile would."""
+
+    requeued = []
+
+    def generate(self, prompt, task=None, model=None, response_schema=None, context=None):
+        if task == 'character':
+            self.requeued.append(requeue_stale_jobs())
+        return super().generate(prompt, task=task, model=model, response_schema=response_schema, context=context)
+
+
+@override_settings(LLM_BACKEND='fake', LLM_BACKEND_OPTIONS={})
+class CharacterJobTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.story = Story.objects.create(title="Story", content="The Verdant Covenant guards the Deepwoods.")
+
+    def test_job_is_queued_and_completed(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(
+                reverse('generate-character-job', args=[self.story.pk]),
+                {'request': 'A healer'}, content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['status'], CharacterGenerationJob.PENDING)
+        self.assertEqual(len(callbacks), 1)
+
+        # Run the job in this thread instead of the worker pool
+        run_job(response.json()['id'])
+
+        job = self.client.get(response['Location']).json()
+        self.assertEqual(job['status'], CharacterGenerationJob.SUCCEEDED)
+        self.assertEqual(job['character']['story'], self.story.pk)
+
+        events = b''.join(self.client.get(response['Location'] + '?stream=ndjson').streaming_content)
+        self.assertIn(b'"done": true', events)
+
+    def test_job_runs_once(self):
+        job = CharacterGenerationJob.objects.create(story=self.story, request='A healer')
+        run_job(job.pk)
+        run_job(job.pk)
+        self.assertEqual(Character.objects.filter(story=self.story).count(), 1)
+
+    @override_settings(CHARACTER_JOB_STALE_AFTER=600)
+    def test_stale_running_job_is_requeued(self):
+        running = CharacterGenerationJob.objects.create(story=self.story, request='A healer',
+                                                        status=CharacterGenerationJob.RUNNING)
+        stale = CharacterGenerationJob.objects.create(story=self.story, request='A smith',
+                                                      status=CharacterGenerationJob.RUNNING)
+        CharacterGenerationJob.objects.filter(pk=stale.pk).update(updated_at=timezone.now() - timedelta(hours=1))
+
+        self.assertEqual(requeue_stale_jobs(), 1)
+        run_job(stale.pk)
+        run_job(running.pk)
+        running.refresh_from_db()
+        stale.refresh_from_db()
+        self.assertEqual(running.status, CharacterGenerationJob.RUNNING)
+        self.assertEqual(stale.status, CharacterGenerationJob.SUCCEEDED)
+
+    @override_settings(LLM_BACKEND='npc_api.tests.RequeueingBackend', CHARACTER_JOB_STALE_AFTER=600)
+    def test_long_pending_job_is_not_requeued_while_running(self):
+        reset_registry()
+        self.addCleanup(reset_registry)
+        RequeueingBackend.requeued.clear()
+        job = CharacterGenerationJob.objects.create(story=self.story, request='A healer')
+        CharacterGenerationJob.objects.filter(pk=job.pk).update(updated_at=timezone.now() - timedelta(hours=1))
+
+        run_job(job.pk)
+        job.refresh_from_db()
+        self.assertEqual(RequeueingBackend.requeued, [0])
+        self.assertEqual(job.status, CharacterGenerationJob.SUCCEEDED)
+
+    async def test_subscription_streams_under_asgi(self):
+        job = await CharacterGenerationJob.objects.acreate(story=self.story, request='A healer')
+        url = reverse('character-job', args=[job.pk]) + '?stream=sse'
+        with override_settings(CHARACTER_JOB_STREAM_TIMEOUT=0):
+            response = await self.async_client.get(url)
+            self.assertTrue(response.is_async)
+            events = b''.join([chunk async for chunk in response.streaming_content])
+        self.assertIn(b'event: timeout', events)
+
+        await CharacterGenerationJob.objects.filter(pk=job.pk).aupdate(status=CharacterGenerationJob.FAILED)
+        response = await self.async_client.get(url)
+        events = b''.join([chunk async for chunk in response.streaming_content])
+        self.assertIn(b'event: done', events)
+
+    @override_settings(CHARACTER_JOB_STREAM_TIMEOUT=0)
+    def test_subscription_times_out_with_reconnect(self):
+        job = CharacterGenerationJob.objects.create(story=self.story, request='A healer')
+        events = b''.join(self.client.get(reverse('character-job', args=[job.pk]) + '?stream=sse').streaming_content)
+        self.assertIn(b'event: timeout', events)
+        self.assertIn(b'"reconnect": true', events)
+
+
+FIXED_CHARACTER = json.dumps({
+    "name": "Bob", "faction": "Verdant Covenant", "profession": "Herbalist",
+    "personality_traits": ["Kind"], "background": "Raised in the Deepwoods.",
+})
+
+
+@override_settings(LLM_BACKEND='fake', LLM_BACKEND_OPTIONS={'responses': {'character': FIXED_CHARACTER}},
+                   CHARACTER_NAME_RETRIES=1)
+class GenerateCharacterErrorTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.story = Story.objects.create(title="Story", content="The Verdant Covenant guards the Deepwoods.")
+
+    def setUp(self):
+        reset_registry()
+        self.addCleanup(reset_registry)
+
+    def generate(self, name='generate-character'):
+        return self.client.post(reverse(name, args=[self.story.pk]), {'request': 'A healer'},
+                                content_type='application/json')
+
+    def test_taken_name_is_answered_with_409(self):
+        self.assertEqual(self.generate().status_code, 201)
+        for name in ('generate-character', 'async-generate-character'):
+            with self.subTest(view=name):
+                response = self.generate(name)
+                self.assertEqual(response.status_code, 409)
+                self.assertIn('Bob', response.json()['error'])
+        self.assertEqual(Character.objects.filter(story=self.story).count(), 1)
+
+    @override_settings(LLM_BACKEND_OPTIONS={'responses': {'character': 'not json'}})
+    def test_invalid_output_is_answered_with_502_after_a_retry(self):
+        for name in ('generate-character', 'async-generate-character'):
+            with self.subTest(view=name):
+                response = self.generate(name)
+                self.assertEqual(response.status_code, 502)
+                self.assertIn('Invalid model output', response.json()['error'])
+        self.assertFalse(Character.objects.exists())
+
+
+@override_settings(LLM_BACKEND='fake', CHARACTER_SINGLE_CALL=False,
+                   LLM_BACKEND_OPTIONS={'responses': {'name': "Aria", 'character': FIXED_CHARACTER}})
+class TwoCallGenerationTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.story = Story.objects.create(title="Story", content="The Verdant Covenant guards the Deepwoods.")
+
+    def setUp(self):
+        reset_registry()
+        self.addCleanup(reset_registry)
+
+    def generate(self, name):
+        return self.client.post(reverse(name, args=[self.story.pk]), {'request': 'A healer'},
+                                content_type='application/json')
+
+    def test_details_keep_the_claimed_name(self):
+        for name in ('generate-character', 'async-generate-character'):
+            with self.subTest(view=name):
+                Character.objects.all().delete()
+                response = self.generate(name)
+                self.assertEqual(response.status_code, 201)
+                self.assertEqual(response.json()['name'], "Aria")
+                self.assertEqual(response.json()['background'], "Raised in the Deepwoods.")
+
+    @override_settings(LLM_BACKEND_OPTIONS={'responses': {'name': "Aria", 'character': '{"name": "Aria"}'}})
+    def test_incomplete_details_are_answered_with_502(self):
+        for name in ('generate-character', 'async-generate-character'):
+            with self.subTest(view=name):
+                response = self.generate(name)
+                self.assertEqual(response.status_code, 502)
+                self.assertIn('background', response.json()['error'])
+        self.assertFalse(Character.objects.exists())
+
+
+class NameRegistryTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.story = Story.objects.create(title="Story", content="Content.")
+        Character.objects.bulk_create([
+            Character(story=cls.story, name=f"Villager {index}", faction="Covenant", profession="Farmer",
+                      personality_traits=["Kind"], background="")
+            for index in range(30)
+        ])
+
+    @override_settings(NAME_REGISTRY_PROMPT_SAMPLE=5)
+    def test_loads_a_sample_and_checks_names_in_the_database(self):
+        with CaptureQueriesContext(connection) as queries:
+            registry = NameRegistry.for_story(self.story)
+            self.assertFalse(registry.claim("vilLAGER 3"))
+            self.assertTrue(registry.claim("Aria"))
+            self.assertFalse(registry.claim("ARIA"))
+        self.assertEqual(registry.sample(), ["Aria", "Villager 29", "Villager 28", "Villager 27", "Villager 26"])
+        # The sample, then one indexed lookup per new name
+        self.assertEqual(len(queries), 3)
+        self.assertIn('LIMIT 5', queries[0]['sql'])
+
+    def test_name_taken_meanwhile_is_a_collision(self):
+        for name in ("Villager 1", "villager 1"):
+            with self.subTest(name=name):
+                character = Character(story=self.story, name=name, faction="Covenant", profession="Farmer",
+                                      personality_traits=["Kind"], background="")
+                with self.assertRaises(NameCollisionError):
+                    with transaction.atomic(), unique_names():
+                        character.save()
+
+
+class InvalidOnceBackend(FakeBackend):
+    """Answers the first character call with invalid output."""
+
+    def _render(self, prompt, task, call, context=None):
+        if task == 'character' and call == 1:
+            return '{"name": "Half a'
+        return super()._render(prompt, task, call, context)
+
+
+@override_settings(CHARACTER_SINGLE_CALL=True)
+class InvalidOutputRetryTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        content = "The Verdant Covenant guards the Deepwoods."
+        cls.story = Story.objects.create(title="Story", content=content, summary="A forest realm.",
+                                         summary_content_hash=Story.hash_content(content))
+
+    def generator(self, backend):
+        return CharacterGenerator(StoryUnderstanding(story=self.story, backend=backend))
+
+    def test_invalid_output_is_retried(self):
+        backend = InvalidOnceBackend()
+        character = self.generator(backend).generate_character_details(request="A healer")
+        self.assertEqual(character['faction'], "Verdant Covenant")
+        self.assertEqual(backend._calls, 2)
+
+    def test_async_invalid_output_is_retried(self):
+        backend = InvalidOnceBackend()
+        character = asyncio.run(self.generator(backend).agenerate_character_details(request="A healer"))
+        self.assertEqual(character['faction'], "Verdant Covenant")
+        self.assertEqual(backend._calls, 2)
+
+    def test_second_invalid_output_raises_llm_error(self):
+        backend = FakeBackend(responses={'character': '{"name": "Bob"}'})
+        with self.assertRaises(LLMInvalidOutputError):
+            self.generator(backend).generate_character_details(request="A healer")
+        self.assertEqual(backend._calls, 2)
+
+
+class CursedRequestBackend(FakeBackend):
+    """Fails the character calls of requests mentioning a curse."""
+
+    def generate(self, prompt, task=None, model=None, response_schema=None, context=None):
+        if task == 'character' and 'cursed' in prompt:
+            raise LLMUnavailableError("Simulated outage")
+        return super().generate(prompt, task=task, model=model, response_schema=response_schema, context=context)
+
+    async def agenerate(self, prompt, task=None, model=None, response_schema=None, context=None):
+        return self.generate(prompt, task=task, model=model, response_schema=response_schema, context=context)
+
+
+@override_settings(LLM_BACKEND='npc_api.tests.CursedRequestBackend', LLM_BACKEND_OPTIONS={}, LLM_MAX_RETRIES=0)
+class GenerateCharacterBatchTestCase(TestCase):
+    VIEWS = ('generate-characters', 'async-generate-characters')
+
+    @classmethod
+    def setUpTestData(cls):
+        content = "The Verdant Covenant guards the Deepwoods."
+        cls.story = Story.objects.create(title="Story", content=content, summary="A forest realm.",
+                                         summary_content_hash=Story.hash_content(content))
+
+    def setUp(self):
+        reset_registry()
+        self.addCleanup(reset_registry)
+
+    def generate(self, view, requests):
+        return self.client.post(reverse(view, args=[self.story.pk]), {'requests': requests},
+                                content_type='application/json')
+
+    def test_partial_failure_saves_the_rest(self):
+        for view in self.VIEWS:
+            with self.subTest(view=view):
+                response = self.generate(view, ["A healer", "A cursed knight", "A smith"])
+                self.assertEqual(response.status_code, 201)
+                self.assertEqual(len(response.json()['characters']), 2)
+                self.assertEqual([error['index'] for error in response.json()['errors']], [1])
+                self.assertIn("Simulated outage", response.json()['errors'][0]['error'])
+        names = list(Character.objects.filter(story=self.story).values_list('name', flat=True))
+        self.assertEqual(len(names), 4)
+        self.assertEqual(len(set(names)), 4)
+
+    def test_nothing_created_is_an_error(self):
+        for view in self.VIEWS:
+            with self.subTest(view=view):
+                response = self.generate(view, ["A cursed knight", "A cursed queen"])
+                self.assertEqual(response.status_code, 503)
+                self.assertIn("Simulated outage", response.json()['error'])
+        self.assertFalse(Character.objects.exists())
+
+    @override_settings(LLM_BACKEND='fake', LLM_BACKEND_OPTIONS={'responses': {'character': '{"name": "Bob"}'}})
+    def test_only_unusable_output_is_502(self):
+        response = self.generate('generate-characters', ["A healer"])
+        self.assertEqual(response.status_code, 502)
+
+
+@override_settings(LLM_BACKEND='fake', LLM_BACKEND_OPTIONS={})
+class GenerateNameCacheTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.story = Story.objects.create(title="Story", content="The Verdant Covenant guards the Deepwoods.")
+
+    def setUp(self):
+        caches[CACHE_ALIAS].clear()
+        reset_registry()
+        self.addCleanup(reset_registry)
+
+    def test_cached_name_is_replaced_once_taken(self):
+        for view in ('generate-name', 'async-generate-name'):
+            with self.subTest(view=view):
+                url = reverse(view, args=[self.story.pk])
+                first = self.client.post(url, {'request': 'A healer'}, content_type='application/json')
+                second = self.client.post(url, {'request': 'A healer'}, content_type='application/json')
+                self.assertEqual(second['X-Cache'], 'HIT')
+                self.assertEqual(second.json()['name'], first.json()['name'])
+
+                create_character(self.story, name=first.json()['name'])
+                third = self.client.post(url, {'request': 'A healer'}, content_type='application/json')
+                self.assertEqual(third['X-Cache'], 'MISS')
+                self.assertNotEqual(third.json()['name'], first.json()['name'])
+
+                fourth = self.client.post(url, {'request': 'A healer'}, content_type='application/json')
+                self.assertEqual(fourth['X-Cache'], 'HIT')
+                self.assertEqual(fourth.json()['name'], third.json()['name'])
+
+
+class StorySummaryTestCase(TestCase):
+    def setUp(self):
+        self.story = Story.objects.create(title="Story", content="The Verdant Covenant guards the Deepwoods.")
+
+    def test_summary_is_generated_once_per_content(self):
+        backend = FakeBackend()
+        self.assertTrue(StoryUnderstanding(story=self.story, backend=backend).story_summary)
+        story = Story.objects.get(pk=self.story.pk)
+        self.assertTrue(story.has_current_summary)
+
+        StoryUnderstanding(story=story, backend=backend).story_summary
+        self.assertEqual(backend._calls, 1)
+
+    def test_content_change_invalidates_the_summary(self):
+        backend = FakeBackend()
+        StoryUnderstanding(story=self.story, backend=backend).story_summary
+        self.story.content = "The Iron Legion marches north."
+        self.story.save()
+        self.assertEqual(Story.objects.get(pk=self.story.pk).summary, '')
+
+        StoryUnderstanding(story=self.story, backend=backend).story_summary
+        self.assertEqual(backend._calls, 2)
+        self.assertEqual(Story.objects.get(pk=self.story.pk).summary_content_hash, self.story.content_hash)
+
+    def test_summary_is_not_saved_over_newer_content(self):
+        understanding = StoryUnderstanding(story=self.story, backend=FakeBackend())
+        Story.objects.filter(pk=self.story.pk).update(content="Rewritten meanwhile.")
+        understanding.story_summary
+        self.assertEqual(Story.objects.get(pk=self.story.pk).summary, '')
+
+    @override_settings(LLM_BACKEND='fake', LLM_BACKEND_OPTIONS={})
+    def test_questions_do_not_summarize(self):
+        reset_registry()
+        self.addCleanup(reset_registry)
+        response = self.client.post(reverse('ask-question', args=[self.story.pk]), {'question': "Who guards the woods?"},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Story.objects.get(pk=self.story.pk).summary, '')
+
+
+@override_settings(STORY_INDEX_CHUNK_WORDS=8)
+class StoryIndexTestCase(TestCase):
+    PARAGRAPHS = [
+        "The Verdant Covenant guards the Deepwoods.",
+        "Iron Legion soldiers march on the northern passes.",
+        "Merchants of Saltmere trade spices and rumours.",
+    ]
+
+    def chunks(self, story):
+        return list(story.chunks.order_by('position').values_list('position', 'text', 'id'))
+
+    def test_rebuild_keeps_unchanged_chunks(self):
+        story = Story.objects.create(title="Story", content="\n\n".join(self.PARAGRAPHS))
+        before = {text: pk for _, text, pk in self.chunks(story)}
+
+        story.content = "\n\n".join(["A dragon sleeps under the mountain.", *reversed(self.PARAGRAPHS[1:])])
+        story.save()
+
+        after = self.chunks(story)
+        self.assertEqual([text for _, text, _ in after], [
+            "A dragon sleeps under the mountain.", self.PARAGRAPHS[2], self.PARAGRAPHS[1],
+        ])
+        # Moved chunks keep their rows, the removed one is gone
+        self.assertEqual(after[1][2], before[self.PARAGRAPHS[2]])
+        self.assertEqual(after[2][2], before[self.PARAGRAPHS[1]])
+        self.assertNotIn(before[self.PARAGRAPHS[0]], [pk for _, _, pk in after])
+
+    def test_stale_rebuild_does_not_duplicate_chunks(self):
+        story = Story.objects.create(title="Story", content="\n\n".join(self.PARAGRAPHS))
+        # A concurrent request still holding the story from before the index was built
+        stale = Story.objects.get(pk=story.pk)
+        stale.index_content_hash = ''
+        build_story_index(stale)
+        self.assertEqual(story.chunks.count(), len(self.PARAGRAPHS))
+
+    def test_search_ranks_by_bm25(self):
+        story = Story.objects.create(title="Story", content="\n\n".join(self.PARAGRAPHS))
+        index = StoryIndex.for_story(story)
+        self.assertEqual(index.search("Who trades spices?", top_k=1), [self.PARAGRAPHS[2]])
+        self.assertEqual(index.search("soldiers of the legion in the north", top_k=1), [self.PARAGRAPHS[1]])
+        # The best passages, in story order
+        self.assertEqual(index.search("Deepwoods spices", top_k=2), [self.PARAGRAPHS[0], self.PARAGRAPHS[2]])
+
+
+def innermost(backend):
+    """The backend below the scheduler, coalescing and metrics wrappers."""
+    while hasattr(backend, 'backend'):
+        backend = backend.backend
+    return backend
+
+
+class BackendSelectionTestCase(SimpleTestCase):
+    def setUp(self):
+        reset_registry()
+        self.addCleanup(reset_registry)
+
+    @override_settings(LLM_BACKEND='fake', LLM_BACKEND_OPTIONS={'responses': {'talk': "Well met, traveller."}})
+    def test_short_name_selects_the_fake_backend(self):
+        backend = get_backend()
+        self.assertIsInstance(innermost(backend), FakeBackend)
+        self.assertEqual(backend.generate("Hello", task="talk"), "Well met, traveller.")
+        self.assertEqual(''.join(backend.stream("Hello", task="talk")), "Well met, traveller.")
+
+    @override_settings(LLM_BACKEND='npc_api.services.llm_backend.FakeBackend', LLM_BACKEND_OPTIONS={'latency': 0.01})
+    def test_dotted_path_and_options(self):
+        fake = innermost(get_backend())
+        self.assertIsInstance(fake, FakeBackend)
+        self.assertEqual(fake.latency, 0.01)
+        # Arguments override the configured options
+        self.assertEqual(innermost(get_backend(latency=0.02)).latency, 0.02)
+
+    @override_settings(LLM_BACKEND='gemini', LLM_BACKEND_OPTIONS={})
+    def test_gemini_backend(self):
+        self.assertIsInstance(innermost(get_backend(api_key='test-key')), GeminiBackend)
+
+    @override_settings(LLM_BACKEND='fake', LLM_BACKEND_OPTIONS={})
+    def test_services_share_the_backend(self):
+        backend = get_backend()
+        self.assertIs(StoryUnderstanding(story_content="A story.").backend, backend)
+        self.assertIs(CharacterConversation().backend, backend)
+
+
+@override_settings(LLM_BACKEND='fake', LLM_BACKEND_OPTIONS={})
+class BackendRegistryTestCase(SimpleTestCase):
+    def setUp(self):
+        reset_registry()
+        self.addCleanup(reset_registry)
+
+    def test_one_backend_per_process_and_options(self):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            backends = list(executor.map(lambda _: get_backend(), range(32)))
+        self.assertEqual(len({id(backend) for backend in backends}), 1)
+        self.assertIsNot(get_backend(latency=0.5), backends[0])
+        self.assertIs(get_backend(latency=0.5), get_backend(latency=0.5))
+
+    def test_settings_toggling_a_layer_get_their_own_backend(self):
+        backend = get_backend()
+        with override_settings(METRICS_ENABLED=False):
+            self.assertNotIsInstance(get_backend(), InstrumentedBackend)
+        self.assertIs(get_backend(), backend)
+
+    def test_reset_drops_the_instances(self):
+        backend = get_backend()
+        reset_registry()
+        self.assertIsNot(get_backend(), backend)
+
+    def test_one_client_per_api_key(self):
+        client = get_client('key-a')
+        self.assertIs(get_client('key-a'), client)
+        self.assertIsNot(get_client('key-b'), client)
+
+    def test_one_async_client_per_event_loop(self):
+        async def clients():
+            return get_async_client('key-a'), get_async_client('key-a')
+
+        first, same = asyncio.run(clients())
+        self.assertIs(same, first)
+        # async_to_sync runs every request of a WSGI server in a new loop
+        second, _ = asyncio.run(clients())
+        self.assertIsNot(second, first)
+        self.assertIsNot(second, get_client('key-a'))
+        self.assertEqual(sum(1 for key in llm_backend._registry if key[1] == 'async_client'), 1)
+
+
+class StreamingFormatTestCase(SimpleTestCase):
+    def test_format_from_query_or_accept_header(self):
+        factory = RequestFactory()
+        self.assertEqual(get_stream_format(factory.get('/?stream=ndjson')), 'ndjson')
+        self.assertEqual(get_stream_format(factory.get('/?stream=1')), 'sse')
+        self.assertEqual(get_stream_format(factory.get('/', HTTP_ACCEPT='text/event-stream')), 'sse')
+        self.assertIsNone(get_stream_format(factory.get('/')))
+
+    def test_sse_framing(self):
+        response = streaming_response(iter(["Well ", "met."]), 'sse', 'response')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(b''.join(response.streaming_content).decode(), (
+            'data: {"token": "Well "}\n\n'
+            'data: {"token": "met."}\n\n'
+            'event: done\ndata: {"done": true, "response": "Well met."}\n\n'
+        ))
+
+    def test_ndjson_framing_and_midway_error(self):
+        def chunks():
+            yield "Well "
+            raise LLMRateLimitError("Slow down")
+
+        response = streaming_response(chunks(), 'ndjson', 'response')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [
+            {'token': "Well "}, {'error': "An error occurred: Slow down"},
+        ])
+
+
+class CallSchedulerTestCase(SimpleTestCase):
+    def scheduler(self, **options):
+        options = {'max_concurrency': 4, 'task_concurrency': {}, 'rate': 0, 'base_delay': 0.001, 'max_delay': 0.001,
+                   **options}
+        return CallScheduler(**options)
+
+    def test_transient_errors_are_retried(self):
+        backend = ScheduledBackend(FakeBackend(error_rate=0.5, seed=1), self.scheduler(max_retries=10))
+        with self.assertLogs('npc_api.services.llm_scheduler', 'WARNING'):
+            for _ in range(5):
+                self.assertTrue(backend.generate("Hello", task="talk"))
+
+    def test_gives_up_with_retry_after(self):
+        backend = ScheduledBackend(FakeBackend(error_rate=1.0), self.scheduler(max_retries=2))
+        with self.assertLogs('npc_api.services.llm_scheduler', 'WARNING') as logs:
+            with self.assertRaises(LLMRateLimitError) as raised:
+                backend.generate("Hello", task="talk")
+        self.assertEqual(len(logs.records), 2)
+        self.assertTrue(raised.exception.retry_after)
+
+    def test_queued_task_does_not_hold_a_global_slot(self):
+        scheduler = self.scheduler(max_concurrency=2, task_concurrency={'summary': 1})
+        backend = ScheduledBackend(FakeBackend(latency=0.3), scheduler)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            summaries = [executor.submit(backend.generate, "Summarize", task="summary") for _ in range(2)]
+            time.sleep(0.05)
+            started = time.perf_counter()
+            backend.generate("Hello", task="talk")
+            waited = time.perf_counter() - started
+            for summary in summaries:
+                summary.result()
+        # One slot is held by the running summary, the other is free for the talk call
+        self.assertLess(waited, 0.5)
+
+
+@override_settings(LLM_BACKEND='fake', LLM_BACKEND_OPTIONS={'error_rate': 1.0}, LLM_MAX_RETRIES=0)
+class LLMErrorResponseTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.character = create_character()
+
+    def setUp(self):
+        reset_registry()
+        self.addCleanup(reset_registry)
+
+    def test_rate_limit_is_answered_with_429(self):
+        for name in ('character-talk', 'async-character-talk'):
+            with self.subTest(view=name):
+                response = self.client.post(
+                    reverse(name, args=[self.character.pk]), {'message': 'Hello'}, content_type='application/json'
+                )
+                self.assertEqual(response.status_code, 429)
+                self.assertIn('Retry-After', response)
+        self.assertFalse(ConversationHistory.objects.exists())
+
+
+@override_settings(LLM_BACKEND='fake', LLM_BACKEND_OPTIONS={})
+class AsyncViewTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.story = Story.objects.create(title="Story", content="Content.")
+        cls.user = get_user_model().objects.create_user('player', password='password')
+
+    def setUp(self):
+        reset_registry()
+        self.addCleanup(reset_registry)
+
+    def url(self, name='async-generate-name', story_id=None):
+        return reverse(name, args=[story_id or self.story.pk])
+
+    async def test_missing_story_is_404(self):
+        response = await self.async_client.post(self.url(story_id=999), {'request': 'A healer'},
+                                                content_type='application/json')
+        self.assertEqual(response.status_code, 404)
+
+    async def test_invalid_data_is_400(self):
+        response = await self.async_client.post(self.url(), {'request': ''}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('request', response.json())
+
+    async def test_malformed_json_is_400(self):
+        response = await self.async_client.post(self.url(), '{"request": ', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"error": "Malformed JSON body"})
+
+    @override_settings(LLM_BACKEND_OPTIONS={'error_rate': 1.0}, LLM_MAX_RETRIES=0)
+    async def test_llm_error_is_mapped(self):
+        response = await self.async_client.post(self.url(), {'request': 'A healer'}, content_type='application/json')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        self.assertIn('error', response.json())
+
+    def test_session_requests_need_a_csrf_token(self):
+        client = Client(enforce_csrf_checks=True)
+        # Without a session, as for DRF views, no token is needed
+        response = client.post(self.url(), {'request': 'A healer'}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+        client.force_login(self.user)
+        response = client.post(self.url(), {'request': 'A healer'}, content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+        self.assertIn('CSRF Failed', response.json()['detail'])
+
+        client.cookies['csrftoken'] = token = get_random_string(32)
+        response = client.post(self.url(), {'request': 'A healer'}, content_type='application/json',
+                               HTTP_X_CSRFTOKEN=token)
+        self.assertEqual(response.status_code, 200)
+
+
+class SingleFlightTestCase(SimpleTestCase):
+    def setUp(self):
+        self.fake = FakeBackend(latency=0.2)
+        self.backend = CoalescingBackend(self.fake, SingleFlight(), tasks=['summary'])
+
+    def test_concurrent_identical_calls_share_one_request(self):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda _: self.backend.generate("Story", task="summary"), range(8)))
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(self.fake._calls, 1)
+
+    def test_async_calls_share_one_request(self):
+        async def generate():
+            return await asyncio.gather(*(self.backend.agenerate("Story", task="summary") for _ in range(8)))
+
+        self.assertEqual(len(set(asyncio.run(generate()))), 1)
+        self.assertEqual(self.fake._calls, 1)
+
+    def test_other_tasks_are_not_coalesced(self):
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(lambda _: self.backend.generate("Hello", task="talk"), range(4)))
+        self.assertEqual(self.fake._calls, 4)
+
+
+class PromptTemplateTestCase(SimpleTestCase):
+    def render_persona(self, **values):
+        return prompts.PERSONA.render(**{
+            'name': "Aria", 'faction': "Verdant Covenant", 'profession': "Herbalist", 'personality': "Kind",
+            'background': "Raised in the Deepwoods.", 'personality_type': "good",
+            **values,
+        })
+
+    def test_whitespace_is_normalized(self):
+        prompt = self.render_persona()
+        self.assertTrue(prompt.startswith("Assume the role"))
+        self.assertNotIn("\n ", prompt)
+        self.assertNotIn("\n\n\n", prompt)
+
+    def test_fields_are_truncated_to_budget(self):
+        prompt = self.render_persona(background="word " * 5000)
+        self.assertIn(prompts.TRUNCATION_MARK, prompt)
+        self.assertLess(prompts.estimate_tokens(prompt), 600)
+
+    @override_settings(PROMPT_FIELD_BUDGETS={'persona.background': 10})
+    def test_budget_from_settings(self):
+        prompt = self.render_persona(background="word " * 100)
+        self.assertIn("word word" + prompts.TRUNCATION_MARK, prompt)
+        self.assertNotIn("word " * 10, prompt)
+
+    @override_settings(PROMPT_FIELD_BUDGETS={'persona.background': 10, 'talk.background': 10, 'tlak.memory': 10})
+    def test_unknown_budget_keys_are_reported(self):
+        self.assertEqual(prompts.unknown_field_budgets(), ['talk.background', 'tlak.memory'])
+        with self.assertLogs(prompts.logger, 'WARNING') as logs:
+            prompts.warn_unknown_field_budgets()
+        self.assertEqual(len(logs.output), 2)
+
+    def test_prompt_size_is_recorded(self):
+        metrics.reset()
+        self.render_persona()
+        histograms = metrics.snapshot()['prompt_tokens']
+        self.assertEqual([h['labels'] for h in histograms], [{'template': 'persona'}])
+        self.assertEqual(histograms[0]['count'], 1)
+
+
+@override_settings(LLM_BACKEND='fake', LLM_BACKEND_OPTIONS={}, METRICS_TIMING_HEADER=True)
+class MetricsTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.character = create_character()
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_request_is_instrumented(self):
+        response = self.client.post(
+            reverse('character-talk', args=[self.character.pk]), {'message': 'Hello'}, content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('llm;dur=', response['Server-Timing'])
+        self.assertIn('desc="1 calls"', response['Server-Timing'])
+
+        exposition = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('npc_llm_call_seconds_count{outcome="ok",task="talk"} 1', exposition)
+        self.assertIn('npc_http_request_seconds_count{endpoint="character-talk",method="POST",status="200"} 1',
+                      exposition)
+        self.assertIn('npc_db_queries_count{endpoint="character-talk"} 1', exposition)
+
+    def test_errors_are_counted(self):
+        self.client.post(reverse('character-talk', args=[0]), {'message': 'Hello'}, content_type='application/json')
+        exposition = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('npc_http_errors_total{endpoint="character-talk",status="404"} 1', exposition)
+
+
+class BenchmarkTestCase(SimpleTestCase):
+    def test_latency_distributions(self):
+        for distribution in FakeBackend.DISTRIBUTIONS:
+            backend = FakeBackend(latency=0.1, jitter=0.5, distribution=distribution)
+            delays = [backend._next_call()[1] for _ in range(200)]
+            self.assertTrue(all(delay > 0 for delay in delays), distribution)
+            self.assertGreater(len(set(delays)), 1, distribution)
+        with self.assertRaises(ValueError):
+            FakeBackend(distribution='normal')
+
+    def test_fake_names_stay_unique(self):
+        backend = FakeBackend()
+        names = {backend._name_for(call) for call in range(1000)}
+        self.assertEqual(len(names), 1000)
+
+    def test_percentiles_and_regressions(self):
+        self.assertEqual(benchmark.percentile(list(range(1, 101)), 0.95), 95)
+        self.assertEqual(benchmark.percentile([0.2], 0.99), 0.2)
+
+        base = {'scenario': 'talk', 'concurrency': 8, 'rps': 100.0, 'p95_ms': 200.0, 'queries_max': 4}
+        baseline = {'results': [base]}
+        _, regressions = benchmark.compare([{**base, 'p95_ms': 220.0}], baseline, tolerance=0.2)
+        self.assertEqual(regressions, [])
+        _, regressions = benchmark.compare([{**base, 'p95_ms': 300.0}], baseline, tolerance=0.2)
+        self.assertEqual(len(regressions), 1)
+        _, regressions = benchmark.compare([{**base, 'queries_max': 5}], baseline, tolerance=0.2)
+        self.assertEqual(len(regressions), 1)
+
+
+class AlignmentTestCase(TestCase):
+    def setUp(self):
+        self.story = Story.objects.create(title="World", content="A realm.")
+
+    def create(self, name, traits):
+        return create_character(self.story, name=name, personality_traits=traits)
+
+    def test_traits_are_matched_as_words(self):
+        self.assertEqual(classify_alignment(["Kind", "Honest"]), Character.GOOD)
+        self.assertEqual(classify_alignment(["Unkind", "Cunning"]), Character.EVIL)
+        self.assertEqual(classify_alignment(["Not kind", "Curious"]), Character.NEUTRAL)
+        self.assertEqual(classify_alignment(["Kind but cruel"]), Character.NEUTRAL)
+        self.assertEqual(classify_alignment("Generous, loyal"), Character.GOOD)
+
+    @override_settings(PERSONALITY_TRAIT_LEXICON={'good': ['curious'], 'evil': []})
+    def test_lexicon_from_settings(self):
+        self.assertEqual(classify_alignment(["Curious"]), Character.GOOD)
+
+    def test_alignment_is_stored_on_save(self):
+        character = self.create("Aria", ["Kind"])
+        self.assertEqual(Character.objects.get(pk=character.pk).alignment, Character.GOOD)
+
+        character.personality_traits = ["Cruel", "Ruthless"]
+        character.save(update_fields=['personality_traits'])
+        self.assertEqual(Character.objects.get(pk=character.pk).alignment, Character.EVIL)
+
+    def test_prompt_uses_stored_alignment(self):
+        character = self.create("Mordred", ["Cruel"])
+        self.assertIn("malicious, selfish, and suspicious personality", persona.render_persona(character))
+
+    def test_filter_by_alignment(self):
+        self.create("Aria", ["Kind"])
+        self.create("Mordred", ["Cruel"])
+        self.create("Tobin", ["Curious"])
+
+        response = self.client.get(reverse('character-list'), {'alignment': 'evil'})
+        self.assertEqual([c['name'] for c in response.json()['results']], ["Mordred"])
+        response = self.client.get(reverse('character-list'), {'alignment': 'chaotic'})
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(LLM_BACKEND='fake', LLM_BACKEND_OPTIONS={})
+class PersonaCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        reset_registry()
+        self.character = create_character()
+        self.backend = FakeBackend(responses={'talk': "$prompt_chars"})
+
+    def talk(self, message="Hello"):
+        character = Character.objects.get(pk=self.character.pk)
+        return CharacterConversation(character, backend=self.backend).generate_response(message)
+
+    def test_persona_is_registered_once(self):
+        first = self.talk()
+        self.talk()
+        self.assertEqual(self.backend.contexts, 1)
+        # Only the turn is sent; the persona is cached on the provider's side
+        self.assertLess(int(first), len(persona.render_persona(self.character)))
+
+    def test_save_invalidates_persona(self):
+        self.talk()
+        self.character.background = "Exiled from the Deepwoods."
+        self.character.save()
+        self.talk()
+        self.assertEqual(self.backend.contexts, 2)
+
+    def test_context_reaches_backend_through_wrappers(self):
+        metrics.reset()
+        backend = get_backend()
+        self.assertIsInstance(backend, InstrumentedBackend)
+        context = backend.create_context("You are Aria.")
+        self.assertTrue(context.name.startswith("fake-context-"))
+        self.assertIn("Well met", backend.generate("Hello", task="talk", context=context))
+        self.assertEqual(metrics.counters()['llm_contexts_total'], [{'labels': {'cached': 'True'}, 'value': 1}])
+
+    @override_settings(LLM_CONTEXT_CACHE_MIN_TOKENS=1024)
+    def test_gemini_falls_back_to_system_instruction(self):
+        gemini = GeminiBackend(api_key="dummy")
+        context = gemini.create_context("You are Aria.")
+        self.assertIsNone(context.name)
+        self.assertEqual(gemini._config(context=context).system_instruction, "You are Aria.")
+
+        cached = PromptContext("You are Aria.", name="cachedContents/1", expires_at=time.time() + 3600)
+        self.assertEqual(gemini._config(context=cached).cached_content, "cachedContents/1")
+        self.assertIsNone(gemini._config(context=cached, use_cache=False).cached_content)
+
+
+@override_settings(LLM_BACKEND='fake', LLM_BACKEND_OPTIONS={})
+class GroupTalkTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        reset_registry()
+        story = Story.objects.create(title="Story", content="Content.")
+        self.characters = [
+            create_character(story, name=name, profession="Innkeeper", background="Keeps the tavern.")
+            for name in ("Aria", "Borin", "Cael")
+        ]
+        self.ids = [character.id for character in reversed(self.characters)]
+
+    def history_inserts(self, queries):
+        return [
+            query for query in queries.captured_queries
+            if query['sql'].startswith('INSERT') and 'conversationhistory' in query['sql']
+        ]
+
+    def test_replies_and_one_history_insert(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                reverse('group-talk'), {'character_ids': self.ids + self.ids[:1], 'message': "A round for everyone!"},
+                content_type='application/json',
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([reply['character_id'] for reply in response.json()['responses']], self.ids)
+        self.assertEqual(response.json()['errors'], [])
+
+        character_queries = [query for query in queries.captured_queries
+                             if query['sql'].startswith('SELECT') and 'FROM "npc_api_character"' in query['sql']]
+        self.assertEqual(len(character_queries), 1)
+        self.assertEqual(len(self.history_inserts(queries)), 1)
+        self.assertEqual(ConversationHistory.objects.count(), 6)
+
+    def test_missing_character(self):
+        response = self.client.post(
+            reverse('group-talk'), {'character_ids': [self.ids[0], 999], 'message': "Hello"},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()['character_ids'], [999])
+        self.assertFalse(ConversationHistory.objects.exists())
+
+    def test_streaming(self):
+        response = self.client.post(
+            reverse('group-talk') + '?stream=ndjson', {'character_ids': self.ids, 'message': "Hello"},
+            content_type='application/json',
+        )
+        events = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertTrue(any('token' in event for event in events))
+        self.assertTrue(events[-1]['done'])
+        self.assertEqual(sorted(reply['character_id'] for reply in events[-1]['responses']), sorted(self.ids))
+        self.assertEqual(ConversationHistory.objects.count(), 6)
+
+    def test_disconnect_does_not_wait_for_the_replies(self):
+        conversation = GroupConversation(self.characters, backend=FakeBackend(token_latency=0.2))
+        events = conversation.stream_events("Hello")
+        self.assertIsNone(next(events)[0])
+        started = time.perf_counter()
+        events.close()
+        self.assertLess(time.perf_counter() - started, 0.5)
+        self.assertFalse(ConversationHistory.objects.exists())
+
+    async def test_async_view(self):
+        response = await self.async_client.post(
+            reverse('async-group-talk'), {'character_ids': self.ids, 'message': "Hello"},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['responses']), 3)
+        self.assertEqual(await ConversationHistory.objects.acount(), 6)
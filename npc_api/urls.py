@@ -1,6 +1,6 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from . import views
+from . import views, async_views
 
 router = DefaultRouter()
 router.register(r'stories', views.StoryViewSet)
@@ -8,9 +8,24 @@ router.register(r'characters', views.CharacterViewSet)
 router.register(r'conversations', views.ConversationHistoryViewSet)
 
 urlpatterns = [
+    # Before the router, whose conversations/<pk>/ route would match it
+    path('conversations/group-talk/', views.GroupTalkView.as_view(), name='group-talk'),
     path('', include(router.urls)),
     path('stories/<int:story_id>/ask-question/', views.StoryAskQuestionView.as_view(), name='ask-question'),
     path('characters/<int:story_id>/generate-name/', views.GenerateCharacterNameView.as_view(), name='generate-name'),
     path('characters/<int:story_id>/generate-character/', views.GenerateCharacterView.as_view(), name='generate-character'),
+    path('characters/<int:story_id>/generate-characters/', views.GenerateCharacterBatchView.as_view(), name='generate-characters'),
+    path('characters/<int:story_id>/generate-character/jobs/', views.GenerateCharacterJobView.as_view(), name='generate-character-job'),
+    path('jobs/<uuid:job_id>/', views.CharacterJobView.as_view(), name='character-job'),
     path('conversations/<int:character_id>/talk/', views.CharacterTalkView.as_view(), name='character-talk'),
+    path('cache-stats/', views.ResponseCacheStatsView.as_view(), name='cache-stats'),
+    path('prompt-stats/', views.PromptStatsView.as_view(), name='prompt-stats'),
+
+    # ASGI-native versions of the LLM-bound endpoints
+    path('async/stories/<int:story_id>/ask-question/', async_views.AsyncStoryAskQuestionView.as_view(), name='async-ask-question'),
+    path('async/characters/<int:story_id>/generate-name/', async_views.AsyncGenerateCharacterNameView.as_view(), name='async-generate-name'),
+    path('async/characters/<int:story_id>/generate-character/', async_views.AsyncGenerateCharacterView.as_view(), name='async-generate-character'),
+    path('async/characters/<int:story_id>/generate-characters/', async_views.AsyncGenerateCharacterBatchView.as_view(), name='async-generate-characters'),
+    path('async/conversations/<int:character_id>/talk/', async_views.AsyncCharacterTalkView.as_view(), name='async-character-talk'),
+    path('async/conversations/group-talk/', async_views.AsyncGroupTalkView.as_view(), name='async-group-talk'),
 ]
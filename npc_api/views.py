@@ -1,36 +1,73 @@
+import asyncio
+import time
+
 from rest_framework import viewsets, status, views
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 
-from .models import Story, Character, ConversationHistory
+from . import metrics
+from .models import Story, Character, ConversationHistory, CharacterGenerationJob
 from .serializers import (
     StorySerializer,
+    StoryListSerializer,
     CharacterSerializer,
     StoryQuestionSerializer,
     CharacterRequestSerializer,
+    CharacterBatchRequestSerializer,
     CharacterTalkSerializer,
+    GroupTalkSerializer,
+    CharacterGenerationJobSerializer,
     ConversationHistorySerializer,
 
 )
 from .services.story_understanding import StoryUnderstanding
 from .services.character_generator import CharacterGenerator
 from .services.character_conversation import CharacterConversation
+from .services.group_conversation import GroupConversation
+from .services.response_cache import ResponseCache, cache_stats
+from .services.character_jobs import submit_job
+from .services.llm_backend import LLMError, LLMInvalidOutputError
+from .services.name_registry import unique_names
+from .pagination import ConversationHistoryCursorPagination, KeysetPage
+from .streaming import (
+    EventStreamRenderer, NDJSONRenderer, event_stream_response, get_stream_format, streaming_response
+)
 
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
 
+from django.db.models.functions import Substr
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
 from django.views.generic import TemplateView
+from django.http import HttpResponse
 from django.shortcuts import get_object_or_404
-from django.core.paginator import Paginator
+from django.urls import reverse
 from django.shortcuts import render
 
 
 class StoryViewSet(viewsets.ModelViewSet):
-    queryset = Story.objects.all()
+    queryset = Story.objects.all().order_by('id')
     serializer_class = StorySerializer
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == 'list':
+            # Lists never show the text, so it is not read from the database either
+            queryset = queryset.defer('content', 'summary')
+        return queryset
+
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return StoryListSerializer
+        return super().get_serializer_class()
+
 
 class StoryAskQuestionView(APIView):
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [EventStreamRenderer, NDJSONRenderer]
+
     @swagger_auto_schema(
         request_body=openapi.Schema(
             type=openapi.TYPE_OBJECT,
@@ -56,18 +93,33 @@ class StoryAskQuestionView(APIView):
 
         if serializer.is_valid():
             question = serializer.validated_data['question']
-            story_understanding = StoryUnderstanding(story_content=story.content)
+            response_cache = ResponseCache.for_request(request, 'ask-question')
+            story_understanding = StoryUnderstanding(story=story, response_cache=response_cache)
+
+            stream_format = get_stream_format(request)
+            if stream_format:
+                return streaming_response(story_understanding.stream_answer(question), stream_format, 'answer')
+
             answer = story_understanding.answer_question(question)
 
-            return Response({'answer': answer})
+            return Response({'answer': answer}, headers={'X-Cache': response_cache.status})
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
 class CharacterViewSet(viewsets.ModelViewSet):
-    queryset = Character.objects.all()
+    queryset = Character.objects.all().order_by('id')
     serializer_class = CharacterSerializer
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        alignment = self.request.query_params.get('alignment')
+        if alignment:
+            if alignment not in dict(Character.ALIGNMENT_CHOICES):
+                raise ValidationError({'alignment': f"Choose one of: {', '.join(dict(Character.ALIGNMENT_CHOICES))}"})
+            queryset = queryset.filter(alignment=alignment)
+        return queryset
+
 
 class GenerateCharacterView(views.APIView):
     @swagger_auto_schema(
@@ -93,7 +145,7 @@ class GenerateCharacterView(views.APIView):
         serializer = CharacterRequestSerializer(data=request.data)
 
         if serializer.is_valid():
-            story_understanding = StoryUnderstanding(story_content=story.content)
+            story_understanding = StoryUnderstanding(story=story)
             character_generator = CharacterGenerator(story_understanding)
 
             character_request = serializer.validated_data['request']
@@ -107,13 +159,194 @@ class GenerateCharacterView(views.APIView):
                 personality_traits=character_data['personality_traits'],
                 background=character_data['background']
             )
-            character.save()
+            with unique_names():
+                character.save()
 
             return Response(CharacterSerializer(character).data, status=status.HTTP_201_CREATED)
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class GenerateCharacterBatchView(views.APIView):
+    @swagger_auto_schema(
+        operation_description="Generates several characters for one story with concurrent model calls",
+        request_body=CharacterBatchRequestSerializer,
+        responses={
+            201: openapi.Response('Generated characters', schema=openapi.Schema(
+                type=openapi.TYPE_OBJECT,
+                properties={
+                    'characters': openapi.Schema(type=openapi.TYPE_ARRAY, items=openapi.Schema(type=openapi.TYPE_OBJECT)),
+                    'errors': openapi.Schema(type=openapi.TYPE_ARRAY, items=openapi.Schema(type=openapi.TYPE_OBJECT)),
+                }
+            )),
+            400: 'Invalid input data',
+            404: 'Story not found',
+            502: 'No character could be generated (429/503 when the model is rate limited or unavailable)',
+        }
+    )
+    def post(self, request, story_id):
+        try:
+            story = Story.objects.get(pk=story_id)
+        except Story.DoesNotExist:
+            return Response(
+                {"error": "Story with the given ID does not exist"},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+        serializer = CharacterBatchRequestSerializer(data=request.data)
+
+        if serializer.is_valid():
+            story_understanding = StoryUnderstanding(story=story)
+            character_generator = CharacterGenerator(story_understanding)
+
+            results = character_generator.generate_characters(serializer.validated_data['requests'])
+            characters, errors = build_characters(story, results)
+            with unique_names():
+                Character.objects.bulk_create(characters)
+
+            return Response(
+                {'characters': CharacterSerializer(characters, many=True).data, 'errors': errors},
+                status=status.HTTP_201_CREATED
+            )
+        else:
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class GenerateCharacterJobView(views.APIView):
+    @swagger_auto_schema(
+        operation_description="Queues character generation and returns the job right away; "
+                              "poll the job (or subscribe with ?stream=sse) for the result",
+        request_body=CharacterRequestSerializer,
+        responses={
+            202: CharacterGenerationJobSerializer,
+            400: 'Invalid input data',
+            404: 'Story not found'
+        }
+    )
+    def post(self, request, story_id):
+        try:
+            story = Story.objects.get(pk=story_id)
+        except Story.DoesNotExist:
+            return Response(
+                {"error": "Story with the given ID does not exist"},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+        serializer = CharacterRequestSerializer(data=request.data)
+
+        if serializer.is_valid():
+            job = submit_job(story, serializer.validated_data['request'])
+            location = reverse('character-job', args=[job.pk])
+            return Response(
+                CharacterGenerationJobSerializer(job).data,
+                status=status.HTTP_202_ACCEPTED,
+                headers={'Location': location}
+            )
+        else:
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class CharacterJobView(APIView):
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [EventStreamRenderer, NDJSONRenderer]
+
+    @swagger_auto_schema(
+        operation_description="Status of a character generation job; with ?stream=sse|ndjson the "
+                              "status is pushed on every change until the job finishes",
+        responses={200: CharacterGenerationJobSerializer, 404: 'Job not found'}
+    )
+    def get(self, request, job_id):
+        try:
+            job = CharacterGenerationJob.objects.select_related('character').get(pk=job_id)
+        except CharacterGenerationJob.DoesNotExist:
+            return Response({"error": "Job does not exist"}, status=status.HTTP_404_NOT_FOUND)
+
+        stream_format = get_stream_format(request)
+        if stream_format:
+            # An ASGI server buffers sync iterators, so it gets the async poll loop
+            if isinstance(request._request, ASGIRequest):
+                return event_stream_response(ajob_status_events(job), stream_format)
+            return event_stream_response(job_status_events(job), stream_format)
+
+        return Response(CharacterGenerationJobSerializer(job).data)
+
+
+def job_status_events(job):
+    """
+    Yields ('status', job data) on every status change and ('done', job data) at the end.
+
+    The poll loop holds a server worker, so it stops after
+    settings.CHARACTER_JOB_STREAM_TIMEOUT seconds with a ('timeout', ...) event
+    telling the client to reconnect.
+    """
+    deadline = time.monotonic() + settings.CHARACTER_JOB_STREAM_TIMEOUT
+    last_status = None
+    while not job.is_finished and time.monotonic() < deadline:
+        if job.status != last_status:
+            last_status = job.status
+            yield 'status', CharacterGenerationJobSerializer(job).data
+        time.sleep(settings.CHARACTER_JOB_POLL_INTERVAL)
+        job = CharacterGenerationJob.objects.select_related('character').get(pk=job.pk)
+
+    if job.is_finished:
+        yield 'done', dict(CharacterGenerationJobSerializer(job).data, done=True)
+    else:
+        yield 'timeout', {'id': str(job.pk), 'status': job.status, 'reconnect': True}
+
+
+async def ajob_status_events(job):
+    """Async version of job_status_events(), for ASGI servers; sleeps without holding a thread."""
+    deadline = time.monotonic() + settings.CHARACTER_JOB_STREAM_TIMEOUT
+    last_status = None
+    while not job.is_finished and time.monotonic() < deadline:
+        if job.status != last_status:
+            last_status = job.status
+            yield 'status', CharacterGenerationJobSerializer(job).data
+        await asyncio.sleep(settings.CHARACTER_JOB_POLL_INTERVAL)
+        job = await CharacterGenerationJob.objects.select_related('character').aget(pk=job.pk)
+
+    if job.is_finished:
+        yield 'done', dict(CharacterGenerationJobSerializer(job).data, done=True)
+    else:
+        yield 'timeout', {'id': str(job.pk), 'status': job.status, 'reconnect': True}
+
+
+def build_characters(story, results):
+    """
+    Turns (character_data, exception) pairs into unsaved Characters and a list of per-request errors.
+
+    When no character could be built, the first LLMError is raised (so the
+    client gets a 429/409/503/502 like for a single character), or an
+    LLMInvalidOutputError (502) if the model only returned unusable data.
+    """
+    characters, errors = [], []
+    for index, (character_data, error) in enumerate(results):
+        if character_data is None:
+            errors.append({'index': index, 'error': str(error)})
+            continue
+        try:
+            character = Character(
+                story=story,
+                name=character_data['name'],
+                faction=character_data['faction'],
+                profession=character_data['profession'],
+                personality_traits=character_data['personality_traits'],
+                background=character_data['background']
+            )
+        except (KeyError, TypeError) as e:
+            errors.append({'index': index, 'error': f"Incomplete character data: {str(e)}"})
+            continue
+        # Saved with bulk_create(), which skips Character.save()
+        character.update_alignment()
+        characters.append(character)
+
+    if not characters:
+        for _, error in results:
+            if isinstance(error, LLMError):
+                raise error
+        raise LLMInvalidOutputError(f"No character could be generated: {errors[0]['error']}")
+    return characters, errors
+
+
 class GenerateCharacterNameView(views.APIView):
     @swagger_auto_schema(
         request_body=CharacterRequestSerializer,
@@ -138,18 +371,21 @@ class GenerateCharacterNameView(views.APIView):
         serializer = CharacterRequestSerializer(data=request.data)
 
         if serializer.is_valid():
-            story_understanding = StoryUnderstanding(story_content=story.content)
-            character_generator = CharacterGenerator(story_understanding)
+            response_cache = ResponseCache.for_request(request, 'generate-name')
+            story_understanding = StoryUnderstanding(story=story)
+            character_generator = CharacterGenerator(story_understanding, response_cache=response_cache)
 
             character_request = serializer.validated_data['request']
             name = character_generator.generate_character_name(character_request)
 
-            return Response({'name': name})
+            return Response({'name': name}, headers={'X-Cache': response_cache.status})
         else:
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
 class CharacterTalkView(APIView):
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [EventStreamRenderer, NDJSONRenderer]
+
     @swagger_auto_schema(
         operation_description="Sends a message to the character and generates a response according to their personality",
         request_body=CharacterTalkSerializer,
@@ -185,10 +421,20 @@ class CharacterTalkView(APIView):
                 # Initialize the conversation service
                 conversation_service = CharacterConversation(character=character)
 
+                # Stream tokens as they are generated if the client asked for it
+                stream_format = get_stream_format(request)
+                if stream_format:
+                    return streaming_response(
+                        conversation_service.stream_response(message), stream_format, 'response'
+                    )
+
                 # Generate response
                 response = conversation_service.generate_response(message)
 
                 return Response({'response': response})
+            except LLMError:
+                # Answered with 429/503 by npc_api.exceptions.exception_handler
+                raise
             except Exception as e:
                 return Response(
                     {"error": f"An error occurred: {str(e)}"},
@@ -198,14 +444,94 @@ class CharacterTalkView(APIView):
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+def load_group(character_ids):
+    """
+    Loads the characters of a group talk with one query.
+
+    Returns:
+        tuple: (characters in the requested order, list of ids that do not exist)
+    """
+    found = Character.objects.in_bulk(character_ids)
+    missing = [character_id for character_id in character_ids if character_id not in found]
+    return [found[character_id] for character_id in character_ids if character_id in found], missing
+
+
+class GroupTalkView(APIView):
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [EventStreamRenderer, NDJSONRenderer]
+
+    @swagger_auto_schema(
+        operation_description="Sends one message to several characters; they answer concurrently",
+        request_body=GroupTalkSerializer,
+        responses={
+            200: openapi.Response('Character responses', schema=openapi.Schema(
+                type=openapi.TYPE_OBJECT,
+                properties={
+                    'responses': openapi.Schema(type=openapi.TYPE_ARRAY, items=openapi.Schema(type=openapi.TYPE_OBJECT)),
+                    'errors': openapi.Schema(type=openapi.TYPE_ARRAY, items=openapi.Schema(type=openapi.TYPE_OBJECT)),
+                }
+            )),
+            400: 'Invalid input data',
+            404: 'Character not found',
+        }
+    )
+    def post(self, request):
+        serializer = GroupTalkSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        characters, missing = load_group(serializer.validated_data['character_ids'])
+        if missing:
+            return Response(
+                {"error": "Characters with the given IDs do not exist", "character_ids": missing},
+                status=status.HTTP_404_NOT_FOUND
+            )
+
+        message = serializer.validated_data['message']
+        group = GroupConversation(characters)
+
+        stream_format = get_stream_format(request)
+        if stream_format:
+            return event_stream_response(group.stream_events(message), stream_format)
+
+        # Replies that failed are listed in `errors`; a model error on every call raises (429/503)
+        return Response(group.generate_responses(message))
+
+
+class ResponseCacheStatsView(APIView):
+    @swagger_auto_schema(
+        operation_description="Per-endpoint hit/miss counters of the LLM response cache in this process",
+        responses={200: 'Counters by endpoint'}
+    )
+    def get(self, request):
+        return Response(cache_stats())
+
+
+class PromptStatsView(APIView):
+    @swagger_auto_schema(
+        operation_description="Histogram of the estimated prompt size in tokens, per prompt template, in this process",
+        responses={200: 'Histograms by template'}
+    )
+    def get(self, request):
+        return Response(metrics.snapshot().get('prompt_tokens', []))
+
+
+def metrics_view(request):
+    """Metrics of this process in the Prometheus text format."""
+    return HttpResponse(metrics.render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 class ConversationHistoryViewSet(viewsets.ModelViewSet):
-    queryset = ConversationHistory.objects.all().order_by('-timestamp')
+    queryset = ConversationHistory.objects.all().order_by('-timestamp', '-id')
     serializer_class = ConversationHistorySerializer
+    pagination_class = ConversationHistoryCursorPagination
     filterset_fields = ['character', 'sender_type']
     search_fields = ['message']
 
     def get_queryset(self):
-        queryset = super().get_queryset()
+        # character_name comes from the joined character, not one query per row
+        queryset = super().get_queryset().select_related('character').only(
+            'id', 'character_id', 'message', 'sender_type', 'timestamp', 'character__name'
+        )
         character_id = self.request.query_params.get('character_id')
         if character_id:
             queryset = queryset.filter(character_id=character_id)
@@ -220,21 +546,32 @@ class ConversationHistoryTemplateView(TemplateView):
         character_id = self.kwargs.get('character_id')
 
         character = get_object_or_404(Character, pk=character_id)
-        conversations = ConversationHistory.objects.filter(character=character).order_by('timestamp')
+        conversations = ConversationHistory.objects.filter(character=character)
 
-        page = self.request.GET.get('page', 1)
-        paginator = Paginator(conversations, 20)
-        paginated_conversations = paginator.get_page(page)
+        paginated_conversations = KeysetPage(
+            conversations,
+            after=self.request.GET.get('after'),
+            before=self.request.GET.get('before'),
+        )
 
         context['character'] = character
         context['conversations'] = paginated_conversations
         return context
 
+
+# Enough characters for the 130 words shown per story on the world page
+WORLD_PAGE_EXCERPT_CHARS = 2000
+
+
 def main_page(request):
     return render(request, 'npc_api/main.html')
 
 def world_page(request):
-    stories = Story.objects.all()
+    # The page shows the first words of each story only; load a bounded excerpt
+    # instead of the full content
+    stories = Story.objects.defer('content', 'summary').annotate(
+        excerpt=Substr('content', 1, WORLD_PAGE_EXCERPT_CHARS)
+    )
     return render(request, 'npc_api/world.html', {'stories': stories})
 
 def characters_page(request):